@@ -0,0 +1,138 @@
+"""
+Admission control for CNN inference.
+
+Inference runs on a dedicated, fixed-size executor so it cannot starve the
+thread pool used for Supabase calls. The executor tracks its backlog and an
+exponentially weighted service time per image, and AdmissionMiddleware uses
+them to shed requests (429 + Retry-After) whose expected wait would exceed
+the budget of their priority class.
+"""
+
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+from .metrics import registry, Counter, Gauge
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+
+# Starting guess for the per-image service time, before any inference has run
+INITIAL_SERVICE_SECONDS = float(os.getenv("INITIAL_INFERENCE_SERVICE_SECONDS", "0.2"))
+
+# Weight of the newest observation in the service-time average
+SERVICE_TIME_ALPHA = 0.2
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    """Parse 'a:x,b:y' into {'a': 'x', 'b': 'y'}"""
+    mapping = {}
+    for item in value.split(","):
+        if ":" in item:
+            key, _, val = item.rpartition(":")
+            mapping[key.strip()] = val.strip()
+    return mapping
+
+
+# Longest expected queue wait, in seconds, each priority class will accept.
+# Classes without a budget (and routes without a class) are never shed.
+ADMISSION_CLASS_BUDGETS = {
+    name: float(budget)
+    for name, budget in _parse_mapping(os.getenv("ADMISSION_CLASS_BUDGETS", "analysis:5,batch:2")).items()
+}
+
+# Priority class of each route; everything else (login, save_similar_moles, ...) is critical
+ADMISSION_ROUTE_CLASSES = _parse_mapping(os.getenv(
+    "ADMISSION_ROUTE_CLASSES",
+    "/api/analyze:analysis,/api/analyze/stream:analysis,/api/analyze/batch:batch",
+))
+
+
+class InferenceQueue:
+    def __init__(self, workers: int = INFERENCE_WORKERS):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self.pending_units = 0
+        self.service_seconds_per_unit = INITIAL_SERVICE_SECONDS
+
+    def _observe(self, seconds_per_unit: float) -> None:
+        with self._lock:
+            self.service_seconds_per_unit += SERVICE_TIME_ALPHA * (seconds_per_unit - self.service_seconds_per_unit)
+
+    def expected_wait(self, units: int = 1) -> float:
+        """Seconds a job of `units` images submitted now is expected to take to finish"""
+        with self._lock:
+            per_unit = self.service_seconds_per_unit
+        return (self.pending_units / self.workers + units) * per_unit
+
+    async def run(self, fn: Callable, *args, units: int = 1):
+        """Run fn(*args) on the inference executor, counting it as `units` images of backlog"""
+        context = contextvars.copy_context()
+
+        def job():
+            start = time.perf_counter()
+            try:
+                return context.run(fn, *args)
+            finally:
+                self._observe((time.perf_counter() - start) / max(units, 1))
+
+        self.pending_units += units
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+        finally:
+            self.pending_units -= units
+
+
+# Global instance
+inference_queue = InferenceQueue()
+
+shed_requests = registry.register(Counter(
+    "dermafast_admission_shed_total", "Requests rejected by admission control", ["priority"]))
+registry.register(Gauge(
+    "dermafast_inference_queue_depth", "Images queued or running on the inference executor",
+    callback=lambda: inference_queue.pending_units))
+registry.register(Gauge(
+    "dermafast_inference_service_seconds", "Average inference service time per image",
+    callback=lambda: inference_queue.service_seconds_per_unit))
+
+
+def retry_after_seconds(expected_wait: float, budget: float) -> int:
+    """How long a shed client should back off: roughly the excess backlog"""
+    return max(1, math.ceil(expected_wait - budget))
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware that answers 429 with Retry-After, before the request body
+    is read, when the inference backlog exceeds the route's class budget.
+    """
+
+    def __init__(self, app, queue: Optional[InferenceQueue] = None):
+        self.app = app
+        self.queue = queue or inference_queue
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            priority = ADMISSION_ROUTE_CLASSES.get(scope["path"])
+            budget = ADMISSION_CLASS_BUDGETS.get(priority) if priority else None
+
+            if budget is not None:
+                expected_wait = self.queue.expected_wait()
+                if expected_wait > budget:
+                    shed_requests.inc(priority=priority)
+                    response = JSONResponse(
+                        status_code=429,
+                        content={"detail": "The analysis service is busy, please retry shortly"},
+                        headers={"Retry-After": str(retry_after_seconds(expected_wait, budget))},
+                    )
+                    await response(scope, receive, send)
+                    return
+
+        await self.app(scope, receive, send)
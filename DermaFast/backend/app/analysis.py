@@ -0,0 +1,255 @@
+"""
+Stages of the mole analysis pipeline shared by the analyze endpoints.
+
+Each stage is awaitable and runs its blocking work off the event loop (CNN
+inference on the admission-controlled inference executor, Supabase requests
+through resilience.remote_call), so the endpoints can interleave or stream them.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch.nn as nn
+from fastapi import HTTPException
+
+from .ml_model import inference, inference_batch
+from .supabase_client import supabase_client as supabase
+from .faiss_service import faiss_service
+from .metrics import stage_timer, fallbacks
+from .admission import inference_queue
+from .resilience import remote_call, has_budget
+
+logger = logging.getLogger(__name__)
+
+# Similar images are optional: skip them when less than this much of the request's deadline is left
+SIMILAR_IMAGES_MIN_BUDGET_SECONDS = float(os.getenv("SIMILAR_IMAGES_MIN_BUDGET_SECONDS", "1.0"))
+
+
+async def run_inference(model: nn.Module, image_bytes: bytes) -> Tuple[float, List[float]]:
+    """Run the CNN on an uploaded image without blocking the event loop"""
+    logger.debug("Running CNN inference")
+    cnn_result, embedding_list = await inference_queue.run(inference, model, image_bytes)
+    logger.debug("CNN inference completed", extra={"cnn_result": cnn_result, "embedding_dimensions": len(embedding_list)})
+    return cnn_result, embedding_list
+
+
+async def run_batch_inference(model: nn.Module, images: List[bytes]) -> List[Optional[Tuple[float, List[float]]]]:
+    """Run one batched CNN forward pass; undecodable images yield None"""
+    logger.debug("Running batched CNN inference", extra={"batch_size": len(images)})
+    results = await inference_queue.run(inference_batch, model, images, units=max(len(images), 1))
+    logger.debug("Batched CNN inference completed", extra={"decoded": sum(r is not None for r in results)})
+    return results
+
+
+async def store_cnn_result(national_id: str, cnn_result: float, embedding_list: List[float],
+                           model_version: Optional[str] = None):
+    """
+    Insert the analysis into the cnn_results table, tagged with the model version that produced it.
+    Raises HTTPException if Supabase reports an error.
+    """
+    logger.debug("Storing results in Supabase")
+    with stage_timer("db_insert_cnn_results"):
+        insert_response = await remote_call(
+            "database",
+            lambda: supabase.table("cnn_results").insert({
+                "national_id": national_id,
+                "cnn_result": float(cnn_result),  # Ensure it's a float
+                "embedding": embedding_list,
+                "model_version": model_version
+            }).execute()
+        )
+
+    # Check if Supabase returned an error
+    if hasattr(insert_response, 'error') and insert_response.error is not None:
+        logger.error("Supabase error storing cnn_results: %s", insert_response.error)
+        raise HTTPException(status_code=500, detail=f"Failed to store results: {insert_response.error}")
+
+    logger.debug("Results stored successfully in Supabase")
+    return insert_response
+
+
+async def store_cnn_results_batch(national_id: str, results: List[Tuple[float, List[float]]],
+                                  model_version: Optional[str] = None):
+    """
+    Insert several analyses into the cnn_results table with a single request.
+    Raises HTTPException if Supabase reports an error.
+
+    The table's key is (national_id, timestamp) and the column's now() default
+    is the same for every row of one statement, so each row gets an explicit
+    timestamp one microsecond after the previous one, in upload order.
+    """
+    if not results:
+        return None
+
+    logger.debug("Storing batch results in Supabase", extra={"rows": len(results)})
+    started = datetime.now(timezone.utc)
+    rows = [
+        {"national_id": national_id, "timestamp": (started + timedelta(microseconds=i)).isoformat(timespec="microseconds"),
+         "cnn_result": float(cnn_result), "embedding": embedding_list, "model_version": model_version}
+        for i, (cnn_result, embedding_list) in enumerate(results)
+    ]
+    with stage_timer("db_insert_cnn_results_batch"):
+        insert_response = await remote_call("database", lambda: supabase.table("cnn_results").insert(rows).execute())
+
+    if hasattr(insert_response, 'error') and insert_response.error is not None:
+        logger.error("Supabase error storing cnn_results batch: %s", insert_response.error)
+        raise HTTPException(status_code=500, detail=f"Failed to store results: {insert_response.error}")
+
+    logger.debug("Batch results stored successfully in Supabase")
+    return insert_response
+
+
+def combine_with_metadata(similar_images: List[Tuple[str, float]], metadata: List[dict]) -> List[Dict[str, Any]]:
+    """Merge FAISS (image_id, distance) pairs with their ham_metadata rows"""
+    # Create a mapping of image_id to metadata for easy lookup
+    metadata_dict = {item['image_id']: item for item in metadata}
+
+    combined = []
+    for image_id, distance in similar_images:
+        item = metadata_dict.get(image_id, {})
+        combined.append({
+            "image_id": image_id,
+            "distance": distance,
+            "image_url": item.get("image_url", ""),
+            "diagnosis": item.get("dx", "unknown"),
+            "age": item.get("age", None),
+            "sex": item.get("sex", "unknown"),
+            "localization": item.get("localization", "unknown")
+        })
+    return combined
+
+
+async def find_similar_with_metadata(embedding_list: List[float], k: int = 9) -> List[Dict[str, Any]]:
+    """
+    Find the k nearest reference images and attach their metadata.
+    Similarity search is optional, so failures (or too little time left before
+    the request's deadline) are logged and yield an empty list.
+    """
+    if not has_budget(SIMILAR_IMAGES_MIN_BUDGET_SECONDS):
+        logger.warning("Skipping similarity search, request deadline nearly reached")
+        fallbacks.inc(reason="deadline_similar_images")
+        return []
+
+    if faiss_service.stale:
+        faiss_service.reload_if_stale()
+        fallbacks.inc(reason="faiss_stale")
+        return []
+
+    logger.debug("Starting FAISS similarity search")
+    try:
+        # Check if FAISS service is ready
+        if not faiss_service.embeddings_loaded:
+            logger.info("FAISS embeddings not loaded, attempting to load")
+            with stage_timer("faiss_load"):
+                load_success = await faiss_service.load_embeddings()
+            if not load_success:
+                logger.warning("FAISS embeddings could not be loaded - similarity search unavailable")
+                fallbacks.inc(reason="faiss_unavailable")
+                return []
+            logger.info("FAISS embeddings loaded successfully")
+
+        with stage_timer("faiss_search"):
+            similar_images = await faiss_service.find_similar_images(embedding_list, k=k)
+        logger.debug("Found %d similar images", len(similar_images))
+
+        if not similar_images:
+            logger.info("No similar images found")
+            return []
+
+        # Get metadata for similar images
+        similar_image_ids = [img_id for img_id, _ in similar_images]
+        with stage_timer("metadata_lookup"):
+            similar_images_metadata = await faiss_service.get_image_metadata(similar_image_ids)
+        logger.debug("Retrieved metadata for %d images", len(similar_images_metadata))
+
+        return combine_with_metadata(similar_images, similar_images_metadata)
+
+    except Exception:
+        logger.exception("FAISS error (continuing without similar images)")
+        fallbacks.inc(reason="faiss_error")
+        return []
+
+
+async def find_similar_with_metadata_batch(embeddings: List[List[float]], k: int = 9) -> List[List[Dict[str, Any]]]:
+    """
+    Batched find_similar_with_metadata: one index search for all queries and one
+    metadata query for the union of their neighbours.
+    """
+    if not has_budget(SIMILAR_IMAGES_MIN_BUDGET_SECONDS):
+        logger.warning("Skipping similarity search, request deadline nearly reached")
+        fallbacks.inc(reason="deadline_similar_images")
+        return [[] for _ in embeddings]
+
+    if faiss_service.stale:
+        faiss_service.reload_if_stale()
+        fallbacks.inc(reason="faiss_stale")
+        return [[] for _ in embeddings]
+
+    logger.debug("Starting batched FAISS similarity search", extra={"queries": len(embeddings)})
+    try:
+        if not faiss_service.embeddings_loaded:
+            logger.info("FAISS embeddings not loaded, attempting to load")
+            with stage_timer("faiss_load"):
+                load_success = await faiss_service.load_embeddings()
+            if not load_success:
+                logger.warning("FAISS embeddings could not be loaded - similarity search unavailable")
+                fallbacks.inc(reason="faiss_unavailable")
+                return [[] for _ in embeddings]
+
+        with stage_timer("faiss_search_batch"):
+            similar_per_query = await faiss_service.find_similar_images_batch(embeddings, k=k)
+
+        unique_ids = list(dict.fromkeys(img_id for similar in similar_per_query for img_id, _ in similar))
+        with stage_timer("metadata_lookup"):
+            metadata = await faiss_service.get_image_metadata(unique_ids) if unique_ids else []
+        logger.debug("Retrieved metadata for %d of %d distinct images", len(metadata), len(unique_ids))
+
+        return [combine_with_metadata(similar, metadata) for similar in similar_per_query]
+
+    except Exception:
+        logger.exception("FAISS error (continuing without similar images)")
+        fallbacks.inc(reason="faiss_error")
+        return [[] for _ in embeddings]
+
+
+async def analyze_image(model: nn.Module, national_id: str, image_bytes: bytes,
+                        model_version: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Full analysis of one image: inference, storing the cnn_results row and the
+    similarity search. Returns the /api/analyze response body.
+    """
+    # Get prediction
+    cnn_result, embedding_list = await run_inference(model, image_bytes)
+
+    # Store results in Supabase
+    insert_response = await store_cnn_result(national_id, cnn_result, embedding_list, model_version)
+
+    # Perform FAISS similarity search
+    similar_images_with_metadata = await find_similar_with_metadata(embedding_list, k=9)
+
+    # The inserted row should be available in the `data` attribute
+    if insert_response.data:
+        inserted_data = insert_response.data[0]
+        result = {
+            "message": "Analysis successful",
+            "cnn_result": inserted_data.get("cnn_result"),
+            "embedding_dimensions": len(inserted_data.get("embedding", [])),
+            "model_version": model_version,
+            "similar_images": similar_images_with_metadata
+        }
+        logger.info("Analysis complete", extra={"similar_images": len(similar_images_with_metadata)})
+        return result
+
+    # Fallback if no data was returned
+    fallbacks.inc(reason="cnn_results_no_data")
+    result = {
+        "message": "Analysis successful but no data returned from DB",
+        "cnn_result": float(cnn_result),
+        "embedding_dimensions": len(embedding_list),
+        "model_version": model_version,
+        "similar_images": similar_images_with_metadata
+    }
+    logger.info("Analysis complete (no data returned from DB)", extra={"similar_images": len(similar_images_with_metadata)})
+    return result
@@ -0,0 +1,86 @@
+"""
+Assessment sessions: the inputs of one user's recommendation, kept in memory.
+
+An assessment collects the questionnaire answers, the CNN result and the
+diagnoses of the similar reference images as the user submits them, so
+save_similar_moles can compute the recommendation without reading them back
+from Supabase. Sessions live in a bounded TTL store in this process only; when
+a request reaches a process that does not hold the session (another worker,
+a restart, an expired entry) the endpoints fall back to the database, which
+stays the system of record.
+"""
+
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from .cache import TTLCache
+
+ASSESSMENT_MAX_SESSIONS = int(os.getenv("ASSESSMENT_MAX_SESSIONS", "10000"))
+ASSESSMENT_TTL_SECONDS = float(os.getenv("ASSESSMENT_TTL_SECONDS", "3600"))
+
+
+@dataclass
+class Assessment:
+    national_id: str
+    cnn_result: Optional[float] = None
+    # image_id -> dx of the similar images shown with the analysis
+    diagnoses: Dict[str, str] = field(default_factory=dict)
+    answers: Optional[Dict[str, bool]] = None
+
+    def has_melanoma_selection(self, selected_ids: List[str]) -> Optional[bool]:
+        """Whether a selected image is a melanoma, or None if a selected image's diagnosis is not known here"""
+        if any(image_id not in self.diagnoses for image_id in selected_ids):
+            return None
+        return any(self.diagnoses[image_id] == "mel" for image_id in selected_ids)
+
+
+class AssessmentStore:
+    def __init__(self, maxsize: int = ASSESSMENT_MAX_SESSIONS, ttl: float = ASSESSMENT_TTL_SECONDS):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, national_id: str, assessment_id: Optional[str]) -> Optional[Assessment]:
+        """The user's assessment, or None if it is unknown, expired or belongs to someone else"""
+        if not assessment_id:
+            return None
+        assessment = self._sessions.get(assessment_id)
+        if assessment is None or assessment.national_id != national_id:
+            return None
+        return assessment
+
+    def _get_or_create(self, national_id: str, assessment_id: Optional[str]) -> str:
+        if self.get(national_id, assessment_id) is None:
+            assessment_id = uuid.uuid4().hex
+        # Setting it again also restarts its time-to-live
+        self._sessions.set(assessment_id, self._sessions.get(assessment_id) or Assessment(national_id))
+        return assessment_id
+
+    def record_answers(self, national_id: str, assessment_id: Optional[str], answers: Dict[str, bool]) -> str:
+        """Store questionnaire answers, starting a new assessment if needed. Returns its ID."""
+        assessment_id = self._get_or_create(national_id, assessment_id)
+        self._sessions.get(assessment_id).answers = dict(answers)
+        return assessment_id
+
+    def record_analysis(self, national_id: str, assessment_id: Optional[str], cnn_result: Optional[float],
+                        similar_images: List[Dict[str, Any]]) -> str:
+        """
+        Store the latest analysis (replacing an earlier one), starting a new
+        assessment if needed. Returns its ID.
+        """
+        assessment_id = self._get_or_create(national_id, assessment_id)
+        assessment = self._sessions.get(assessment_id)
+        assessment.cnn_result = None if cnn_result is None else float(cnn_result)
+        assessment.diagnoses = {
+            image["image_id"]: image["diagnosis"]
+            for image in similar_images
+            if image.get("diagnosis", "unknown") != "unknown"
+        }
+        return assessment_id
+
+    def clear(self) -> None:
+        self._sessions.clear()
+
+
+# Global instance
+assessment_store = AssessmentStore()
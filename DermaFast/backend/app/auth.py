@@ -1,16 +1,107 @@
+import asyncio
+import logging
+import math
+import os
+import time
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from typing import Dict, Any, Optional
 import jwt
-from fastapi import Header, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 
+from .cache import TTLCache
+from .rate_limit import SlidingWindowLimiter
 from .supabase_client import supabase_client
+from .logging_config import bind_user
+from .metrics import registry, Counter, Gauge, Histogram
+from .resilience import remote_call
+
+logger = logging.getLogger(__name__)
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key"  # Should be in .env file
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Authenticated user cache. Entries are keyed by the token subject (users.id),
+# so a user deleted or revoked by another process is still accepted for at most this long.
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+_user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Revocations are stored in users.tokens_valid_after, which every process reads through
+# the user cache. This deny-list of user ID -> revocation time applies them at once in
+# the process that made them; every token it covers has expired once the entry does.
+REVOKED_USERS_MAX_SIZE = int(os.getenv("REVOKED_USERS_MAX_SIZE", "100000"))
+_revoked_user_ids = TTLCache(maxsize=REVOKED_USERS_MAX_SIZE, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+# bcrypt is deliberately slow, so it runs on a dedicated pool instead of the
+# event loop. Jobs beyond PASSWORD_HASH_MAX_PENDING are refused outright.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_password_jobs_pending = 0
+
+password_hash_queue_time = registry.register(Histogram(
+    "dermafast_password_hash_queue_seconds", "Time password hashing jobs wait for a pool worker"))
+password_hash_rejected = registry.register(Counter(
+    "dermafast_password_hash_rejected_total", "Password hashing jobs refused because the pool was saturated"))
+registry.register(Gauge(
+    "dermafast_password_hash_pending", "Password hashing jobs queued or running",
+    callback=lambda: _password_jobs_pending))
+
+# Login admission limits, counted over a sliding window: every attempt per IP,
+# failed password checks per account (a successful login clears the account's window)
+LOGIN_ATTEMPT_WINDOW_SECONDS = float(os.getenv("LOGIN_ATTEMPT_WINDOW_SECONDS", "60"))
+LOGIN_ATTEMPTS_PER_ACCOUNT = int(os.getenv("LOGIN_ATTEMPTS_PER_ACCOUNT", "5"))
+LOGIN_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_ATTEMPTS_PER_IP", "30"))
+# Accounts with recent failed logins tracked at once (and as many again that reached the limit)
+LOGIN_TRACKED_ACCOUNTS = int(os.getenv("LOGIN_TRACKED_ACCOUNTS", "50000"))
+
+_account_limiter = SlidingWindowLimiter(LOGIN_ATTEMPTS_PER_ACCOUNT, LOGIN_ATTEMPT_WINDOW_SECONDS,
+                                        max_keys=LOGIN_TRACKED_ACCOUNTS)
+_ip_limiter = SlidingWindowLimiter(LOGIN_ATTEMPTS_PER_IP, LOGIN_ATTEMPT_WINDOW_SECONDS)
+
+# Users allowed to call the /admin endpoints (comma-separated national IDs)
+ADMIN_NATIONAL_IDS = {nid.strip() for nid in os.getenv("ADMIN_NATIONAL_IDS", "").split(",") if nid.strip()}
+
+
+async def _run_password_job(fn, *args):
+    """Run a bcrypt call on the password pool, recording how long it queued"""
+    global _password_jobs_pending
+
+    if _password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        password_hash_rejected.inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-in attempts in progress, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    submitted_at = time.monotonic()
+
+    def job():
+        password_hash_queue_time.observe(time.monotonic() - submitted_at)
+        return fn(*args)
+
+    _password_jobs_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, job)
+    finally:
+        _password_jobs_pending -= 1
+
+def _too_many_attempts(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many attempts, please try again later",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
 class AuthService:
     @staticmethod
     def hash_password(password: str) -> str:
@@ -19,6 +110,31 @@ class AuthService:
         hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
         return hashed.decode('utf-8')
     
+    @staticmethod
+    async def hash_password_async(password: str) -> str:
+        """Hash a password on the password pool without blocking the event loop"""
+        return await _run_password_job(AuthService.hash_password, password)
+
+    @staticmethod
+    async def verify_password_async(password: str, hashed_password: str) -> bool:
+        """Verify a password on the password pool without blocking the event loop"""
+        return await _run_password_job(AuthService.verify_password, password, hashed_password)
+
+    @staticmethod
+    def check_login_admission(national_id: str, client_ip: Optional[str]) -> None:
+        """
+        Enforce the per-IP attempt limit and the per-account limit on failed
+        logins. Only the IP attempt is recorded here; authenticate_user reserves
+        the account's attempt.
+        Raises a 429 HTTPException with Retry-After when either is exceeded.
+        """
+        retry_after = _ip_limiter.hit(client_ip) if client_ip else None
+        if retry_after is None:
+            retry_after = _account_limiter.check(national_id)
+
+        if retry_after is not None:
+            raise _too_many_attempts(retry_after)
+
     @staticmethod
     def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         to_encode = data.copy()
@@ -26,7 +142,8 @@ class AuthService:
             expire = datetime.now(timezone.utc) + expires_delta
         else:
             expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-        to_encode.update({"exp": expire})
+        # Sub-second iat, so a token from signing in right after a revocation is not covered by it
+        to_encode.update({"exp": expire, "iat": time.time()})
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
         return encoded_jwt
 
@@ -42,27 +159,31 @@ class AuthService:
         """Create a new user in the Supabase 'users' table"""
         try:
             # Check if user already exists
-            response = supabase_client.from_("users").select("id").eq("national_id", national_id).execute()
+            response = await remote_call(
+                "database", lambda: supabase_client.from_("users").select("id").eq("national_id", national_id).execute()
+            )
             if response.data:
                 return False  # User already exists
 
-            password_hash = AuthService.hash_password(password)
+            password_hash = await AuthService.hash_password_async(password)
             
             # Insert new user
-            insert_response = supabase_client.from_("users").insert({
+            insert_response = await remote_call("database", lambda: supabase_client.from_("users").insert({
                 "national_id": national_id,
                 "password_hash": password_hash,
-            }).execute()
+            }).execute())
 
             # Check if insert was successful
             if not insert_response.data:
                 # Log error or handle it more gracefully
-                print(f"Error creating user: {insert_response.get('error')}")
+                logger.error("Error creating user: %s", getattr(insert_response, 'error', None))
                 return False
             
             return True
-        except Exception as e:
-            print(f"An unexpected error occurred in create_user: {e}")
+        except HTTPException:
+            raise
+        except Exception:
+            logger.exception("An unexpected error occurred in create_user")
             return False
     
     @staticmethod
@@ -70,25 +191,39 @@ class AuthService:
         """
         Authenticate a user from Supabase and update their last_login.
         Returns user data on success, None on failure.
+
+        The attempt counts against the account before anything is awaited, so
+        concurrent guesses cannot all get past the limit; it is taken back on
+        success (with the account's earlier failures) or when no password was
+        checked. Raises a 429 HTTPException when the account is at its limit.
         """
+        retry_after = _account_limiter.hit(national_id)
+        if retry_after is not None:
+            raise _too_many_attempts(retry_after)
+
         try:
-            response = supabase_client.from_("users").select("id, password_hash, last_login").eq("national_id", national_id).execute()
+            response = await remote_call(
+                "database",
+                lambda: supabase_client.from_("users").select("id, password_hash, last_login").eq("national_id", national_id).execute()
+            )
             
             if not response.data:
                 return None  # User not found
 
             user_data = response.data[0]
             
-            if not AuthService.verify_password(password, user_data['password_hash']):
+            if not await AuthService.verify_password_async(password, user_data['password_hash']):
                 return None  # Invalid password
+
+            _account_limiter.reset(national_id)
             
             previous_last_login = user_data.get("last_login")
             
             # Update last_login timestamp
             current_time = datetime.now(timezone.utc).isoformat()
-            supabase_client.from_("users").update({
+            await remote_call("database", lambda: supabase_client.from_("users").update({
                 "last_login": current_time
-            }).eq("national_id", national_id).execute()
+            }).eq("national_id", national_id).execute())
 
             # Create access token
             access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -103,10 +238,64 @@ class AuthService:
                 "access_token": access_token,
                 "token_type": "bearer"
             }
-        except Exception as e:
-            print(f"An unexpected error occurred in authenticate_user: {e}")
+        except HTTPException:
+            _account_limiter.release(national_id)
+            raise
+        except Exception:
+            _account_limiter.release(national_id)
+            logger.exception("An unexpected error occurred in authenticate_user")
             return None
 
+    @staticmethod
+    def revoke_user(user_id, revoked_at: Optional[float] = None) -> None:
+        """
+        Reject every token issued to this user up to `revoked_at` (default now)
+        in this process, and drop them from the cache
+        """
+        _revoked_user_ids.set(str(user_id), time.time() if revoked_at is None else revoked_at)
+        _user_cache.pop(str(user_id))
+
+    @staticmethod
+    def restore_user(user_id) -> None:
+        """Lift a revocation made with revoke_user"""
+        _revoked_user_ids.pop(str(user_id))
+
+    @staticmethod
+    def is_revoked(user_id, issued_at: Optional[float] = None) -> bool:
+        """Whether a token issued at `issued_at` (unknown: None) was revoked"""
+        return _issued_before(issued_at, _revoked_user_ids.get(str(user_id)))
+
+    @staticmethod
+    async def revoke_sessions(national_id: str) -> bool:
+        """
+        Revoke every token issued so far to the user with this national ID;
+        they can sign in again. Returns False if there is no such user.
+        """
+        revoked_at = datetime.now(timezone.utc)
+        response = await remote_call("database", lambda: supabase_client.from_("users").update({
+            "tokens_valid_after": revoked_at.isoformat()
+        }).eq("national_id", national_id).execute())
+        for row in response.data or []:
+            AuthService.revoke_user(row["id"], revoked_at.timestamp())
+        return bool(response.data)
+
+    @staticmethod
+    async def delete_user(national_id: str) -> bool:
+        """
+        Delete a user from the Supabase 'users' table and revoke their tokens.
+        Returns True if a user was deleted.
+        """
+        try:
+            response = await remote_call(
+                "database", lambda: supabase_client.from_("users").delete().eq("national_id", national_id).execute()
+            )
+            for row in response.data or []:
+                AuthService.revoke_user(row["id"])
+            return bool(response.data)
+        except Exception:
+            logger.exception("An unexpected error occurred in delete_user")
+            return False
+
     @staticmethod
     async def get_current_user(authorization: str = Header(...)) -> Dict[str, Any]:
         credentials_exception = HTTPException(
@@ -121,14 +310,47 @@ class AuthService:
             
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             user_id: str = payload.get("sub")
-            if user_id is None:
+            issued_at = payload.get("iat")
+            if user_id is None or AuthService.is_revoked(user_id, issued_at):
                 raise credentials_exception
-            
-            # Fetch user from DB to ensure they exist
-            response = supabase_client.from_("users").select("id, national_id").eq("id", user_id).execute()
-            if not response.data:
+
+            cached = _user_cache.get(str(user_id))
+            if cached is None:
+                # Fetch user from DB to ensure they exist and pick up revocations made by other processes
+                response = await remote_call(
+                    "database",
+                    lambda: supabase_client.from_("users").select("id, national_id, tokens_valid_after").eq("id", user_id).execute()
+                )
+                if not response.data:
+                    raise credentials_exception
+                user = dict(response.data[0])
+                cached = (user, _timestamp(user.pop("tokens_valid_after", None)))
+                # The user may have been revoked here while the query was in flight
+                if AuthService.is_revoked(user_id, issued_at):
+                    raise credentials_exception
+                _user_cache.set(str(user_id), cached)
+
+            user, tokens_valid_after = cached
+            if _issued_before(issued_at, tokens_valid_after):
                 raise credentials_exception
-            
-            return response.data[0]
+            bind_user(user.get("national_id"))
+            return dict(user)
         except (jwt.PyJWTError, ValueError):
             raise credentials_exception
+
+
+def _issued_before(issued_at: Optional[float], revoked_at: Optional[float]) -> bool:
+    """Whether a token issued at `issued_at` (unknown: None) is covered by a revocation at `revoked_at`"""
+    return revoked_at is not None and (issued_at is None or issued_at <= revoked_at)
+
+
+def _timestamp(value: Optional[str]) -> Optional[float]:
+    """Epoch seconds of a timestamptz column as returned by Supabase"""
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+async def require_admin(current_user: Dict[str, Any] = Depends(AuthService.get_current_user)) -> Dict[str, Any]:
+    """Dependency for admin-only endpoints; 403 unless the user is in ADMIN_NATIONAL_IDS"""
+    if current_user.get("national_id") not in ADMIN_NATIONAL_IDS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
@@ -3,10 +3,80 @@ FAISS service for Approximate Nearest Neighbor search
 This module provides functionality to find similar mole images using FAISS
 """
 
+import asyncio
+import logging
+import os
+import time
 import faiss
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from .supabase_client import supabase_client as supabase
+from .metrics import registry, Gauge
+from .resilience import remote_call
+
+# Loading every reference embedding is a large query, and the index is shared by
+# all later requests, so it gets its own timeout instead of the request's deadline
+FAISS_LOAD_TIMEOUT_SECONDS = float(os.getenv("FAISS_LOAD_TIMEOUT_SECONDS", "60"))
+
+# Model version assumed for ham_metadata embeddings without an embedding_version;
+# unset assumes the model loaded at startup
+REFERENCE_EMBEDDINGS_VERSION = os.getenv("REFERENCE_EMBEDDINGS_VERSION")
+
+# A stale index (reference embeddings of another model version) is rebuilt in the
+# background when searched, at most this often. Each worker process does this itself.
+FAISS_STALE_RELOAD_SECONDS = float(os.getenv("FAISS_STALE_RELOAD_SECONDS", "30"))
+
+# Neighbours kept per reference image in the precomputed k-NN graph
+KNN_GRAPH_K = int(os.getenv("KNN_GRAPH_K", "9"))
+
+# Storage bucket holding the reference images (case-sensitive)
+REFERENCE_BUCKET = "HAM10000_for_comparison"
+
+logger = logging.getLogger(__name__)
+
+
+def _drop_self_matches(distances: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """From k+1 results per query of a self-search, keep the k that are not the query's own row"""
+    keep = indices != rows[:, None]
+    # With exact duplicates a row may not find itself; it drops its farthest result instead
+    keep[keep.all(axis=1), -1] = False
+    k = indices.shape[1] - 1
+    return distances[keep].reshape(len(rows), k), indices[keep].reshape(len(rows), k)
+
+
+def build_knn_graph(index, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The k nearest other references of every reference in `index`, from one
+    batched self-search. Returns (distances, rows), both of shape (ntotal, k).
+    """
+    vectors = index.reconstruct_n(0, index.ntotal)
+    distances, indices = index.search(vectors, k + 1)
+    return _drop_self_matches(distances, indices, np.arange(index.ntotal))
+
+
+def extend_knn_graph(index, previous_count: int, distances: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Update the graph of the first `previous_count` references of `index` after
+    more were appended. The new references search the whole index, and the
+    existing ones merge their lists with their nearest new references, so the
+    result matches build_knn_graph at a fraction of its cost.
+    """
+    k = indices.shape[1]
+    vectors = index.reconstruct_n(0, index.ntotal)
+    added = vectors[previous_count:]
+
+    added_distances, added_indices = _drop_self_matches(
+        *index.search(added, k + 1), np.arange(previous_count, index.ntotal))
+
+    added_index = faiss.IndexFlatL2(index.d)
+    added_index.add(added)
+    candidate_distances, candidate_indices = added_index.search(vectors[:previous_count], min(k, len(added)))
+    merged_distances = np.hstack([distances, candidate_distances])
+    merged_indices = np.hstack([indices, candidate_indices + previous_count])
+    nearest = np.argsort(merged_distances, axis=1, kind="stable")[:, :k]
+
+    return (np.vstack([np.take_along_axis(merged_distances, nearest, axis=1), added_distances]),
+            np.vstack([np.take_along_axis(merged_indices, nearest, axis=1), added_indices]))
 
 
 class FAISSService:
@@ -14,52 +84,206 @@ class FAISSService:
         self.index = None
         self.image_ids = []
         self.embeddings_loaded = False
+        # Model version of the vectors in the index, and the one assumed for unversioned rows
+        self.embeddings_version = REFERENCE_EMBEDDINGS_VERSION
+        self.legacy_embeddings_version = REFERENCE_EMBEDDINGS_VERSION
+        self.model_version = None
+        # Precomputed k-NN graph: row i holds the nearest other references of image_ids[i]
+        self.neighbour_rows = None
+        self.neighbour_distances = None
+        self._rows: Dict[str, int] = {}
+        self._metadata: Dict[str, dict] = {}
+        self._graph_version = None
+        self._reload_task = None
+        self._last_reload_attempt = float("-inf")
+        # OpenMP threads of index builds (None = OpenMP's default). OpenMP settings are
+        # per thread, so it is applied in the build's own thread; serve.py uses 1 before forking.
+        self.build_threads: Optional[int] = None
+
+    @property
+    def stale(self) -> bool:
+        """True when the reference embeddings came from a different model than the one serving"""
+        return self.model_version is not None and self.embeddings_version != self.model_version
+
+    def set_model_version(self, version: str) -> None:
+        """Record the version of the model producing query embeddings"""
+        if self.legacy_embeddings_version is None:
+            self.legacy_embeddings_version = version
+        if self.embeddings_version is None:
+            self.embeddings_version = version
+        self.model_version = version
+        if self.stale:
+            logger.warning("Reference embeddings are stale; similarity search is disabled until they are recomputed",
+                           extra={"embeddings_version": self.embeddings_version, "model_version": version})
     
+    def reload_if_stale(self) -> None:
+        """
+        Start rebuilding a stale index in the background, at most once per
+        FAISS_STALE_RELOAD_SECONDS, so every worker picks up re-embedded
+        references after a model swap without an admin refresh or a restart.
+        Searches keep skipping similar images until the rebuild finishes.
+        """
+        if not self.stale or (self._reload_task is not None and not self._reload_task.done()):
+            return
+        now = time.monotonic()
+        if now - self._last_reload_attempt < FAISS_STALE_RELOAD_SECONDS:
+            return
+        self._last_reload_attempt = now
+        logger.info("Reference embeddings are stale; rebuilding the FAISS index in the background")
+        self._reload_task = asyncio.get_running_loop().create_task(self._reload_stale())
+
+    async def _reload_stale(self) -> bool:
+        # Cheap probe first: rebuild only once no reference is left on another version, so a
+        # worker never swaps to a partly re-embedded index while reembed_stale.py is running
+        version = self.model_version
+
+        def probe():
+            query = supabase.table("ham_metadata").select("image_id").not_.is_("embedding", "null")
+            if self.legacy_embeddings_version == version:
+                query = query.neq("embedding_version", version)
+            else:
+                query = query.or_(f"embedding_version.is.null,embedding_version.neq.{version}")
+            return query.limit(1).execute()
+
+        try:
+            remaining = await remote_call("database", probe, use_deadline=False)
+        except Exception:
+            logger.exception("Could not check for re-embedded references")
+            return False
+        if remaining.data:
+            return False
+        return await self.load_embeddings()
+
     async def load_embeddings(self) -> bool:
         """
-        Load only embeddings that are not null from the ham_metadata table and build FAISS index
+        Load only embeddings that are not null from the ham_metadata table and build FAISS index.
+        Once the serving model's version is known, only embeddings computed by that version are indexed.
+        A stale index is only replaced once every reference was re-embedded by the serving
+        model; until then the current one is kept and stays stale.
         """
         try:
             # Fetch only records with non-null embeddings from ham_metadata table
-            response = supabase.table("ham_metadata").select("image_id, embedding").not_.is_("embedding", "null").execute()
+            response = await remote_call(
+                "database",
+                lambda: supabase.table("ham_metadata").select(
+                    "image_id, embedding, embedding_version, dx, age, sex, localization"
+                ).not_.is_("embedding", "null").execute(),
+                timeout=FAISS_LOAD_TIMEOUT_SECONDS,
+                use_deadline=False,
+            )
             
             if not response.data:
-                print("No embeddings found in ham_metadata table")
+                logger.warning("No embeddings found in ham_metadata table")
                 return False
             
-            print(f"Found {len(response.data)} records with embeddings in ham_metadata table")
+            logger.info("Found %d records with embeddings in ham_metadata table", len(response.data))
             
             # Extract embeddings and image_ids
             embeddings_list = []
             image_ids_list = []
+            metadata = {}
+            stale_rows = 0
             
             for row in response.data:
+                version = row.get('embedding_version') or self.legacy_embeddings_version
+                if self.model_version is not None and version != self.model_version:
+                    stale_rows += 1
+                    continue
                 if row['embedding'] and len(row['embedding']) > 0:
                     embeddings_list.append(row['embedding'])
                     image_ids_list.append(row['image_id'])
+                    metadata[row['image_id']] = {
+                        "image_id": row['image_id'],
+                        **{column: row.get(column) for column in ("dx", "age", "sex", "localization")},
+                    }
+
+            if stale_rows:
+                if self.stale:
+                    logger.warning("%d references are not re-embedded yet; keeping the stale index", stale_rows,
+                                   extra={"model_version": self.model_version})
+                    return False
+                logger.warning("Skipped %d embeddings computed by another model version", stale_rows,
+                               extra={"model_version": self.model_version})
             
             if not embeddings_list:
-                print("No valid embeddings found")
+                logger.warning("No valid embeddings found")
                 return False
             
             # Convert to numpy array
             embeddings_array = np.array(embeddings_list, dtype=np.float32)
-            
-            # Build FAISS index (using L2 distance)
             dimension = embeddings_array.shape[1]
-            self.index = faiss.IndexFlatL2(dimension)
-            self.index.add(embeddings_array)
-            
+            version = self.model_version or self.embeddings_version
+
+            # The graph's self-search is the slow part, so build off the event loop
+            index, image_ids_list, neighbour_distances, neighbour_rows = await asyncio.to_thread(
+                self._build_index, image_ids_list, embeddings_array, version
+            )
+
+            # Swap everything together so requests never see an index and graph that disagree
+            self.index = index
             self.image_ids = image_ids_list
+            self.neighbour_distances = neighbour_distances
+            self.neighbour_rows = neighbour_rows
+            self._rows = {image_id: row for row, image_id in enumerate(image_ids_list)}
+            self._metadata = metadata
+            self._graph_version = version
             self.embeddings_loaded = True
-            
-            print(f"FAISS index built with {len(embeddings_list)} embeddings of dimension {dimension}")
+            if self.model_version is not None:
+                self.embeddings_version = self.model_version
+
+            logger.info("FAISS index built with %d embeddings of dimension %d", len(embeddings_list), dimension)
             return True
             
-        except Exception as e:
-            print(f"Error loading embeddings: {str(e)}")
+        except Exception:
+            logger.exception("Error loading embeddings")
             return False
     
+    def _extension_order(self, image_ids: List[str], vectors: np.ndarray, version: Optional[str]) -> Optional[np.ndarray]:
+        """
+        If the new references only add to the indexed ones (same model version,
+        every indexed image still present with the same vector), the order that
+        keeps the indexed images first in their current rows; otherwise None.
+        """
+        if (self.index is None or self.neighbour_rows is None or self._graph_version != version
+                or self.neighbour_rows.shape[1] != KNN_GRAPH_K or self.index.d != vectors.shape[1]):
+            return None
+        position = {image_id: i for i, image_id in enumerate(image_ids)}
+        if any(image_id not in position for image_id in self.image_ids):
+            return None
+        kept = np.array([position[image_id] for image_id in self.image_ids], dtype=np.int64)
+        if not np.array_equal(vectors[kept], self.index.reconstruct_n(0, self.index.ntotal)):
+            return None
+        return np.concatenate([kept, np.setdiff1d(np.arange(len(image_ids)), kept)])
+
+    def _build_index(self, image_ids: List[str], vectors: np.ndarray, version: Optional[str]):
+        """
+        Build the L2 index and its k-NN graph. When references were only added
+        since the last build, the graph is extended instead of recomputed.
+        """
+        if self.build_threads is not None:
+            faiss.omp_set_num_threads(self.build_threads)
+        started = time.monotonic()
+        order = self._extension_order(image_ids, vectors, version)
+        if order is not None:
+            vectors = vectors[order]
+            image_ids = [image_ids[i] for i in order]
+
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+
+        if order is None:
+            distances, rows = build_knn_graph(index, min(KNN_GRAPH_K, len(image_ids) - 1))
+            mode = "built"
+        elif len(image_ids) == len(self.image_ids):
+            distances, rows = self.neighbour_distances, self.neighbour_rows
+            mode = "reused"
+        else:
+            distances, rows = extend_knn_graph(index, len(self.image_ids), self.neighbour_distances, self.neighbour_rows)
+            mode = "extended"
+        logger.info("k-NN graph %s in %.2fs", mode, time.monotonic() - started,
+                    extra={"references": len(image_ids), "k": rows.shape[1]})
+        return index, image_ids, distances, rows
+
     async def find_similar_images(self, query_embedding: List[float], k: int = 9) -> List[Tuple[str, float]]:
         """
         Find k most similar images to the query embedding
@@ -97,10 +321,72 @@ class FAISSService:
             
             return results
             
-        except Exception as e:
-            print(f"Error finding similar images: {str(e)}")
+        except Exception:
+            logger.exception("Error finding similar images")
             return []
     
+    async def find_similar_images_batch(self, query_embeddings: List[List[float]], k: int = 9) -> List[List[Tuple[str, float]]]:
+        """
+        Find the k most similar images for each query embedding with one index search
+
+        Args:
+            query_embeddings: The embedding vectors to search for
+            k: Number of similar images to return per query (default: 9)
+
+        Returns:
+            One list of (image_id, distance) tuples per query embedding
+        """
+        try:
+            if not query_embeddings:
+                return []
+
+            # Load embeddings if not already loaded
+            if not self.embeddings_loaded:
+                success = await self.load_embeddings()
+                if not success:
+                    return [[] for _ in query_embeddings]
+
+            query_matrix = np.array(query_embeddings, dtype=np.float32)
+
+            # Ensure k doesn't exceed available data
+            k = min(k, len(self.image_ids))
+
+            distances, indices = self.index.search(query_matrix, k)
+
+            return [
+                [(self.image_ids[idx], float(distance)) for idx, distance in zip(row_indices, row_distances)]
+                for row_indices, row_distances in zip(indices, distances)
+            ]
+
+        except Exception:
+            logger.exception("Error finding similar images in batch")
+            return [[] for _ in query_embeddings]
+
+    def similar_to_reference(self, image_id: str, k: int = KNN_GRAPH_K) -> Optional[List[Tuple[str, float]]]:
+        """
+        The k nearest other references of a reference image, from the
+        precomputed graph. Returns None if `image_id` is not in the index.
+        """
+        row = self._rows.get(image_id)
+        if row is None:
+            return None
+        return [
+            (self.image_ids[neighbour], float(distance))
+            for neighbour, distance in zip(self.neighbour_rows[row, :k], self.neighbour_distances[row, :k])
+        ]
+
+    def reference_metadata(self, image_ids: List[str]) -> List[dict]:
+        """Metadata of indexed references, as get_image_metadata returns it but without a database query"""
+        return [
+            {**self._metadata[image_id], "image_url": self._image_url(image_id)}
+            for image_id in image_ids if image_id in self._metadata
+        ]
+
+    @staticmethod
+    def _image_url(image_id: str) -> str:
+        # Strip potential whitespace from image_id; the Supabase client builds the public URL
+        return supabase.storage.from_(REFERENCE_BUCKET).get_public_url(f"{image_id.strip()}.jpg")
+
     async def get_image_metadata(self, image_ids: List[str]) -> List[dict]:
         """
         Get metadata for the given image IDs
@@ -112,32 +398,27 @@ class FAISSService:
             List of metadata dictionaries with constructed image URLs
         """
         try:
-            response = supabase.table("ham_metadata").select(
+            response = await remote_call("database", lambda: supabase.table("ham_metadata").select(
                 "image_id, dx, age, sex, localization"
-            ).in_("image_id", image_ids).execute()
+            ).in_("image_id", image_ids).execute())
             
             if not response.data:
                 return []
             
-            # Use the correct, case-sensitive bucket name
-            bucket_name = "HAM10000_for_comparison"
-            
             # Add constructed image_url to each metadata entry
             for item in response.data:
-                # Strip potential whitespace from image_id and create the path
-                image_id = item['image_id'].strip()
-                image_path = f"{image_id}.jpg"
-                
-                # Use the Supabase client to get the public URL, which is more robust
-                public_url = supabase.storage.from_(bucket_name).get_public_url(image_path)
-                item['image_url'] = public_url
+                item['image_url'] = self._image_url(item['image_id'])
             
             return response.data
             
-        except Exception as e:
-            print(f"Error getting image metadata: {str(e)}")
+        except Exception:
+            logger.exception("Error getting image metadata")
             return []
 
 
 # Global instance
 faiss_service = FAISSService()
+
+registry.register(Gauge(
+    "dermafast_faiss_index_size", "Number of reference embeddings in the FAISS index",
+    callback=lambda: faiss_service.index.ntotal if faiss_service.index is not None else 0))
@@ -0,0 +1,91 @@
+"""
+Idempotency-Key support for endpoints that clients retry.
+
+A retried request carrying the same key gets the stored result of the first
+one instead of repeating its work, and a retry that arrives while the first
+request is still running waits for it. Keys live in a bounded TTL store in
+this process only.
+"""
+
+import asyncio
+import hashlib
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from fastapi import HTTPException
+
+from .cache import TTLCache
+
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+
+# Longest accepted Idempotency-Key header value
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(*parts) -> str:
+    """Stable digest of the request payload a key was first used with"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, maxsize: int = IDEMPOTENCY_MAX_KEYS, ttl: float = IDEMPOTENCY_TTL_SECONDS):
+        self._completed = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: Dict[Hashable, Tuple[str, asyncio.Future]] = {}
+
+    @staticmethod
+    def _check_fingerprint(stored: str, received: str) -> None:
+        if stored != received:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+    async def run(self, key: Hashable, request_fingerprint: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Return (result, replayed).
+
+        The first call for `key` awaits `compute()` and stores its result;
+        later calls return the stored result with replayed=True. Failures are
+        not stored, so a retry after an error runs again.
+        """
+        stored = self._completed.get(key)
+        if stored is not None:
+            self._check_fingerprint(stored[0], request_fingerprint)
+            return stored[1], True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._check_fingerprint(in_flight[0], request_fingerprint)
+            # shield so a disconnecting duplicate does not cancel the original
+            return await asyncio.shield(in_flight[1]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = (request_fingerprint, future)
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.set_exception(HTTPException(status_code=409, detail="The original request was cancelled, please retry"))
+            future.exception()  # mark retrieved when nobody is waiting
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self._completed.set(key, (request_fingerprint, result))
+            future.set_result(result)
+            return result, False
+        finally:
+            self._in_flight.pop(key, None)
+
+
+def validate_key(idempotency_key: str) -> str:
+    if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+    return idempotency_key
+
+
+# Global instance
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,319 @@
+"""
+Job queue for asynchronous analyses.
+
+POST /api/jobs/analyze stores the upload as a job and returns its ID; an
+inference worker claims the job, runs the analysis pipeline and reports the
+result, which the client fetches by polling (or long-polling) the job.
+
+The broker is a thread-safe in-memory JobBroker. By default it lives in the
+API process and is served by in-process workers. With JOB_BROKER_ADDRESS set,
+the API and the workers (job_worker.py, possibly on other machines) connect to
+a broker hosted by `job_worker.py broker` through multiprocessing.managers, so
+API and inference nodes can be scaled independently.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .metrics import registry, Counter
+
+logger = logging.getLogger(__name__)
+
+# "host:port" of a shared broker; unset runs the broker inside the API process
+JOB_BROKER_ADDRESS = os.getenv("JOB_BROKER_ADDRESS")
+# Shared secret of the broker connection; required whenever a broker is served or used over TCP
+JOB_BROKER_AUTHKEY = os.getenv("JOB_BROKER_AUTHKEY")
+
+# In-process workers started by the API (defaults to none when a shared broker is used)
+JOB_LOCAL_WORKERS = int(os.getenv("JOB_LOCAL_WORKERS", "0" if JOB_BROKER_ADDRESS else "1"))
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# A claimed job whose worker reports nothing for this long is handed to another worker
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+# Finished jobs (and their results) are forgotten after this long
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))
+
+# Longest a GET /api/jobs/{id}?wait= request may block
+MAX_JOB_WAIT_SECONDS = float(os.getenv("MAX_JOB_WAIT_SECONDS", "25"))
+# Long polls held at once by one process; past this, ?wait= requests get the job's current state at once
+MAX_JOB_LONG_POLLS = int(os.getenv("MAX_JOB_LONG_POLLS", "200"))
+# Threads for broker calls, apart from the thread pool shared by Supabase requests. A long poll
+# holds none while it waits, but each worker's claim holds one for up to a second.
+JOB_BROKER_THREADS = int(os.getenv("JOB_BROKER_THREADS", "8"))
+
+# A long poll checks the job after this long, backing off by LONG_POLL_BACKOFF up to LONG_POLL_MAX_INTERVAL
+LONG_POLL_INITIAL_INTERVAL = 0.05
+LONG_POLL_MAX_INTERVAL = 1.0
+LONG_POLL_BACKOFF = 2.0
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+jobs_finished = registry.register(Counter(
+    "dermafast_jobs_finished_total", "Analysis jobs that reached a final state", ["status"]))
+jobs_retried = registry.register(Counter(
+    "dermafast_jobs_retried_total", "Analysis job attempts that failed and were queued again"))
+
+
+class QueueFull(Exception):
+    """Raised by JobBroker.submit when JOB_MAX_QUEUED jobs are already waiting"""
+
+
+class LongPollsFull(Exception):
+    """Raised by wait_for_job when MAX_JOB_LONG_POLLS long polls are already held"""
+
+
+class JobBroker:
+    def __init__(self, max_attempts: int = JOB_MAX_ATTEMPTS, lease_seconds: float = JOB_LEASE_SECONDS,
+                 result_ttl: float = JOB_RESULT_TTL_SECONDS, max_queued: int = JOB_MAX_QUEUED):
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._pending: deque = deque()
+        self._changed = threading.Condition()
+
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in job.items() if key not in ("payload", "lease_expires")}
+
+    def _housekeeping(self, now: float) -> None:
+        """Requeue jobs whose lease ran out and drop finished jobs past their TTL (lock held)"""
+        for job_id, job in list(self._jobs.items()):
+            if job["status"] == RUNNING and job["lease_expires"] <= now:
+                logger.warning("Job lease expired", extra={"job_id": job_id, "attempts": job["attempts"]})
+                self._retry_or_fail(job, "Worker stopped responding")
+            elif job["status"] in (SUCCEEDED, FAILED) and now - job["updated_at"] > self.result_ttl:
+                del self._jobs[job_id]
+
+    def _retry_or_fail(self, job: Dict[str, Any], error: str, retryable: bool = True) -> None:
+        job["error"] = error
+        job["updated_at"] = time.time()
+        if retryable and job["attempts"] < self.max_attempts:
+            job["status"] = QUEUED
+            self._pending.append(job["job_id"])
+            jobs_retried.inc()
+        else:
+            job["status"] = FAILED
+            job["payload"] = None
+            jobs_finished.inc(status=FAILED)
+
+    def submit(self, owner: str, payload: Any) -> str:
+        """Queue a job for `owner` and return its ID. Raises QueueFull."""
+        with self._changed:
+            self._housekeeping(time.time())
+            if len(self._pending) >= self.max_queued:
+                raise QueueFull()
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "owner": owner,
+                "status": QUEUED,
+                "attempts": 0,
+                "created_at": now,
+                "updated_at": now,
+                "result": None,
+                "error": None,
+                "payload": payload,
+                "lease_expires": None,
+            }
+            self._pending.append(job_id)
+            self._changed.notify_all()
+            return job_id
+
+    def claim(self, timeout: float = 1.0) -> Optional[Tuple[str, Any]]:
+        """Take the next queued job as (job_id, payload), waiting up to `timeout` seconds"""
+        end = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                now = time.time()
+                self._housekeeping(now)
+                while self._pending:
+                    job = self._jobs.get(self._pending.popleft())
+                    if job is None or job["status"] != QUEUED:
+                        continue
+                    job["status"] = RUNNING
+                    job["attempts"] += 1
+                    job["lease_expires"] = now + self.lease_seconds
+                    job["updated_at"] = now
+                    self._changed.notify_all()
+                    return job["job_id"], job["payload"]
+                left = end - time.monotonic()
+                if left <= 0:
+                    return None
+                self._changed.wait(min(left, 1.0))
+
+    def complete(self, job_id: str, result: Any) -> None:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING:
+                return
+            job.update(status=SUCCEEDED, result=result, error=None, payload=None, updated_at=time.time())
+            jobs_finished.inc(status=SUCCEEDED)
+            self._changed.notify_all()
+
+    def fail(self, job_id: str, error: str, retryable: bool = True) -> None:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING:
+                return
+            self._retry_or_fail(job, error, retryable)
+            self._changed.notify_all()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job is not None else None
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Like get, but blocks up to `timeout` seconds for the job to finish"""
+        end = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job["status"] in (SUCCEEDED, FAILED):
+                    return self._public(job) if job is not None else None
+                left = end - time.monotonic()
+                if left <= 0:
+                    return self._public(job)
+                self._changed.wait(left)
+
+    def stats(self) -> Dict[str, int]:
+        with self._changed:
+            counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return counts
+
+
+class JobBrokerServer(BaseManager):
+    """Serves a JobBroker over TCP"""
+
+
+class JobBrokerClient(BaseManager):
+    """Connects to a JobBroker served by JobBrokerServer"""
+
+
+JobBrokerClient.register("broker")
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def broker_authkey() -> bytes:
+    """
+    JOB_BROKER_AUTHKEY as bytes. The broker exchanges pickles, so anyone who
+    can connect with the key can run code in the broker and the workers;
+    there is deliberately no default.
+    """
+    if not JOB_BROKER_AUTHKEY:
+        raise RuntimeError("JOB_BROKER_AUTHKEY must be set to serve or connect to a job broker")
+    return JOB_BROKER_AUTHKEY.encode("utf-8")
+
+
+def serve_broker(address: str, broker: Optional[JobBroker] = None) -> None:
+    """Host a JobBroker on `address` ("host:port") until the process is stopped"""
+    authkey = broker_authkey()
+    broker = broker or JobBroker()
+    JobBrokerServer.register("broker", callable=lambda: broker)
+    manager = JobBrokerServer(address=parse_address(address), authkey=authkey)
+    logger.info("Job broker listening", extra={"address": address})
+    manager.get_server().serve_forever()
+
+
+def connect_broker(address: str):
+    """Return a proxy to the JobBroker hosted on `address`"""
+    manager = JobBrokerClient(address=parse_address(address), authkey=broker_authkey())
+    manager.connect()
+    return manager.broker()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The broker used by this process: a shared one if configured, else an in-process JobBroker"""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = connect_broker(JOB_BROKER_ADDRESS) if JOB_BROKER_ADDRESS else JobBroker()
+        return _broker
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_BROKER_THREADS, thread_name_prefix="job-broker")
+_long_polls = 0
+
+
+async def call_broker(fn: Callable, *args):
+    """Run a broker method (local, or a proxy call over TCP) on the broker's own threads"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args))
+
+
+async def wait_for_job(broker, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """
+    Like JobBroker.wait, but sleeps on the event loop between quick broker.get
+    calls, so a held long poll costs no thread. Raises LongPollsFull when
+    MAX_JOB_LONG_POLLS are already held by this process.
+    """
+    global _long_polls
+    if _long_polls >= MAX_JOB_LONG_POLLS:
+        raise LongPollsFull()
+    _long_polls += 1
+    try:
+        end = time.monotonic() + timeout
+        interval = LONG_POLL_INITIAL_INTERVAL
+        while True:
+            job = await call_broker(broker.get, job_id)
+            left = end - time.monotonic()
+            if job is None or job["status"] in (SUCCEEDED, FAILED) or left <= 0:
+                return job
+            await asyncio.sleep(min(interval, left))
+            interval = min(interval * LONG_POLL_BACKOFF, LONG_POLL_MAX_INTERVAL)
+    finally:
+        _long_polls -= 1
+
+
+async def work(broker, process: Callable[[Any], Any], stop: asyncio.Event, poll_seconds: float = 1.0) -> None:
+    """
+    Worker loop: claim jobs from `broker` and run `await process(payload)` on
+    each until `stop` is set. Client errors (4xx) fail the job immediately;
+    anything else is retried up to the broker's max_attempts.
+    """
+    while not stop.is_set():
+        try:
+            claimed = await call_broker(broker.claim, poll_seconds)
+        except Exception:
+            logger.exception("Could not reach the job broker")
+            await asyncio.sleep(poll_seconds)
+            continue
+        if claimed is None:
+            continue
+
+        job_id, payload = claimed
+        logger.info("Processing job", extra={"job_id": job_id})
+        try:
+            result = await process(payload)
+        except HTTPException as e:
+            logger.warning("Job failed: %s", e.detail, extra={"job_id": job_id})
+            await call_broker(broker.fail, job_id, str(e.detail), e.status_code >= 500)
+        except Exception as e:
+            logger.exception("Job failed", extra={"job_id": job_id})
+            await call_broker(broker.fail, job_id, str(e), True)
+        else:
+            await call_broker(broker.complete, job_id, result)
@@ -0,0 +1,207 @@
+"""
+Structured, asynchronous logging for the backend.
+
+Records are pushed onto a bounded in-memory queue and written by a background
+listener thread, so request handlers never block on stdout or log files. Each
+record carries the current request ID and a salted hash of the user's
+national_id, and per-request debug lines can be sampled.
+"""
+
+import atexit
+import contextvars
+import copy
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_FILE = os.getenv("LOG_FILE")  # defaults to stderr
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Fraction of requests whose DEBUG records are emitted (when LOG_LEVEL is DEBUG)
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+# Salt for national_id hashes, so log files never contain raw national IDs
+LOG_HASH_SALT = os.getenv("LOG_HASH_SALT", "dermafast")
+
+# Name of the logger every backend module logs under (its children)
+APP_LOGGER_NAME = __name__.rsplit(".", 1)[0]
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+national_id_hash_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("national_id_hash", default=None)
+debug_sampled_var: contextvars.ContextVar[bool] = contextvars.ContextVar("debug_sampled", default=True)
+
+# Attributes present on every LogRecord; anything else was passed via `extra`
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+
+dropped_records = 0
+
+
+def hash_national_id(national_id: str) -> str:
+    return hashlib.sha256(f"{LOG_HASH_SALT}:{national_id}".encode("utf-8")).hexdigest()[:16]
+
+
+def bind_user(national_id: Optional[str]) -> None:
+    """Attach the (hashed) national_id to every record logged for the current request"""
+    national_id_hash_var.set(hash_national_id(national_id) if national_id else None)
+
+
+class RequestContextFilter(logging.Filter):
+    """Copies the request context onto each record and applies debug sampling"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.national_id_hash = national_id_hash_var.get()
+        if record.levelno <= logging.DEBUG and not debug_sampled_var.get():
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Keep the message and traceback separate so the formatter can structure them
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+def configure_logging() -> None:
+    """
+    Route the backend loggers through a non-blocking queue handler.
+    Safe to call more than once; only the first call has an effect.
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    if LOG_FILE:
+        output = logging.FileHandler(LOG_FILE)
+    else:
+        output = logging.StreamHandler(sys.stderr)
+
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(RequestContextFilter())
+
+    app_logger = logging.getLogger(APP_LOGGER_NAME)
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.addHandler(_queue_handler)
+    app_logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_listener_after_fork() -> None:
+    """
+    A forked worker inherits the queue handler but not the listener thread
+    (and possibly a queue locked mid-put), so give it a fresh queue and listener.
+    """
+    global _listener
+    if _listener is None:
+        return
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware that assigns each request an ID (reusing X-Request-ID when
+    the client sends one), decides whether its debug lines are sampled, and
+    echoes the ID back in the X-Request-ID response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        request_token = request_id_var.set(request_id)
+        user_token = national_id_hash_var.set(None)
+        sampled_token = debug_sampled_var.set(random.random() < LOG_DEBUG_SAMPLE_RATE)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(request_token)
+            national_id_hash_var.reset(user_token)
+            debug_sampled_var.reset(sampled_token)
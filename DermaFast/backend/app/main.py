@@ -1,27 +1,62 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
+import asyncio
+import json
+import logging
+from typing import List, Optional
 import torch
 from PIL import Image
 import io
 import os
 
-from .models import UserRegister, UserLogin, UserResponse, ErrorResponse, TokenResponse, SimilarMoleSelection
-from .auth import AuthService
-from .ml_model import load_model, inference
+from .models import UserRegister, UserLogin, UserResponse, ErrorResponse, TokenResponse, SimilarMoleSelection, QuestionnaireAnswers
+from .auth import AuthService, require_admin
+from .model_registry import ModelRegistry, MODEL_PATH, MODEL_WATCH_INTERVAL_SECONDS
+from .analysis import (
+    run_inference, run_batch_inference, store_cnn_result, store_cnn_results_batch,
+    find_similar_with_metadata, find_similar_with_metadata_batch, analyze_image, combine_with_metadata,
+)
 from .supabase_client import supabase_client as supabase
-from .faiss_service import faiss_service
+from .faiss_service import faiss_service, KNN_GRAPH_K
+from .recommendation import MESSAGES, QUESTIONS, count_yes_answers, recommend_tier
+from .assessments import assessment_store
+from .uploads import BodySizeLimitMiddleware, read_image_upload, MAX_UPLOAD_BYTES, MULTIPART_OVERHEAD_BYTES
+from .logging_config import configure_logging, RequestContextMiddleware
+from .metrics import registry, stage_timer, fallbacks, Gauge, ServerTimingMiddleware
+from . import profiling
+from .idempotency import idempotency_store, fingerprint, validate_key
+from .admission import AdmissionMiddleware
+from .resilience import DeadlineMiddleware, remote_call
+from . import jobs
+import anyio.to_thread
 
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    if jobs.JOB_BROKER_ADDRESS:
+        jobs.broker_authkey()  # fail fast rather than on the first queued job
+    stop_background = asyncio.Event()
+    background_tasks = [
+        asyncio.create_task(jobs.work(jobs.get_broker(), _process_analysis_job, stop_background))
+        for _ in range(jobs.JOB_LOCAL_WORKERS)
+    ]
+    if MODEL_WATCH_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(model_registry.watch(MODEL_WATCH_INTERVAL_SECONDS, stop_background)))
     yield
     # Shutdown
+    stop_background.set()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
 
 app = FastAPI(
     title="DermaFast API", 
@@ -29,6 +64,25 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Maximum number of images accepted by /api/analyze/batch
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "32"))
+
+
+def _max_body_bytes(path: str):
+    """Request body limit for upload endpoints; other endpoints are not limited here"""
+    if path == "/api/analyze/batch":
+        return MAX_BATCH_IMAGES * (MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+    if path.startswith("/api/analyze") or path == "/api/jobs/analyze":
+        return MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+    return None
+
+
+# Reject oversized uploads before their body is read
+app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=_max_body_bytes)
+
+# Shed analyses with 429 while the inference backlog exceeds their wait budget
+app.add_middleware(AdmissionMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -36,11 +90,29 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Server-Timing", "Idempotent-Replayed", "Retry-After"],
 )
 
-# Load the model
-# TODO: Make sure to replace 'model.pth' with the actual path to your model weights file.
-model = load_model()
+# Give every request a deadline that bounds its calls to Supabase
+app.add_middleware(DeadlineMiddleware)
+
+# Record request latency and emit per-stage Server-Timing headers
+app.add_middleware(ServerTimingMiddleware)
+
+# Tag every request (and its log records) with a request ID
+app.add_middleware(RequestContextMiddleware)
+
+# Load the model. Endpoints take model_registry.current() once per request, so a
+# hot reload never switches models in the middle of an analysis.
+model_registry = ModelRegistry(MODEL_PATH)
+
+# Similar images are only meaningful while the reference embeddings match the model
+faiss_service.set_model_version(model_registry.current().version)
+model_registry.on_swap(lambda old, new: faiss_service.set_model_version(new.version))
+
+registry.register(Gauge(
+    "dermafast_threadpool_busy_workers", "Worker threads in use for inference and Supabase calls",
+    callback=lambda: anyio.to_thread.current_default_thread_limiter().borrowed_tokens))
 
 
 @app.get("/health")
@@ -51,8 +123,13 @@ async def health_check():
         "message": "DermaFast API is running successfully"
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics for request and pipeline stage latency"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/register", response_model=UserResponse)
-async def register(user_data: UserRegister):
+async def register(user_data: UserRegister, request: Request):
     """
     Register a new user with national_id and password
     """
@@ -69,6 +146,8 @@ async def register(user_data: UserRegister):
                 status_code=400,
                 detail="Password must be at least 6 characters long"
             )
+
+        AuthService.check_login_admission(user_data.national_id, request.client.host if request.client else None)
         
         # Create user using AuthService
         success = await AuthService.create_user(
@@ -96,7 +175,7 @@ async def register(user_data: UserRegister):
         )
 
 @app.post("/api/login", response_model=TokenResponse)
-async def login(user_data: UserLogin):
+async def login(user_data: UserLogin, request: Request):
     """
     Login user with national_id and password
     """
@@ -107,6 +186,8 @@ async def login(user_data: UserLogin):
                 status_code=400,
                 detail="National ID and password are required"
             )
+
+        AuthService.check_login_admission(user_data.national_id, request.client.host if request.client else None)
         
         # Authenticate user using AuthService
         user_info = await AuthService.authenticate_user(
@@ -131,139 +212,354 @@ async def login(user_data: UserLogin):
         )
         
 @app.post("/api/analyze")
-async def analyze_mole(file: UploadFile = File(...), current_user: dict = Depends(AuthService.get_current_user)):
+async def analyze_mole(
+    response: Response,
+    file: UploadFile = File(...),
+    assessment_id: Optional[str] = Form(None),
+    current_user: dict = Depends(AuthService.get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     Analyze a mole image and store the results with FAISS similarity search.
+
+    The result is recorded in the assessment given by the assessment_id form
+    field (or a new one), whose ID is returned for save_similar_moles.
+
+    A retry carrying the same Idempotency-Key header gets the original result
+    back instead of re-running inference and inserting another row.
     """
     try:
-        print(f"Starting analysis for user: {current_user.get('national_id', 'unknown')}")
+        logger.info("Starting analysis")
         
         # Validate file type
         if not file.content_type or not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        print(f"File type validated: {file.content_type}")
-        
-        # Read image from upload
-        image_bytes = await file.read()
-        print(f"Image read successfully, size: {len(image_bytes)} bytes")
-
-        # Get prediction
-        print("Running CNN inference...")
-        cnn_result, embedding_list = inference(model, image_bytes)
-        print(f"CNN inference completed. Result: {cnn_result}, Embedding dimensions: {len(embedding_list)}")
+        logger.debug("File type validated: %s", file.content_type)
         
+        # Read image from upload, rejecting oversized or non-image payloads early
+        with stage_timer("upload_read"):
+            image_bytes = await read_image_upload(file)
+        logger.debug("Image read successfully", extra={"image_bytes": len(image_bytes)})
+
         # Get national_id from the authenticated user
         national_id = current_user['national_id']
 
-        # Store results in Supabase
-        print("Storing results in Supabase...")
-        insert_response = supabase.table("cnn_results").insert({
-            "national_id": national_id,
-            "cnn_result": float(cnn_result),  # Ensure it's a float
-            "embedding": embedding_list
-        }).execute()
+        async def analyze():
+            loaded = model_registry.current()
+            result = await analyze_image(loaded.model, national_id, image_bytes, loaded.version)
+            result["assessment_id"] = assessment_store.record_analysis(
+                national_id, assessment_id, result["cnn_result"], result["similar_images"]
+            )
+            return result
+
+        if idempotency_key is None:
+            return await analyze()
+
+        result, replayed = await idempotency_store.run(
+            (national_id, "analyze", validate_key(idempotency_key)), fingerprint(image_bytes, assessment_id), analyze
+        )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in analyze_mole")
+        raise HTTPException(status_code=500, detail=f"An error occurred during analysis: {str(e)}")
+
+
+@app.post("/api/analyze/stream")
+async def analyze_mole_stream(file: UploadFile = File(...), assessment_id: Optional[str] = Form(None),
+                              current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    Analyze a mole image, streaming the results as newline-delimited JSON events.
+
+    Events are emitted as each stage finishes:
+      {"event": "classification", ...}  - CNN probability, right after inference
+      {"event": "similar_images", ...}   - nearest reference images with metadata
+      {"event": "complete", ...}         - whether the result was stored in cnn_results,
+                                           and if so the assessment it was recorded in
+    A failing stage emits {"event": "error", "detail": ...} and ends the stream.
+    """
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
 
-        # Check if Supabase returned an error
-        if hasattr(insert_response, 'error') and insert_response.error is not None:
-            print(f"Supabase error: {insert_response.error}")
-            raise HTTPException(status_code=500, detail=f"Failed to store results: {insert_response.error}")
+    # The upload is closed once the endpoint returns, so read it up front
+    with stage_timer("upload_read"):
+        image_bytes = await read_image_upload(file)
+    national_id = current_user['national_id']
 
-        print("Results stored successfully in Supabase")
+    loaded = model_registry.current()
 
-        # Perform FAISS similarity search
-        print("Starting FAISS similarity search...")
-        similar_images_with_metadata = []
+    async def events():
         try:
-            # Check if FAISS service is ready
-            if not faiss_service.embeddings_loaded:
-                print("FAISS embeddings not loaded, attempting to load...")
-                load_success = await faiss_service.load_embeddings()
-                if not load_success:
-                    print("FAISS embeddings could not be loaded - similarity search unavailable")
-                    similar_images_with_metadata = []
-                else:
-                    print("FAISS embeddings loaded successfully")
-            
-            # Only proceed if embeddings are available
-            if faiss_service.embeddings_loaded:
-                similar_images = await faiss_service.find_similar_images(embedding_list, k=9)
-                print(f"Found {len(similar_images)} similar images")
-                
-                if similar_images:
-                    # Get metadata for similar images
-                    similar_image_ids = [img_id for img_id, _ in similar_images]
-                    similar_images_metadata = await faiss_service.get_image_metadata(similar_image_ids)
-                    print(f"Retrieved metadata for {len(similar_images_metadata)} images")
-                    
-                    # Create a mapping of image_id to metadata for easy lookup
-                    metadata_dict = {item['image_id']: item for item in similar_images_metadata}
-                    
-                    # Combine similarity results with metadata
-                    for image_id, distance in similar_images:
-                        metadata = metadata_dict.get(image_id, {})
-                        similar_images_with_metadata.append({
-                            "image_id": image_id,
-                            "distance": distance,
-                            "image_url": metadata.get("image_url", ""),
-                            "diagnosis": metadata.get("dx", "unknown"),
-                            "age": metadata.get("age", None),
-                            "sex": metadata.get("sex", "unknown"),
-                            "localization": metadata.get("localization", "unknown")
-                        })
-                else:
-                    print("No similar images found")
-            else:
-                print("FAISS service not ready - skipping similarity search")
-            
-        except Exception as faiss_error:
-            print(f"FAISS error (continuing without similar images): {str(faiss_error)}")
-            import traceback
-            traceback.print_exc()
-            similar_images_with_metadata = []
-
-        # The inserted row should be available in the `data` attribute
-        if insert_response.data:
-            inserted_data = insert_response.data[0]
-            result = {
-                "message": "Analysis successful",
-                "cnn_result": inserted_data.get("cnn_result"),
-                "embedding_dimensions": len(inserted_data.get("embedding", [])),
-                "similar_images": similar_images_with_metadata
-            }
-            print(f"Analysis complete. Returning result with {len(similar_images_with_metadata)} similar images")
-            return result
+            cnn_result, embedding_list = await run_inference(loaded.model, image_bytes)
+        except Exception as e:
+            logger.exception("Error in analyze_mole_stream")
+            yield _ndjson({"event": "error", "detail": f"An error occurred during analysis: {str(e)}"})
+            return
 
-        # Fallback if no data was returned
-        result = {
-            "message": "Analysis successful but no data returned from DB",
+        yield _ndjson({
+            "event": "classification",
             "cnn_result": float(cnn_result),
             "embedding_dimensions": len(embedding_list),
-            "similar_images": similar_images_with_metadata
+            "model_version": loaded.version
+        })
+
+        # Persist in the background while the similarity search runs
+        store_task = asyncio.create_task(store_cnn_result(national_id, cnn_result, embedding_list, loaded.version))
+
+        similar_images_with_metadata = await find_similar_with_metadata(embedding_list, k=9)
+        yield _ndjson({"event": "similar_images", "similar_images": similar_images_with_metadata})
+
+        try:
+            await store_task
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else f"Failed to store results: {str(e)}"
+            logger.error("Could not store streamed analysis: %s", detail)
+            yield _ndjson({"event": "complete", "stored": False, "message": detail})
+            return
+
+        # Only stored results go into the assessment, so it never disagrees with cnn_results
+        recorded_in = assessment_store.record_analysis(
+            national_id, assessment_id, cnn_result, similar_images_with_metadata
+        )
+        yield _ndjson({"event": "complete", "stored": True, "message": "Analysis successful",
+                       "assessment_id": recorded_in})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.post("/api/analyze/batch")
+async def analyze_mole_batch(files: List[UploadFile] = File(...), current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    Analyze several mole images from one screening session.
+
+    All images go through a single CNN forward pass and a single FAISS search,
+    and their cnn_results rows are written with one insert. Files that are not
+    decodable images get an "error" entry instead of failing the whole batch.
+    """
+    try:
+        if len(files) > MAX_BATCH_IMAGES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IMAGES} images can be analyzed per batch")
+
+        national_id = current_user['national_id']
+        logger.info("Starting batch analysis", extra={"images": len(files)})
+
+        async def read_or_reject(file: UploadFile):
+            if not file.content_type or not file.content_type.startswith('image/'):
+                return None, "File must be an image"
+            try:
+                return await read_image_upload(file), None
+            except HTTPException as e:
+                return None, e.detail
+
+        uploads = await asyncio.gather(*(read_or_reject(file) for file in files))
+        accepted = [image_bytes for image_bytes, _ in uploads if image_bytes is not None]
+
+        loaded = model_registry.current()
+        inference_results = iter(await run_batch_inference(loaded.model, accepted))
+        per_file = [next(inference_results) if image_bytes is not None else None for image_bytes, _ in uploads]
+
+        analyzed = [result for result in per_file if result is not None]
+        await store_cnn_results_batch(national_id, analyzed, loaded.version)
+        similar_per_image = iter(await find_similar_with_metadata_batch([embedding for _, embedding in analyzed], k=9))
+
+        results = []
+        for file, (_, rejection), result in zip(files, uploads, per_file):
+            if result is None:
+                results.append({
+                    "filename": file.filename,
+                    "error": rejection or "Could not decode image"
+                })
+                continue
+
+            cnn_result, embedding_list = result
+            results.append({
+                "filename": file.filename,
+                "cnn_result": float(cnn_result),
+                "embedding_dimensions": len(embedding_list),
+                "similar_images": next(similar_per_image)
+            })
+
+        logger.info("Batch analysis complete", extra={"images": len(files), "analyzed": len(analyzed)})
+        return {
+            "message": "Batch analysis successful",
+            "model_version": loaded.version,
+            "analyzed": len(analyzed),
+            "failed": len(files) - len(analyzed),
+            "results": results
         }
-        print(f"Analysis complete (fallback). Returning result with {len(similar_images_with_metadata)} similar images")
-        return result
-        
+
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error in analyze_mole: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"An error occurred during analysis: {str(e)}")
+        logger.exception("Error in analyze_mole_batch")
+        raise HTTPException(status_code=500, detail=f"An error occurred during batch analysis: {str(e)}")
+
+
+def _ndjson(event: dict) -> bytes:
+    return (json.dumps(event) + "\n").encode("utf-8")
+
+
+async def _process_analysis_job(payload: dict) -> dict:
+    loaded = model_registry.current()
+    return await analyze_image(loaded.model, payload["national_id"], payload["image_bytes"], loaded.version)
+
+
+@app.post("/api/jobs/analyze", status_code=202)
+async def submit_analysis_job(file: UploadFile = File(...), current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    Queue a mole image for analysis and return a job ID right away.
+
+    Fetch the result with GET /api/jobs/{job_id}; it has the same body as
+    /api/analyze once the job has succeeded.
+    """
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+
+    with stage_timer("upload_read"):
+        image_bytes = await read_image_upload(file)
+    national_id = current_user['national_id']
+
+    try:
+        job_id = await jobs.call_broker(
+            jobs.get_broker().submit, national_id, {"national_id": national_id, "image_bytes": image_bytes}
+        )
+    except jobs.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many queued analyses, please retry shortly",
+                            headers={"Retry-After": "5"})
+
+    logger.info("Queued analysis job", extra={"job_id": job_id})
+    return {"job_id": job_id, "status": jobs.QUEUED}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_analysis_job(job_id: str, wait: float = 0.0, current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    Return the status of an analysis job, and its result once it has succeeded.
+
+    With ?wait=N the request is held for up to N seconds (at most
+    MAX_JOB_WAIT_SECONDS) until the job finishes (long polling). When too many
+    long polls are already held, an unfinished job is returned at once with
+    202 and Retry-After.
+    """
+    broker = jobs.get_broker()
+    wait = min(max(wait, 0.0), jobs.MAX_JOB_WAIT_SECONDS)
+    busy = False
+    if wait > 0:
+        try:
+            job = await jobs.wait_for_job(broker, job_id, wait)
+        except jobs.LongPollsFull:
+            busy = True
+            job = await jobs.call_broker(broker.get, job_id)
+    else:
+        job = await jobs.call_broker(broker.get, job_id)
+
+    # Other users' jobs are reported as missing rather than forbidden
+    if job is None or job.pop("owner") != current_user['national_id']:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if busy and job["status"] not in (jobs.SUCCEEDED, jobs.FAILED):
+        return JSONResponse(status_code=202, content=job, headers={"Retry-After": "1"})
+    return job
+
+
+@app.get("/api/references/{image_id}/similar")
+async def similar_references(image_id: str, k: int = KNN_GRAPH_K, current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    The reference images most similar to a reference image, for browsing from
+    one of the similar images an analysis returned. Served from the k-NN graph
+    precomputed with the FAISS index, with metadata from the same snapshot, so
+    no search or database query is made.
+    """
+    if not 1 <= k <= KNN_GRAPH_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {KNN_GRAPH_K}")
+
+    if faiss_service.stale:
+        faiss_service.reload_if_stale()
+        fallbacks.inc(reason="faiss_stale")
+        return {"image_id": image_id, "similar_images": []}
+
+    if not faiss_service.embeddings_loaded:
+        with stage_timer("faiss_load"):
+            if not await faiss_service.load_embeddings():
+                fallbacks.inc(reason="faiss_unavailable")
+                return {"image_id": image_id, "similar_images": []}
+
+    similar = faiss_service.similar_to_reference(image_id, k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Reference image not found")
+
+    metadata = faiss_service.reference_metadata([neighbour for neighbour, _ in similar])
+    return {"image_id": image_id, "similar_images": combine_with_metadata(similar, metadata)}
+
+
+@app.post("/api/questionnaire")
+async def submit_questionnaire(answers: QuestionnaireAnswers, current_user: dict = Depends(AuthService.get_current_user)):
+    """
+    Save the user's questionnaire answers and record them in their assessment
+    (the given assessment_id, or a new one whose ID is returned).
+    """
+    try:
+        national_id = current_user['national_id']
+        record = {"national_id": national_id, **{question: getattr(answers, question) for question in QUESTIONS}}
+
+        with stage_timer("db_insert_questionnaire"):
+            insert_response = await remote_call("database", lambda: supabase.table("mole_questionnaires").insert(record).execute())
+
+        if hasattr(insert_response, 'error') and insert_response.error:
+            raise HTTPException(status_code=500, detail=f"Failed to save questionnaire: {insert_response.error}")
+
+        assessment_id = assessment_store.record_answers(
+            national_id, answers.assessment_id, {question: record[question] for question in QUESTIONS}
+        )
+        return {"message": "Questionnaire saved successfully", "assessment_id": assessment_id}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in submit_questionnaire")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
 
 @app.post("/api/save_similar_moles")
 async def save_similar_moles(
     selection: SimilarMoleSelection,
-    current_user: dict = Depends(AuthService.get_current_user)
+    response: Response,
+    current_user: dict = Depends(AuthService.get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
     """
     Save the user's selection of similar moles and return a recommendation.
+
+    Inputs held by the assessment named in the request are taken from memory;
+    the rest are read from the database.
+
+    A retry carrying the same Idempotency-Key header gets the original
+    recommendation back without inserting the selection again.
     """
+    national_id = current_user['national_id']
+
+    if idempotency_key is None:
+        return await _save_similar_moles(national_id, selection.selected_ids, selection.assessment_id)
+
+    result, replayed = await idempotency_store.run(
+        (national_id, "save_similar_moles", validate_key(idempotency_key)),
+        fingerprint(selection.selected_ids, selection.assessment_id),
+        lambda: _save_similar_moles(national_id, selection.selected_ids, selection.assessment_id),
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _save_similar_moles(national_id: str, selected_ids: List[str], assessment_id: Optional[str] = None) -> dict:
     try:
-        national_id = current_user['national_id']
-        selected_ids = selection.selected_ids
+        assessment = assessment_store.get(national_id, assessment_id)
+        if assessment_id and assessment is None:
+            fallbacks.inc(reason="assessment_not_found")
 
         # Pad the list with None if fewer than 3 images were selected
         image_ids = selected_ids + [None] * (3 - len(selected_ids))
@@ -277,7 +573,8 @@ async def save_similar_moles(
         }
 
         # Insert into Supabase
-        insert_response = supabase.table("similar_moles_ann_user").insert(record).execute()
+        with stage_timer("db_insert_selection"):
+            insert_response = await remote_call("database", lambda: supabase.table("similar_moles_ann_user").insert(record).execute())
 
         if hasattr(insert_response, 'error') and insert_response.error:
             raise HTTPException(status_code=500, detail=f"Failed to save selection: {insert_response.error}")
@@ -285,60 +582,54 @@ async def save_similar_moles(
         # --- Recommendation Logic ---
 
         # 1. Get latest CNN result
-        cnn_response = supabase.table("cnn_results").select("cnn_result").eq("national_id", national_id).order("timestamp", desc=True).limit(1).execute()
-        latest_cnn_result = cnn_response.data[0]['cnn_result'] if cnn_response.data else None
+        if assessment is not None and assessment.cnn_result is not None:
+            latest_cnn_result = assessment.cnn_result
+        else:
+            with stage_timer("db_latest_cnn_result"):
+                cnn_response = await remote_call(
+                    "database",
+                    lambda: supabase.table("cnn_results").select("cnn_result").eq("national_id", national_id).order("timestamp", desc=True).limit(1).execute()
+                )
+            latest_cnn_result = cnn_response.data[0]['cnn_result'] if cnn_response.data else None
 
         # 2. Get latest questionnaire answers
-        questionnaire_response = supabase.table("mole_questionnaires").select("q1, q2, q3, q4, q5").eq("national_id", national_id).order("timestamp", desc=True).limit(1).execute()
-        yes_answers = 0
-        if questionnaire_response.data:
-            answers = questionnaire_response.data[0]
-            yes_answers = sum(1 for q in ['q1', 'q2', 'q3', 'q4', 'q5'] if answers.get(q) is True)
+        if assessment is not None and assessment.answers is not None:
+            yes_answers = count_yes_answers(assessment.answers)
+        else:
+            with stage_timer("db_latest_questionnaire"):
+                questionnaire_response = await remote_call(
+                    "database",
+                    lambda: supabase.table("mole_questionnaires").select("q1, q2, q3, q4, q5").eq("national_id", national_id).order("timestamp", desc=True).limit(1).execute()
+                )
+            yes_answers = count_yes_answers(questionnaire_response.data[0]) if questionnaire_response.data else 0
 
         # 3. Check diagnosis of selected similar moles
-        has_melanoma_selection = False
-        if selected_ids:
-            metadata_response = supabase.table("ham_metadata").select("dx").in_("image_id", selected_ids).eq("dx", "mel").execute()
-            if metadata_response.data:
-                has_melanoma_selection = True
+        has_melanoma_selection = assessment.has_melanoma_selection(selected_ids) if assessment is not None else None
+        if has_melanoma_selection is None:
+            has_melanoma_selection = False
+            if selected_ids:
+                with stage_timer("db_melanoma_check"):
+                    metadata_response = await remote_call(
+                        "database",
+                        lambda: supabase.table("ham_metadata").select("dx").in_("image_id", selected_ids).eq("dx", "mel").execute()
+                    )
+                if metadata_response.data:
+                    has_melanoma_selection = True
 
         # --- Determine Recommendation ---
-        
-        plastic_surgeon_msg = "According to the data you have provided to DermaFast, we highly recommend you schedule a meeting with a plastic surgeon as soon as possible."
-        dermatologist_msg = "According to the data you have provided to DermaFast, we highly recommend you schedule a meeting with a dermatologist."
-        monitoring_msg = "According to the data you have provided to DermaFast, we highly recommend you continue monitoring your moles and beauty marks, and visit a dermatologist at least once a year."
-
-        recommendation_message = ""
+        recommendation_message = MESSAGES[recommend_tier(latest_cnn_result, yes_answers, has_melanoma_selection)]
 
-        # Condition for Plastic Surgeon
-        is_plastic_surgeon_case = (
-            (latest_cnn_result is not None and latest_cnn_result >= 0.3) or
-            (yes_answers >= 2) or
-            has_melanoma_selection
-        )
-
-        if is_plastic_surgeon_case:
-            recommendation_message = plastic_surgeon_msg
-        else:
-            # Condition for Dermatologist
-            is_dermatologist_case = (
-                (latest_cnn_result is not None and 0.15 < latest_cnn_result < 0.3) or
-                (yes_answers == 1)
-            )
-            if is_dermatologist_case:
-                recommendation_message = dermatologist_msg
-            else:
-                recommendation_message = monitoring_msg
-        
         # --- Store Recommendation in the new table ---
         try:
-            supabase.table("final_recommendation").insert({
-                "national_id": national_id,
-                "recommendation": recommendation_message
-            }).execute()
-        except Exception as e:
+            with stage_timer("db_insert_recommendation"):
+                await remote_call("database", lambda: supabase.table("final_recommendation").insert({
+                    "national_id": national_id,
+                    "recommendation": recommendation_message
+                }).execute())
+        except Exception:
             # Log the error but don't fail the request
-            print(f"Could not save recommendation to 'final_recommendation' table: {e}")
+            logger.exception("Could not save recommendation to 'final_recommendation' table")
+            fallbacks.inc(reason="recommendation_not_saved")
 
         return {
             "message": "Selection saved successfully",
@@ -348,8 +639,115 @@ async def save_similar_moles(
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in save_similar_moles")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+
+@app.get("/admin/profile/cpu")
+async def profile_cpu(seconds: float = 10.0, format: str = "collapsed", admin: dict = Depends(require_admin)):
+    """
+    Sample this worker's CPU stacks for `seconds` and return them as
+    collapsed stacks (format=collapsed) or a speedscope file (format=speedscope).
+    """
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'speedscope'")
+
+    try:
+        # Sampling runs in a worker thread so the event loop keeps serving (and is sampled)
+        profile = await run_in_threadpool(profiling.sample_cpu, seconds)
+    except profiling.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    logger.info("CPU profile collected", extra={"seconds": profile["duration"]})
+    if format == "speedscope":
+        return profiling.to_speedscope(profile)
+    return PlainTextResponse(profiling.to_collapsed(profile))
+
+@app.post("/admin/profile/memory/start")
+async def profile_memory_start(frames: int = 10, admin: dict = Depends(require_admin)):
+    """Start tracemalloc allocation tracing in this worker"""
+    started = profiling.start_tracemalloc(frames)
+    return {"tracing": True, "started": started}
+
+@app.get("/admin/profile/memory/snapshot")
+async def profile_memory_snapshot(limit: int = 20, admin: dict = Depends(require_admin)):
+    """Top allocation sites since tracing started"""
+    top = await run_in_threadpool(profiling.tracemalloc_top, limit)
+    if top is None:
+        raise HTTPException(status_code=409, detail="tracemalloc is not running; POST /admin/profile/memory/start first")
+    return top
+
+@app.post("/admin/profile/memory/stop")
+async def profile_memory_stop(admin: dict = Depends(require_admin)):
+    """Stop tracemalloc and release its trace data"""
+    return {"tracing": False, "stopped": profiling.stop_tracemalloc()}
+
+@app.get("/admin/profile/resources")
+async def profile_resources(admin: dict = Depends(require_admin)):
+    """Worker RSS with torch and FAISS memory breakdown"""
+    return profiling.memory_breakdown(model=model_registry.current().model, index=faiss_service.index)
+
+
+@app.get("/admin/model")
+async def model_info(admin: dict = Depends(require_admin)):
+    """Version of the model serving new requests and whether the FAISS references match it"""
+    loaded = model_registry.current()
+    return {
+        "version": loaded.version,
+        "path": loaded.path,
+        "loaded_at": loaded.loaded_at,
+        "reference_embeddings_version": faiss_service.embeddings_version,
+        "reference_embeddings_stale": faiss_service.stale,
+    }
+
+@app.post("/admin/faiss/refresh")
+async def refresh_faiss_index(admin: dict = Depends(require_admin)):
+    """
+    Rebuild the FAISS index and its k-NN graph from ham_metadata, e.g. after
+    reference embeddings were recomputed or added
+    """
+    loaded = await faiss_service.load_embeddings()
+    return {
+        "loaded": loaded,
+        "vectors": faiss_service.index.ntotal if faiss_service.index is not None else 0,
+        "graph_neighbours": faiss_service.neighbour_rows.shape[1] if faiss_service.neighbour_rows is not None else 0,
+        "embeddings_version": faiss_service.embeddings_version,
+        "stale": faiss_service.stale,
+    }
+
+@app.post("/admin/model/reload")
+async def reload_model(force: bool = False, admin: dict = Depends(require_admin)):
+    """
+    Load the weights file again and swap it in without dropping requests.
+    Unchanged weights are not reloaded unless force=true.
+    """
+    try:
+        return await model_registry.reload_async(force)
+    except Exception as e:
+        logger.exception("Model reload failed")
+        raise HTTPException(status_code=500, detail=f"Model reload failed, keeping version {model_registry.current().version}: {str(e)}")
+
+
+
+@app.delete("/admin/users/{national_id}")
+async def delete_user(national_id: str, admin: dict = Depends(require_admin)):
+    """Delete a user and reject the tokens already issued to them"""
+    if not await AuthService.delete_user(national_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"deleted": national_id}
+
+
+@app.post("/admin/users/{national_id}/revoke")
+async def revoke_user_sessions(national_id: str, admin: dict = Depends(require_admin)):
+    """Reject every token issued to a user so far (e.g. a leaked token); they can sign in again"""
+    try:
+        if not await AuthService.revoke_sessions(national_id):
+            raise HTTPException(status_code=404, detail="User not found")
+        return {"revoked": national_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in revoke_user_sessions")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
 
@@ -362,9 +760,14 @@ async def root():
         "docs": "/docs",
         "endpoints": {
             "health": "/health",
+            "metrics": "/metrics",
             "register": "/api/register",
             "login": "/api/login",
-            "analyze": "/api/analyze"
+            "analyze": "/api/analyze",
+            "analyze_stream": "/api/analyze/stream",
+            "analyze_batch": "/api/analyze/batch",
+            "analyze_job": "/api/jobs/analyze",
+            "job_status": "/api/jobs/{job_id}"
         }
     }
 
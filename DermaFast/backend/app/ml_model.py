@@ -3,9 +3,16 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import io
+import logging
 import os
 
+from .metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
 # Image transformation
 val_transform = transforms.Compose([
     transforms.Resize((256, 256)),
@@ -13,6 +20,10 @@ val_transform = transforms.Compose([
     transforms.Normalize([0.5]*3, [0.5]*3)
 ])
 
+# Pool used to decode the images of a batch in parallel (PIL releases the GIL while decoding)
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "4"))
+_decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="image-decode")
+
 # CNN Model Definition
 class BasicCNN(nn.Module):
     def __init__(self):
@@ -52,42 +63,58 @@ class BasicCNN(nn.Module):
         
         return classification, embedding
 
-def load_model():
+def default_model_path() -> str:
+    """
+    Path of the bundled model weights (backend/app/ml_model/model_weights.pkl).
+    Raises FileNotFoundError if they are missing.
+    """
+    # Get the absolute path to the directory of the current script
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    # Construct the absolute path to the model weights, assuming the script is in backend/app/
+    model_path = os.path.join(script_dir, 'ml_model', 'model_weights.pkl')
+
+    # Check if the file exists before attempting to load
+    if not os.path.exists(model_path):
+        # Fallback for when script is run from a different structure, e.g. tests
+        app_dir = os.path.join(os.path.dirname(script_dir), "app")
+        model_path = os.path.join(app_dir, 'ml_model', 'model_weights.pkl')
+        logger.info("Fallback: Loading model from: %s", model_path)
+        if not os.path.exists(model_path):
+             raise FileNotFoundError(f"Model file not found at: {model_path}")
+    return model_path
+
+def load_model(model_path: Optional[str] = None):
     """
-    Load the pre-trained model from the specified path.
+    Load the pre-trained model from `model_path` (default: the bundled weights).
     """
     try:
-        # Get the absolute path to the directory of the current script
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # Construct the absolute path to the model weights, assuming the script is in backend/app/
-        model_path = os.path.join(script_dir, 'ml_model', 'model_weights.pkl')
-        
-        print(f"Loading model from: {model_path}")
+        if model_path is None:
+            model_path = default_model_path()
 
-        # Check if the file exists before attempting to load
-        if not os.path.exists(model_path):
-            # Fallback for when script is run from a different structure, e.g. tests
-            app_dir = os.path.join(os.path.dirname(script_dir), "app")
-            model_path = os.path.join(app_dir, 'ml_model', 'model_weights.pkl')
-            print(f"Fallback: Loading model from: {model_path}")
-            if not os.path.exists(model_path):
-                 raise FileNotFoundError(f"Model file not found at: {model_path}")
+        logger.info("Loading model from: %s", model_path)
 
         model = BasicCNN()
         # The state dict is loaded from a pickled file, not directly from .pth
         model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
         model.eval()  # Set the model to evaluation mode
-        print("Model loaded successfully.")
+        logger.info("Model loaded successfully.")
         return model
     except FileNotFoundError as e:
-        print(f"Error loading model from {model_path}: {e}")
+        logger.error("Error loading model from %s: %s", model_path, e)
         raise e
     except Exception as e:
         # General exception for other potential errors (e.g., torch issues)
-        print(f"An unexpected error occurred while loading the model: {e}")
+        logger.exception("An unexpected error occurred while loading the model")
         raise e
 
+def preprocess(image_bytes: bytes) -> torch.Tensor:
+    """
+    Decode raw image bytes into a normalized (3, 256, 256) tensor.
+    """
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    return val_transform(image)
+
 def inference(model: nn.Module, image_bytes: bytes):
     """
     Perform inference on a mole image.
@@ -103,17 +130,55 @@ def inference(model: nn.Module, image_bytes: bytes):
     As the results are stored in the database, we'll be able to adjust the results later.
     """
     try:
-        # Load and convert image
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        
-        # Transform image
-        image_tensor = val_transform(image).unsqueeze(0)
+        # Load, convert and transform image
+        with stage_timer("decode"):
+            image_tensor = preprocess(image_bytes).unsqueeze(0)
 
-        with torch.no_grad():
+        with stage_timer("inference"), torch.no_grad():
             classification, embedding = model(image_tensor)
             
         return classification.item(), embedding.numpy().flatten().tolist()
         
     except Exception as e:
-        print(f"Error in inference: {str(e)}")
+        logger.warning("Error in inference: %s", e)
         raise e
+
+def inference_batch(model: nn.Module, images: List[bytes]) -> List[Optional[Tuple[float, List[float]]]]:
+    """
+    Perform inference on several mole images with a single forward pass.
+
+    Images are decoded in parallel. An image that cannot be decoded yields None
+    in its position instead of failing the whole batch.
+
+    Args:
+        model: The loaded BasicCNN model
+        images: Raw image data for each image
+
+    Returns:
+        List aligned with `images` of (classification_probability, embedding_list) or None
+    """
+    def safe_preprocess(image_bytes):
+        try:
+            return preprocess(image_bytes)
+        except Exception as e:
+            logger.warning("Could not decode image in batch: %s", e)
+            return None
+
+    with stage_timer("decode_batch"):
+        tensors = list(_decode_executor.map(safe_preprocess, images))
+    valid_positions = [i for i, tensor in enumerate(tensors) if tensor is not None]
+
+    results: List[Optional[Tuple[float, List[float]]]] = [None] * len(images)
+    if not valid_positions:
+        return results
+
+    batch = torch.stack([tensors[i] for i in valid_positions])
+    with stage_timer("inference_batch"), torch.no_grad():
+        classifications, embeddings = model(batch)
+
+    classifications = classifications.view(-1).tolist()
+    embeddings = embeddings.numpy()
+    for row, position in enumerate(valid_positions):
+        results[position] = (classifications[row], embeddings[row].tolist())
+
+    return results
@@ -0,0 +1,144 @@
+"""
+Versioned CNN weights with hot reload.
+
+The registry holds the model currently used for new requests. A reload loads
+and warms up the new weights off the event loop and then swaps a single
+reference, so requests that already picked up the old model finish on it.
+A model's version is the prefix of the sha256 of its weights file.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from starlette.concurrency import run_in_threadpool
+
+from .ml_model import load_model, default_model_path
+
+logger = logging.getLogger(__name__)
+
+# Weights file to load and watch (default: the bundled weights)
+MODEL_PATH = os.getenv("MODEL_PATH")
+
+# Poll the weights file for changes this often and reload when it changes (0 = disabled)
+MODEL_WATCH_INTERVAL_SECONDS = float(os.getenv("MODEL_WATCH_INTERVAL_SECONDS", "0"))
+
+VERSION_LENGTH = 12
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    model: nn.Module
+    version: str
+    path: str
+    loaded_at: float
+
+
+def weights_version(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as weights:
+        for chunk in iter(lambda: weights.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:VERSION_LENGTH]
+
+
+def _warm_up(model: nn.Module) -> None:
+    """Run one forward pass so the first real request doesn't pay for lazy initialization"""
+    with torch.no_grad():
+        model(torch.zeros(1, 3, 256, 256))
+
+
+class ModelRegistry:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_model_path()
+        self._reload_lock = threading.Lock()
+        self._listeners: List[Callable[[LoadedModel, LoadedModel], None]] = []
+        self._current = self._load(self.path)
+
+    @staticmethod
+    def _load(path: str) -> LoadedModel:
+        version = weights_version(path)
+        model = load_model(path)
+        return LoadedModel(model=model, version=version, path=path, loaded_at=time.time())
+
+    def current(self) -> LoadedModel:
+        """The model for new work; hold on to the returned object for the whole request"""
+        return self._current
+
+    def on_swap(self, listener: Callable[[LoadedModel, LoadedModel], None]) -> None:
+        """Call listener(old, new) after each swap to a different version"""
+        self._listeners.append(listener)
+
+    def reload(self, force: bool = False) -> Dict[str, object]:
+        """
+        Load, warm up and swap in the weights at self.path. Blocking; the
+        current model keeps serving until the swap, and stays if loading fails.
+        """
+        with self._reload_lock:
+            previous = self._current
+            version = weights_version(self.path)
+            if version == previous.version and not force:
+                return {"reloaded": False, "version": version, "previous_version": previous.version}
+
+            started = time.perf_counter()
+            loaded = self._load(self.path)
+            _warm_up(loaded.model)
+            self._current = loaded
+
+            logger.info("Model swapped", extra={
+                "model_version": loaded.version,
+                "previous_version": previous.version,
+                "load_seconds": round(time.perf_counter() - started, 3),
+            })
+            if loaded.version != previous.version:
+                for listener in self._listeners:
+                    try:
+                        listener(previous, loaded)
+                    except Exception:
+                        logger.exception("Model swap listener failed")
+
+            return {"reloaded": True, "version": loaded.version, "previous_version": previous.version}
+
+    async def reload_async(self, force: bool = False) -> Dict[str, object]:
+        return await run_in_threadpool(self.reload, force)
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def watch(self, interval: float, stop: asyncio.Event) -> None:
+        """Reload whenever the weights file changes, until `stop` is set"""
+        signature = self._file_signature()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+            current = self._file_signature()
+            if current is None or current == signature:
+                continue
+
+            # Wait for a writer to finish: reload only once the file stops changing
+            await asyncio.sleep(interval)
+            if self._file_signature() != current:
+                continue
+            signature = current
+
+            try:
+                result = await self.reload_async()
+                if result["reloaded"]:
+                    logger.info("Reloaded model after weights file changed", extra={"model_version": result["version"]})
+            except Exception:
+                logger.exception("Could not reload changed weights; keeping the current model")
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 
 class UserRegister(BaseModel):
     national_id: str
@@ -30,3 +30,12 @@ class MoleAnalysisRequest(BaseModel):
 
 class SimilarMoleSelection(BaseModel):
     selected_ids: List[str] = Field(..., max_items=3)
+    assessment_id: Optional[str] = None
+
+class QuestionnaireAnswers(BaseModel):
+    q1: bool
+    q2: bool
+    q3: bool
+    q4: bool
+    q5: bool
+    assessment_id: Optional[str] = None
@@ -0,0 +1,195 @@
+"""
+On-demand profiling of a live worker.
+
+Nothing here runs until an admin asks for it: the CPU profiler is a
+time-boxed sampling thread and tracemalloc is only started on request, so the
+overhead is zero while profiling is off.
+"""
+
+import collections
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+import torch
+
+# Upper bound on a single CPU profile, so a forgotten request cannot run forever
+MAX_PROFILE_SECONDS = float(os.getenv("MAX_PROFILE_SECONDS", "60"))
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when a CPU profile is requested while another one is running"""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def _stack(frame) -> List[str]:
+    """Return the stack as labels ordered from the root frame to the leaf"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def sample_cpu(duration: float, interval: float = 0.005) -> Dict[str, Any]:
+    """
+    Sample the stacks of every thread in this process for `duration` seconds.
+
+    Returns {"samples": Counter of stack tuples, "interval": ..., "duration": ...}.
+    Raises ProfilerBusy if another profile is already running.
+    """
+    duration = min(max(duration, interval), MAX_PROFILE_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A CPU profile is already running")
+
+    try:
+        own_thread = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        samples: collections.Counter = collections.Counter()
+
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                thread_name = thread_names.get(thread_id) or f"thread-{thread_id}"
+                samples[(thread_name,) + tuple(_stack(frame))] += 1
+            time.sleep(interval)
+
+        return {"samples": samples, "interval": interval, "duration": duration}
+    finally:
+        _profile_lock.release()
+
+
+def to_collapsed(profile: Dict[str, Any]) -> str:
+    """Render a CPU profile in the collapsed-stack format used by flame graph tools"""
+    lines = [f"{';'.join(stack)} {count}" for stack, count in profile["samples"].most_common()]
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Render a CPU profile as a speedscope file (one sampled profile per thread)"""
+    frames: List[Dict[str, str]] = []
+    frame_index: Dict[str, int] = {}
+
+    def index_of(label: str) -> int:
+        if label not in frame_index:
+            frame_index[label] = len(frames)
+            frames.append({"name": label})
+        return frame_index[label]
+
+    by_thread: Dict[str, Dict[str, list]] = collections.defaultdict(lambda: {"samples": [], "weights": []})
+    for stack, count in profile["samples"].items():
+        thread_name, labels = stack[0], stack[1:]
+        by_thread[thread_name]["samples"].append([index_of(label) for label in labels])
+        by_thread[thread_name]["weights"].append(count * profile["interval"])
+
+    profiles = []
+    for thread_name, data in sorted(by_thread.items()):
+        profiles.append({
+            "type": "sampled",
+            "name": thread_name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(data["weights"]),
+            "samples": data["samples"],
+            "weights": data["weights"],
+        })
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"DermaFast worker {os.getpid()}",
+        "shared": {"frames": frames},
+        "profiles": profiles,
+    }
+
+
+def start_tracemalloc(frames: int = 10) -> bool:
+    """Start tracing allocations. Returns False if tracing was already on."""
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracemalloc() -> bool:
+    """Stop tracing allocations and free the trace data. Returns False if it was off."""
+    if not tracemalloc.is_tracing():
+        return False
+    tracemalloc.stop()
+    return True
+
+
+def tracemalloc_top(limit: int = 20, key_type: str = "lineno") -> Optional[Dict[str, Any]]:
+    """Return the top allocation sites of a fresh snapshot, or None if tracing is off"""
+    if not tracemalloc.is_tracing():
+        return None
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics(key_type)
+    current, peak = tracemalloc.get_traced_memory()
+
+    return {
+        "traced_bytes": current,
+        "peak_traced_bytes": peak,
+        "top": [
+            {
+                "site": str(stat.traceback[0]) if stat.traceback else "unknown",
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in stats[:limit]
+        ],
+    }
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_breakdown(model: Optional[torch.nn.Module] = None, index=None) -> Dict[str, Any]:
+    """Report this worker's RSS alongside the memory held by the model and FAISS index"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+    report: Dict[str, Any] = {
+        "pid": os.getpid(),
+        "rss_bytes": _rss_bytes(),
+        "max_rss_bytes": max_rss,
+        "torch_num_threads": torch.get_num_threads(),
+        "tracemalloc_active": tracemalloc.is_tracing(),
+    }
+
+    if model is not None:
+        report["model_parameter_bytes"] = sum(p.numel() * p.element_size() for p in model.parameters())
+        report["model_buffer_bytes"] = sum(b.numel() * b.element_size() for b in model.buffers())
+
+    if index is not None:
+        report["faiss_vectors"] = index.ntotal
+        report["faiss_dimension"] = index.d
+        # Flat indexes store every vector as float32
+        report["faiss_vector_bytes"] = index.ntotal * index.d * 4
+
+    return report
@@ -0,0 +1,81 @@
+"""
+Sliding-window rate limiting for admission control on expensive endpoints
+"""
+
+import time
+from collections import deque
+from typing import Hashable, Optional
+
+from .cache import TTLCache
+
+
+class SlidingWindowLimiter:
+    """
+    Allow at most `limit` hits per key within any `window` seconds.
+
+    Keys are held in bounded TTL caches, so idle keys are forgotten after one
+    window and at most `max_keys` keys under their limit (and as many at it)
+    are tracked. Keys at their limit are kept apart, so a flood of new keys
+    cannot evict them and lift their limit early.
+    """
+
+    def __init__(self, limit: int, window: float, max_keys: int = 10000):
+        self.limit = limit
+        self.window = window
+        self._hits = TTLCache(maxsize=max_keys, ttl=window)
+        self._limited = TTLCache(maxsize=max_keys, ttl=window)
+
+    def _window(self, key: Hashable, now: float) -> deque:
+        hits = self._limited.get(key)
+        if hits is None:
+            hits = self._hits.get(key)
+        if hits is None:
+            hits = deque()
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        return hits
+
+    def _store(self, key: Hashable, hits: deque) -> None:
+        if len(hits) >= self.limit:
+            self._limited.set(key, hits)
+            self._hits.pop(key)
+        else:
+            self._hits.set(key, hits)
+            self._limited.pop(key)
+
+    def check(self, key: Hashable) -> Optional[float]:
+        """Like hit, but without recording anything"""
+        now = time.monotonic()
+        hits = self._window(key, now)
+        if len(hits) >= self.limit:
+            return hits[0] + self.window - now
+        return None
+
+    def hit(self, key: Hashable) -> Optional[float]:
+        """
+        Record a hit for `key`.
+
+        Returns None if the hit is admitted, otherwise the number of seconds
+        until the oldest hit in the window expires.
+        """
+        now = time.monotonic()
+        hits = self._window(key, now)
+
+        if len(hits) >= self.limit:
+            self._store(key, hits)
+            return hits[0] + self.window - now
+
+        hits.append(now)
+        self._store(key, hits)
+        return None
+
+    def release(self, key: Hashable) -> None:
+        """Take back the latest hit of `key`, for an attempt that turned out not to count"""
+        hits = self._window(key, time.monotonic())
+        if hits:
+            hits.pop()
+            self._store(key, hits)
+
+    def reset(self, key: Hashable) -> None:
+        self._hits.pop(key)
+        self._limited.pop(key)
@@ -0,0 +1,67 @@
+"""
+Recommendation rules (see docs/recommendation_logic.md).
+
+The rules are pure functions over columns, so the same code scores one user
+in save_similar_moles and every user at once in
+scripts/backfill_recommendations.py. Inputs may be scalars, lists, NumPy
+arrays or pandas Series; a missing CNN result is None or NaN.
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+
+PLASTIC_SURGEON = "plastic_surgeon"
+DERMATOLOGIST = "dermatologist"
+MONITORING = "monitoring"
+
+# Plastic surgeon from this CNN score; dermatologist strictly between the two thresholds
+SURGEON_CNN_THRESHOLD = 0.3
+DERMATOLOGIST_CNN_THRESHOLD = 0.15
+# Plastic surgeon from this many "yes" answers; exactly one means dermatologist
+SURGEON_MIN_YES_ANSWERS = 2
+
+QUESTIONS = ("q1", "q2", "q3", "q4", "q5")
+
+MESSAGES: Dict[str, str] = {
+    PLASTIC_SURGEON: "According to the data you have provided to DermaFast, we highly recommend you schedule a meeting with a plastic surgeon as soon as possible.",
+    DERMATOLOGIST: "According to the data you have provided to DermaFast, we highly recommend you schedule a meeting with a dermatologist.",
+    MONITORING: "According to the data you have provided to DermaFast, we highly recommend you continue monitoring your moles and beauty marks, and visit a dermatologist at least once a year.",
+}
+_TIER_BY_MESSAGE = {message: tier for tier, message in MESSAGES.items()}
+
+
+def recommend_tiers(cnn_result, yes_answers, has_melanoma_selection,
+                    surgeon_threshold: float = SURGEON_CNN_THRESHOLD,
+                    dermatologist_threshold: float = DERMATOLOGIST_CNN_THRESHOLD) -> np.ndarray:
+    """
+    Tier for each user given the latest CNN result, the number of "yes"
+    questionnaire answers and whether a known melanoma was selected as similar.
+    """
+    cnn = np.asarray(cnn_result, dtype=np.float64)
+    yes = np.asarray(yes_answers)
+    melanoma = np.asarray(has_melanoma_selection, dtype=bool)
+
+    # Comparisons with NaN (no CNN result) are False, so the score then plays no part
+    with np.errstate(invalid="ignore"):
+        surgeon = (cnn >= surgeon_threshold) | (yes >= SURGEON_MIN_YES_ANSWERS) | melanoma
+        dermatologist = ((cnn > dermatologist_threshold) & (cnn < surgeon_threshold)) | (yes == 1)
+    return np.select([surgeon, dermatologist], [PLASTIC_SURGEON, DERMATOLOGIST], MONITORING)
+
+
+def recommend_tier(cnn_result: Optional[float], yes_answers: int, has_melanoma_selection: bool) -> str:
+    """recommend_tiers for a single user"""
+    cnn = np.nan if cnn_result is None else cnn_result
+    return str(recommend_tiers(cnn, yes_answers, has_melanoma_selection))
+
+
+def count_yes_answers(answers):
+    """Number of questions answered True, from a questionnaire row (dict) or a DataFrame of rows"""
+    if isinstance(answers, dict):
+        return sum(1 for question in QUESTIONS if answers.get(question) is True)
+    return (answers[list(QUESTIONS)] == True).sum(axis=1).to_numpy()  # noqa: E712 - NULL answers count as "no"
+
+
+def tier_of_message(message: Optional[str]) -> Optional[str]:
+    """Tier of a stored recommendation message (None if it matches no current message)"""
+    return _TIER_BY_MESSAGE.get(message)
@@ -0,0 +1,216 @@
+"""
+Deadlines, timeouts and circuit breakers for calls to remote dependencies.
+
+Every request gets a deadline (DeadlineMiddleware) that is visible to all the
+stages it runs. `remote_call` runs a blocking Supabase call off the event loop
+with a timeout derived from the time left, and through the circuit breaker of
+its dependency, so a slow or failing dependency costs a bounded amount of
+time instead of hanging the request.
+"""
+
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import registry, Counter, Gauge
+
+# Total time budget of a request
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+
+# Upper bound on a single remote call, even when the request has more time left
+REMOTE_CALL_TIMEOUT_SECONDS = float(os.getenv("REMOTE_CALL_TIMEOUT_SECONDS", "10"))
+
+# Consecutive failures that open a breaker, and how long it stays open before a probe call
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# Absolute time.monotonic() by which the current request must finish (None = no deadline)
+deadline_var: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+deadline_exceeded = registry.register(Counter(
+    "dermafast_deadline_exceeded_total", "Remote calls abandoned because the request ran out of time", ["dependency"]))
+breaker_rejections = registry.register(Counter(
+    "dermafast_circuit_breaker_rejected_total", "Calls refused because the dependency's breaker was open", ["dependency"]))
+breaker_state = registry.register(Gauge(
+    "dermafast_circuit_breaker_open", "1 while the dependency's breaker is open or probing", ["dependency"]))
+
+
+class DependencyUnavailable(HTTPException):
+    """The dependency's breaker is open; the call was not attempted"""
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail=f"The {dependency} is temporarily unavailable, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class DependencyTimeout(HTTPException):
+    """The call did not finish within its timeout or the request's remaining budget"""
+
+    def __init__(self, dependency: str):
+        super().__init__(status_code=504, detail=f"The {dependency} did not respond in time")
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Limit the enclosed code to `seconds`; an enclosing, earlier deadline still applies"""
+    current = deadline_var.get()
+    if seconds is not None:
+        candidate = time.monotonic() + seconds
+        current = candidate if current is None else min(current, candidate)
+    token = deadline_var.set(current)
+    try:
+        yield
+    finally:
+        deadline_var.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None if there is none"""
+    current = deadline_var.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def has_budget(seconds: float) -> bool:
+    """True if at least `seconds` remain; used to skip optional stages late in a request"""
+    left = remaining()
+    return left is None or left >= seconds
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after `failure_threshold` consecutive failures. Once
+    `reset_timeout` has passed a single probe call is let through: its success
+    closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self) -> None:
+        """Raise DependencyUnavailable unless a call may be attempted now"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            waited = time.monotonic() - self._opened_at
+            if waited >= self.reset_timeout and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(self.reset_timeout - waited, 1.0)
+        breaker_rejections.inc(dependency=self.name)
+        raise DependencyUnavailable(self.name, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+        breaker_state.set(0, dependency=self.name)
+
+    def release_probe(self) -> None:
+        """Let another probe through after one was abandoned without an outcome"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+            is_open = self._opened_at is not None
+        breaker_state.set(1 if is_open else 0, dependency=self.name)
+
+
+# Storage is not called remotely (reference image URLs are built locally), so it has no breaker
+breakers: Dict[str, CircuitBreaker] = {
+    "database": CircuitBreaker("database"),
+}
+
+
+def _is_dependency_failure(error: Exception) -> bool:
+    # An APIError means the database answered (e.g. a constraint violation), so it is healthy
+    return not isinstance(error, (APIError, HTTPException))
+
+
+async def remote_call(dependency: str, fn: Callable, *args, timeout: Optional[float] = None,
+                      use_deadline: bool = True):
+    """
+    Run the blocking call fn(*args) in the thread pool, guarded by the breaker of
+    `dependency` and a timeout of min(timeout, time left before the deadline).
+
+    Raises DependencyUnavailable (503) when the breaker is open and
+    DependencyTimeout (504) when the call or the request runs out of time.
+    """
+    breaker = breakers[dependency]
+    timeout = REMOTE_CALL_TIMEOUT_SECONDS if timeout is None else timeout
+    left = remaining() if use_deadline else None
+    if left is not None:
+        timeout = min(timeout, left)
+    if timeout <= 0:
+        deadline_exceeded.inc(dependency=dependency)
+        raise DependencyTimeout(dependency)
+
+    breaker.before_call()
+    try:
+        result = await asyncio.wait_for(run_in_threadpool(fn, *args), timeout)
+    except asyncio.TimeoutError:
+        breaker.record_failure()
+        deadline_exceeded.inc(dependency=dependency)
+        raise DependencyTimeout(dependency)
+    except asyncio.CancelledError:
+        breaker.release_probe()
+        raise
+    except Exception as e:
+        if _is_dependency_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+class DeadlineMiddleware:
+    """ASGI middleware that gives each HTTP request a deadline of REQUEST_DEADLINE_SECONDS"""
+
+    def __init__(self, app, seconds: float = REQUEST_DEADLINE_SECONDS):
+        self.app = app
+        self.seconds = seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with deadline(self.seconds):
+            await self.app(scope, receive, send)
@@ -1,9 +1,14 @@
 import os
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# HTTP timeouts of the underlying clients. Requests also time out earlier via
+# resilience.remote_call; these bound the worker thread left behind when they do.
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "10"))
+STORAGE_TIMEOUT_SECONDS = float(os.getenv("STORAGE_TIMEOUT_SECONDS", "20"))
+
 def get_supabase_client() -> Client:
     """
     Initializes and returns the Supabase client.
@@ -14,6 +19,20 @@ def get_supabase_client() -> Client:
     if not supabase_url or not supabase_key:
         raise ValueError("Supabase URL and service key must be set in .env file")
 
-    return create_client(supabase_url, supabase_key)
+    options = ClientOptions(
+        postgrest_client_timeout=SUPABASE_TIMEOUT_SECONDS,
+        storage_client_timeout=STORAGE_TIMEOUT_SECONDS,
+    )
+    return create_client(supabase_url, supabase_key, options=options)
 
 supabase_client = get_supabase_client()
+
+
+def close_connections():
+    """
+    Close the client's pooled HTTP connections; they are reopened on next use.
+    Called before forking workers so they never share a connection.
+    """
+    if supabase_client._postgrest is not None:
+        supabase_client._postgrest.session.close()
+        supabase_client._postgrest = None
@@ -0,0 +1,162 @@
+"""
+Size-bounded handling of image uploads.
+
+Uploads are read in chunks with a byte limit, and the image header is sniffed
+from the first chunks so oversized, decompression-bomb or non-image payloads are
+rejected before the whole body is buffered.
+"""
+
+import io
+import os
+from typing import Callable, Optional
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image, UnidentifiedImageError
+from starlette.responses import JSONResponse
+
+# Largest accepted image file, in bytes
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+
+# Largest accepted image, in pixels. Anything bigger is treated as a decompression bomb.
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+
+# How much of the body may be read while looking for the image dimensions
+# (JPEG files can carry large EXIF blocks before the frame header)
+HEADER_SNIFF_BYTES = 512 * 1024
+
+# Allowance for multipart boundaries and part headers around the file content
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+ACCEPTED_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "BMP", "GIF", "TIFF"}
+
+_SIGNATURES = (
+    b"\xff\xd8\xff",            # JPEG / MPO
+    b"\x89PNG\r\n\x1a\n",       # PNG
+    b"GIF87a", b"GIF89a",       # GIF
+    b"BM",                      # BMP
+    b"II*\x00", b"MM\x00*",     # TIFF
+)
+
+
+def _looks_like_image(head: bytes) -> bool:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(_SIGNATURES)
+
+
+def check_image_header(head: bytes) -> Optional[tuple]:
+    """
+    Inspect the first bytes of an upload.
+
+    Returns the image (width, height), or None if more bytes are needed to
+    reach the header. Raises HTTPException for non-image payloads and images
+    whose dimensions exceed MAX_IMAGE_PIXELS.
+    """
+    if len(head) >= 12 and not _looks_like_image(head):
+        raise HTTPException(status_code=415, detail="File must be a JPEG, PNG, WEBP, BMP, GIF or TIFF image")
+
+    try:
+        # Image.open only parses the header; pixel data is not decoded here
+        with Image.open(io.BytesIO(head)) as image:
+            image_format, size = image.format, image.size
+    except Image.DecompressionBombError:
+        # PIL refuses headers far beyond its own pixel limit before reporting the size
+        raise HTTPException(status_code=400, detail=f"Image dimensions exceed the allowed {MAX_IMAGE_PIXELS} pixels")
+    except (UnidentifiedImageError, SyntaxError, OSError, ValueError):
+        return None
+
+    if image_format not in ACCEPTED_FORMATS:
+        raise HTTPException(status_code=415, detail=f"Unsupported image format: {image_format}")
+
+    width, height = size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=400, detail=f"Image dimensions {width}x{height} exceed the allowed {MAX_IMAGE_PIXELS} pixels")
+
+    return size
+
+
+async def read_image_upload(file: UploadFile, max_bytes: Optional[int] = None) -> bytes:
+    """
+    Read an uploaded image in chunks, validating it as it arrives.
+
+    Raises HTTPException with 413 once the upload exceeds `max_bytes`
+    (MAX_UPLOAD_BYTES by default), and with 400/415 as soon as the header shows
+    it is not an acceptable image.
+    """
+    if max_bytes is None:
+        max_bytes = MAX_UPLOAD_BYTES
+
+    chunks = []
+    total = 0
+    header_checked = False
+
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image exceeds the maximum upload size of {max_bytes} bytes")
+        chunks.append(chunk)
+
+        if not header_checked:
+            head = b"".join(chunks)
+            if check_image_header(head) is not None:
+                header_checked = True
+            elif total >= HEADER_SNIFF_BYTES:
+                raise HTTPException(status_code=415, detail="Could not read an image header from the upload")
+
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+
+    if not header_checked:
+        raise HTTPException(status_code=415, detail="Uploaded file is not a readable image")
+
+    # bytes are immutable, so io.BytesIO in the decoder shares this buffer rather than copying it
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware that rejects request bodies larger than a per-path limit.
+
+    Requests that declare a too-large Content-Length are answered with 413
+    before any of the body is read. Chunked bodies are counted as they stream
+    in and aborted with 413 once they cross the limit.
+    """
+
+    def __init__(self, app, max_body_bytes: Callable[[str], Optional[int]]):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.max_body_bytes(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse(status_code=413, content={"detail": f"Request body exceeds {limit} bytes"})
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=f"Request body exceeds {limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,83 @@
+"""
+Shared job broker and inference workers for the asynchronous analysis API.
+
+Start one broker, point the API processes at it with JOB_BROKER_ADDRESS, and
+start as many inference workers as needed, on any machine that can reach it:
+
+    JOB_BROKER_AUTHKEY=secret python job_worker.py broker --address 10.0.0.5:50000
+    JOB_BROKER_ADDRESS=broker-host:50000 JOB_BROKER_AUTHKEY=secret python serve.py --workers 4
+    JOB_BROKER_AUTHKEY=secret python job_worker.py work --broker broker-host:50000 --concurrency 2
+
+Workers need the same .env (Supabase credentials) and model weights as the API.
+JOB_BROKER_AUTHKEY is required: the broker exchanges pickles, so its port must
+only be reachable from a private network, never from the internet.
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+logger = logging.getLogger("app.job_worker")
+
+
+def run_broker(address: str) -> None:
+    from app.logging_config import configure_logging
+    from app.jobs import serve_broker
+
+    configure_logging()
+    serve_broker(address)
+
+
+async def run_workers(address: str, concurrency: int) -> None:
+    from app.logging_config import configure_logging
+    from app.model_registry import ModelRegistry, MODEL_PATH, MODEL_WATCH_INTERVAL_SECONDS
+    from app.analysis import analyze_image
+    from app.faiss_service import faiss_service
+    from app.jobs import connect_broker, work
+
+    configure_logging()
+    model_registry = ModelRegistry(MODEL_PATH)
+    faiss_service.set_model_version(model_registry.current().version)
+    model_registry.on_swap(lambda old, new: faiss_service.set_model_version(new.version))
+    broker = connect_broker(address)
+
+    async def process(payload: dict) -> dict:
+        loaded = model_registry.current()
+        return await analyze_image(loaded.model, payload["national_id"], payload["image_bytes"], loaded.version)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info("Inference workers started", extra={"broker": address, "concurrency": concurrency})
+    # Jobs in progress are finished before exiting; claims are polled so stop is noticed within a second
+    tasks = [work(broker, process, stop) for _ in range(concurrency)]
+    if MODEL_WATCH_INTERVAL_SECONDS > 0:
+        tasks.append(model_registry.watch(MODEL_WATCH_INTERVAL_SECONDS, stop))
+    await asyncio.gather(*tasks)
+    logger.info("Inference workers stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DermaFast job broker and inference workers")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    broker_parser = subcommands.add_parser("broker", help="Host the shared job broker")
+    broker_parser.add_argument("--address", default="127.0.0.1:50000",
+                               help="host:port to listen on; bind a private interface to serve other machines")
+
+    work_parser = subcommands.add_parser("work", help="Run inference workers against a broker")
+    work_parser.add_argument("--broker", required=True, help="host:port of the job broker")
+    work_parser.add_argument("--concurrency", type=int, default=1, help="Jobs processed at the same time")
+
+    args = parser.parse_args()
+    if args.command == "broker":
+        run_broker(args.address)
+    else:
+        asyncio.run(run_workers(args.broker, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# Add project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from backend.app.recommendation import (
+    DERMATOLOGIST_CNN_THRESHOLD, MESSAGES, QUESTIONS, SURGEON_CNN_THRESHOLD,
+    count_yes_answers, recommend_tiers, tier_of_message,
+)
+from backend.app.supabase_client import supabase_client as supabase
+
+PAGE_SIZE = 1000
+INSERT_BATCH_SIZE = 500
+SELECTION_COLUMNS = ['image_id1', 'image_id2', 'image_id3']
+
+
+def fetch_latest(table, columns):
+    """
+    Latest row per national_id of `table`, as a DataFrame indexed by
+    national_id. Pages are read in (national_id, timestamp) order and each is
+    reduced to its last row per user as it arrives.
+    """
+    columns = ['national_id', 'timestamp'] + columns
+    pages, start = [], 0
+    while True:
+        rows = (supabase.table(table).select(', '.join(columns))
+                .order('national_id').order('timestamp')
+                .range(start, start + PAGE_SIZE - 1).execute().data)
+        if rows:
+            pages.append(pd.DataFrame(rows, columns=columns).drop_duplicates('national_id', keep='last'))
+        if len(rows) < PAGE_SIZE:
+            break
+        start += PAGE_SIZE
+    # A user whose rows span two pages appears in both; the later page holds the newer row
+    latest = pd.concat(pages, ignore_index=True) if pages else pd.DataFrame(columns=columns)
+    latest = latest.drop_duplicates('national_id', keep='last')
+    print(f"{table}: {len(latest)} users")
+    return latest.set_index('national_id').drop(columns='timestamp')
+
+
+def melanoma_image_ids():
+    """IDs of every ham_metadata image diagnosed as melanoma"""
+    image_ids, start = [], 0
+    while True:
+        rows = (supabase.table('ham_metadata').select('image_id').eq('dx', 'mel')
+                .order('image_id').range(start, start + PAGE_SIZE - 1).execute().data)
+        image_ids.extend(row['image_id'] for row in rows)
+        if len(rows) < PAGE_SIZE:
+            return np.array(image_ids, dtype=str)
+        start += PAGE_SIZE
+
+
+def score_users(selections, cnn_results, questionnaires, melanoma_ids, surgeon_threshold, dermatologist_threshold):
+    """
+    One row per user with a similar-mole selection: the inputs of the rules
+    and the tier they give, as save_similar_moles would compute it from each
+    user's latest CNN result, questionnaire and selection.
+    """
+    users = pd.DataFrame(index=selections.index)
+    users['cnn_result'] = pd.to_numeric(cnn_results['cnn_result'], errors='coerce').reindex(users.index)
+    answers = questionnaires.reindex(users.index)
+    users['yes_answers'] = count_yes_answers(answers)
+    selected = selections[SELECTION_COLUMNS].fillna('').to_numpy(dtype=str)
+    users['melanoma_selected'] = np.isin(selected, melanoma_ids).any(axis=1)
+    users['tier'] = recommend_tiers(users['cnn_result'], users['yes_answers'], users['melanoma_selected'],
+                                    surgeon_threshold=surgeon_threshold,
+                                    dermatologist_threshold=dermatologist_threshold)
+    return users
+
+
+def insert_recommendations(users):
+    """Append a final_recommendation row for each user; the newest row is the one the app reads"""
+    rows = [{'national_id': national_id, 'recommendation': MESSAGES[tier]}
+            for national_id, tier in users['tier'].items()]
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        supabase.table('final_recommendation').insert(rows[start:start + INSERT_BATCH_SIZE]).execute()
+    print(f"Inserted {len(rows)} recommendations.")
+
+
+def backfill_recommendations(args):
+    """
+    Re-score every user's latest inputs with the recommendation rules and
+    report how their tier would change against their latest stored
+    recommendation; with --write, store the new recommendation of each changed
+    user.
+    """
+    started = time.time()
+    selections = fetch_latest('similar_moles_ann_user', SELECTION_COLUMNS)
+    cnn_results = fetch_latest('cnn_results', ['cnn_result'])
+    questionnaires = fetch_latest('mole_questionnaires', list(QUESTIONS))
+    stored = fetch_latest('final_recommendation', ['recommendation'])
+    melanoma_ids = melanoma_image_ids()
+
+    users = score_users(selections, cnn_results, questionnaires, melanoma_ids,
+                        args.surgeon_threshold, args.dermatologist_threshold)
+    users['stored_tier'] = (stored['recommendation'].reindex(users.index)
+                            .map(tier_of_message).fillna('none'))
+    changed = users[users['tier'] != users['stored_tier']]
+    print(f"Scored {len(users)} users in {time.time() - started:.1f}s "
+          f"(thresholds {args.dermatologist_threshold} / {args.surgeon_threshold}).")
+
+    print("\nStored tier (rows) -> new tier (columns):")
+    print(pd.crosstab(users['stored_tier'], users['tier'], margins=True))
+    print(f"\n{len(changed)} users would change tier.")
+    if args.show_changes and len(changed):
+        print(changed[['stored_tier', 'tier', 'cnn_result', 'yes_answers', 'melanoma_selected']].to_string())
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        users.to_csv(args.output, index_label='national_id')
+        print(f"Per-user results have been saved to {args.output}")
+
+    if args.write and len(changed):
+        insert_recommendations(changed)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Re-score every user's recommendation and report tier changes")
+    parser.add_argument('--surgeon-threshold', type=float, default=SURGEON_CNN_THRESHOLD,
+                        help="CNN score from which a plastic surgeon is recommended")
+    parser.add_argument('--dermatologist-threshold', type=float, default=DERMATOLOGIST_CNN_THRESHOLD,
+                        help="CNN score above which a dermatologist is recommended")
+    parser.add_argument('--show-changes', action='store_true', help="List every user whose tier changes")
+    parser.add_argument('--output', help="Also save the per-user inputs and tiers to this CSV")
+    parser.add_argument('--write', action='store_true',
+                        help="Store the new recommendation of every user whose tier changes")
+
+    backfill_recommendations(parser.parse_args())
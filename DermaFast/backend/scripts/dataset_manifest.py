@@ -0,0 +1,210 @@
+"""
+Columnar index of the local HAM10000 dataset under moles_data/.
+
+One row per image ID found in HAM10000_metadata.csv or in the image
+directories, sorted by image_id, with these columns:
+
+    image_id, path (relative to the data directory, '' if the image is missing),
+    dx, lesion_id, split ('train', 'test' or 'unused'), size (bytes, -1 if
+    missing), mtime_ns and sha256 (hex digest prefix of the image file)
+
+'train' is HAM10000_binary_balanced.csv minus test_images_ids.csv, the
+images the model was trained on; 'test' is test_images_ids.csv.
+
+The manifest is stored as moles_data/dataset_manifest.npz and rebuilt
+automatically when a source CSV or image directory changes; unchanged image
+files keep their hash instead of being read again.
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, '..', '..'))
+DEFAULT_DATA_DIR = os.path.join(PROJECT_ROOT, 'moles_data')
+IMAGE_DIRS = ('HAM10000_images_part_1', 'HAM10000_images_part_2')
+
+MANIFEST_FILE = 'dataset_manifest.npz'
+METADATA_CSV = 'HAM10000_metadata.csv'
+BALANCED_CSV = 'HAM10000_binary_balanced.csv'
+TEST_CSV = 'test_images_ids.csv'
+
+HASH_LENGTH = 16
+COLUMNS = ('image_id', 'path', 'dx', 'lesion_id', 'split', 'size', 'mtime_ns', 'sha256')
+
+
+def find_images(data_dir):
+    """Map image_id -> path relative to `data_dir` for every .jpg in the HAM10000 image directories"""
+    paths = {}
+    for image_dir in IMAGE_DIRS:
+        directory = os.path.join(data_dir, image_dir)
+        if not os.path.isdir(directory):
+            print(f"Image directory not found, skipping: {directory}")
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith('.jpg'):
+                paths.setdefault(os.path.splitext(name)[0], os.path.join(image_dir, name))
+    return paths
+
+
+def _read_ids(path):
+    if not os.path.exists(path):
+        print(f"{os.path.basename(path)} not found; treating it as empty.")
+        return set()
+    return set(pd.read_csv(path, usecols=['image_id'])['image_id'])
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def _sources(data_dir):
+    return [os.path.join(data_dir, name) for name in (METADATA_CSV, BALANCED_CSV, TEST_CSV) + IMAGE_DIRS]
+
+
+def build_dataset_manifest(data_dir=DEFAULT_DATA_DIR, workers=8, previous=None):
+    """
+    Scan `data_dir` and write its manifest. Files whose path, size and mtime
+    match the `previous` DatasetManifest reuse its hash. Returns the new manifest.
+    """
+    started = time.time()
+    metadata = pd.read_csv(os.path.join(data_dir, METADATA_CSV), usecols=['image_id', 'lesion_id', 'dx'])
+    metadata = metadata.drop_duplicates('image_id').set_index('image_id')
+    test_ids = _read_ids(os.path.join(data_dir, TEST_CSV))
+    training_ids = _read_ids(os.path.join(data_dir, BALANCED_CSV)) - test_ids
+    images = find_images(data_dir)
+
+    image_ids = np.array(sorted(set(metadata.index) | set(images)), dtype=str)
+    rows = metadata.reindex(image_ids)
+    paths = np.array([images.get(image_id, '') for image_id in image_ids], dtype=str)
+
+    sizes = np.full(len(image_ids), -1, dtype=np.int64)
+    mtimes = np.zeros(len(image_ids), dtype=np.int64)
+    for row in np.nonzero(paths != '')[0]:
+        stat = os.stat(os.path.join(data_dir, paths[row]))
+        sizes[row], mtimes[row] = stat.st_size, stat.st_mtime_ns
+
+    hashes = np.full(len(image_ids), '', dtype=f'<U{HASH_LENGTH}')
+    on_disk = paths != ''
+    unchanged = np.zeros(len(image_ids), dtype=bool)
+    if previous is not None and len(previous):
+        before = previous.rows(image_ids)
+        known = before >= 0
+        unchanged[known] = ((previous.path[before[known]] == paths[known])
+                            & (previous.size[before[known]] == sizes[known])
+                            & (previous.mtime_ns[before[known]] == mtimes[known]))
+        unchanged &= on_disk
+        hashes[unchanged] = previous.sha256[before[unchanged]]
+    to_hash = np.nonzero(on_disk & ~unchanged)[0]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for row, digest in zip(to_hash, executor.map(
+                _file_hash, (os.path.join(data_dir, paths[row]) for row in to_hash))):
+            hashes[row] = digest
+
+    in_training = np.isin(image_ids, list(training_ids))
+    in_test = np.isin(image_ids, list(test_ids))
+    arrays = {
+        'image_id': image_ids,
+        'path': paths,
+        'dx': rows['dx'].fillna('').to_numpy(dtype=str),
+        'lesion_id': rows['lesion_id'].fillna('').to_numpy(dtype=str),
+        'split': np.where(in_training, 'train', np.where(in_test, 'test', 'unused')),
+        'size': sizes,
+        'mtime_ns': mtimes,
+        'sha256': hashes,
+    }
+
+    output_path = os.path.join(data_dir, MANIFEST_FILE)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, output_path)
+    print(f"Wrote {output_path}: {len(image_ids)} images ({int((paths != '').sum())} on disk, "
+          f"{len(to_hash)} hashed) in {time.time() - started:.1f}s")
+    return DatasetManifest(data_dir, arrays)
+
+
+class DatasetManifest:
+    """The manifest's columns as NumPy arrays, with lookups by image_id"""
+
+    def __init__(self, data_dir, arrays):
+        self.data_dir = data_dir
+        for column in COLUMNS:
+            setattr(self, column, arrays[column])
+
+    def __len__(self):
+        return len(self.image_id)
+
+    def rows(self, image_ids):
+        """Row of each of `image_ids` (-1 where unknown)"""
+        image_ids = np.asarray(image_ids, dtype=str)
+        positions = np.searchsorted(self.image_id, image_ids)
+        positions = np.minimum(positions, max(len(self.image_id) - 1, 0))
+        found = (self.image_id[positions] == image_ids) if len(self.image_id) else np.zeros(len(image_ids), bool)
+        return np.where(found, positions, -1)
+
+    def row(self, image_id):
+        row = int(self.rows([image_id])[0])
+        return row if row >= 0 else None
+
+    def diagnoses(self, image_ids):
+        """Diagnosis of each of `image_ids` ('' where unknown)"""
+        return np.append(self.dx, '')[self.rows(image_ids)]
+
+    def image_paths(self):
+        """Map image_id -> absolute path for every image on disk"""
+        on_disk = np.nonzero(self.path != '')[0]
+        return {self.image_id[row]: os.path.join(self.data_dir, self.path[row]) for row in on_disk}
+
+    def ids(self, splits=None, on_disk=False, labeled=False):
+        """Image IDs, optionally limited to some splits, to images on disk and to images with a diagnosis"""
+        mask = np.ones(len(self), dtype=bool)
+        if splits is not None:
+            mask &= np.isin(self.split, list(splits))
+        if on_disk:
+            mask &= self.path != ''
+        if labeled:
+            mask &= self.dx != ''
+        return self.image_id[mask]
+
+
+def _is_stale(data_dir, manifest_path):
+    built = os.path.getmtime(manifest_path)
+    return any(os.path.exists(source) and os.path.getmtime(source) > built for source in _sources(data_dir))
+
+
+def load_dataset(data_dir=DEFAULT_DATA_DIR, rebuild=False, workers=8):
+    """
+    The dataset manifest of `data_dir`, built first if it is missing, out of
+    date, or `rebuild` is set.
+    """
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    previous = None
+    if os.path.exists(manifest_path):
+        with np.load(manifest_path, allow_pickle=False) as npz:
+            previous = DatasetManifest(data_dir, {column: npz[column] for column in COLUMNS})
+        if not rebuild and not _is_stale(data_dir, manifest_path):
+            return previous
+    return build_dataset_manifest(data_dir, workers=workers, previous=previous)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the HAM10000 dataset manifest")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild even if the manifest is up to date")
+    parser.add_argument('--workers', type=int, default=8, help="Threads hashing image files")
+    args = parser.parse_args()
+
+    dataset = load_dataset(args.data_dir, rebuild=args.rebuild, workers=args.workers)
+    splits, counts = np.unique(dataset.split, return_counts=True)
+    print(f"{len(dataset)} images: " + ", ".join(f"{count} {split}" for split, count in zip(splits, counts)))
@@ -0,0 +1,211 @@
+"""
+Shared pipeline for computing reference embeddings of HAM10000 images.
+
+Three stages run concurrently, connected by bounded queues so a slow stage
+holds back the others instead of buffering the whole bucket in memory:
+
+    download (thread pool) -> batched CNN inference -> bulk upsert into ham_metadata
+
+Used by populate_embeddings.py and reembed_stale.py; both add the project root
+to sys.path before importing this module.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+from backend.app.ml_model import inference_batch
+from backend.app.supabase_client import supabase_client as supabase
+
+BUCKET_NAME = 'HAM10000_for_comparison'
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(SCRIPT_DIR, 'results')
+
+_DONE = object()
+
+
+def download_image(image_id):
+    """Download `image_id`.jpg from the comparison bucket; None if it cannot be fetched"""
+    try:
+        return supabase.storage.from_(BUCKET_NAME).download(f"{image_id}.jpg")
+    except Exception as e:
+        print(f"  -> Could not download {image_id}: {e}")
+        return None
+
+
+class Checkpoint:
+    """
+    Image IDs already embedded (or given up on) for one model version, saved
+    atomically after every written batch so an interrupted run can resume.
+    A checkpoint written for another model version is ignored.
+    """
+
+    def __init__(self, path, model_version):
+        self.path = path
+        self.model_version = model_version
+        self.completed = set()
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('model_version') == model_version:
+                self.completed = set(data.get('completed', []))
+                self.failed = data.get('failed', {})
+            else:
+                print(f"Ignoring checkpoint for model version {data.get('model_version')}")
+
+    def pending(self, image_ids, retry_failed=False):
+        """The IDs of `image_ids` that still need an embedding"""
+        for image_id in image_ids:
+            if image_id in self.completed or (image_id in self.failed and not retry_failed):
+                continue
+            yield image_id
+
+    def record(self, completed, failed):
+        self.completed.update(completed)
+        for image_id in completed:
+            self.failed.pop(image_id, None)
+        self.failed.update(failed)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'model_version': self.model_version,
+                'completed': sorted(self.completed),
+                'failed': self.failed,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+class EmbeddingPipeline:
+    def __init__(self, model, model_version, batch_size=64, download_workers=16, queued_batches=4):
+        self.model = model
+        self.model_version = model_version
+        self.batch_size = batch_size
+        self.download_workers = download_workers
+        self.queued_batches = queued_batches
+
+    def _feed(self, image_ids, ids_queue):
+        try:
+            for image_id in image_ids:
+                ids_queue.put(image_id)
+        except Exception as e:
+            # Listing more IDs failed; finish what was queued and report it from run()
+            self._feed_error = e
+        finally:
+            for _ in range(self.download_workers):
+                ids_queue.put(_DONE)
+
+    def _download(self, ids_queue, images_queue):
+        while True:
+            image_id = ids_queue.get()
+            if image_id is _DONE:
+                images_queue.put(_DONE)
+                return
+            images_queue.put((image_id, download_image(image_id)))
+
+    def _embed(self, batch):
+        """Turn a list of (image_id, bytes or None) into (upsert rows, {image_id: reason})"""
+        failed = {image_id: 'download failed' for image_id, image in batch if image is None}
+        downloaded = [(image_id, image) for image_id, image in batch if image is not None]
+        if not downloaded:
+            return [], failed
+
+        try:
+            results = inference_batch(self.model, [image for _, image in downloaded])
+        except Exception as e:
+            print(f"  -> Inference failed for a batch of {len(downloaded)} images: {e}")
+            failed.update({image_id: f'inference failed: {e}' for image_id, _ in downloaded})
+            return [], failed
+
+        rows = []
+        for (image_id, _), result in zip(downloaded, results):
+            if result is None:
+                failed[image_id] = 'could not decode image'
+                continue
+            _, embedding = result
+            rows.append({'image_id': image_id, 'embedding': embedding, 'embedding_version': self.model_version})
+        return rows, failed
+
+    def _infer(self, images_queue, writes_queue):
+        remaining_downloaders = self.download_workers
+        batch = []
+        while remaining_downloaders:
+            item = images_queue.get()
+            if item is _DONE:
+                remaining_downloaders -= 1
+            else:
+                batch.append(item)
+            if batch and (len(batch) >= self.batch_size or not remaining_downloaders):
+                writes_queue.put(self._embed(batch))
+                batch = []
+        writes_queue.put(_DONE)
+
+    def _write(self, rows):
+        """Bulk-upsert one batch; returns (written IDs, {image_id: reason})"""
+        if not rows:
+            return [], {}
+        try:
+            supabase.table('ham_metadata').upsert(rows, on_conflict='image_id').execute()
+        except Exception as e:
+            print(f"  -> Could not write a batch of {len(rows)} embeddings: {e}")
+            return [], {row['image_id']: f'write failed: {e}' for row in rows}
+        return [row['image_id'] for row in rows], {}
+
+    def run(self, image_ids, checkpoint=None):
+        """
+        Embed and store every ID in `image_ids` (any iterable, consumed lazily).
+        Progress is recorded in `checkpoint` after each batch is written.
+
+        Returns a dict with the number of images written and failed, the elapsed
+        seconds and the throughput in images per second.
+        """
+        self._feed_error = None
+        ids_queue = queue.Queue(maxsize=self.batch_size * self.queued_batches)
+        images_queue = queue.Queue(maxsize=self.batch_size * self.queued_batches)
+        writes_queue = queue.Queue(maxsize=self.queued_batches)
+
+        threads = [threading.Thread(target=self._feed, args=(image_ids, ids_queue), daemon=True)]
+        threads += [
+            threading.Thread(target=self._download, args=(ids_queue, images_queue), daemon=True)
+            for _ in range(self.download_workers)
+        ]
+        threads.append(threading.Thread(target=self._infer, args=(images_queue, writes_queue), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        started = time.time()
+        written = failed = 0
+        while True:
+            item = writes_queue.get()
+            if item is _DONE:
+                break
+            rows, batch_failed = item
+            written_ids, write_failed = self._write(rows)
+            batch_failed.update(write_failed)
+            if checkpoint is not None:
+                checkpoint.record(written_ids, batch_failed)
+
+            written += len(written_ids)
+            failed += len(batch_failed)
+            elapsed = time.time() - started
+            print(f"Written {written} embeddings, {failed} failed ({written / elapsed:.1f} images/sec)")
+
+        for thread in threads:
+            thread.join()
+        if self._feed_error is not None:
+            raise self._feed_error
+
+        elapsed = time.time() - started
+        return {
+            'written': written,
+            'failed': failed,
+            'seconds': round(elapsed, 1),
+            'images_per_second': round(written / elapsed, 2) if elapsed > 0 else 0.0,
+        }
@@ -0,0 +1,216 @@
+"""
+On-disk embedding shards written by extract_embeddings.py.
+
+A shard directory holds, for one model version, a manifest.json and for each
+shard three .npy files that can be memory-mapped:
+
+    shard_00000.image_ids.npy        fixed-width unicode image IDs, shape (n,)
+    shard_00000.classifications.npy  float32 melanoma probabilities, shape (n,)
+    shard_00000.embeddings.npy       float32 embeddings, shape (n, embedding_dim)
+
+Rows are aligned across the three files. The manifest lists the shards in
+order, so readers never see a shard that was only partly written.
+
+The directory for a model version also serves as the embedding cache of the
+evaluation scripts (cached_embeddings), which append images they had to embed
+and compact the small shards this leaves once there are too many.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+ARRAYS = ('image_ids', 'classifications', 'embeddings')
+
+
+def _save_atomic(path, save):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        save(f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(shard_dir):
+    """The manifest of `shard_dir`, or None if nothing was written there yet"""
+    path = os.path.join(shard_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class ShardWriter:
+    """
+    Buffers embeddings and writes a shard every `shard_size` rows. Writing
+    into a directory that already has shards for the same model version
+    appends to them, so an interrupted extraction can resume.
+    """
+
+    def __init__(self, shard_dir, model_version, shard_size=4096, sources=None):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        os.makedirs(shard_dir, exist_ok=True)
+
+        manifest = load_manifest(shard_dir)
+        if manifest is not None and manifest['model_version'] != model_version:
+            raise ValueError(f"{shard_dir} holds embeddings of model version {manifest['model_version']}, "
+                             f"not {model_version}")
+        self.manifest = manifest or {
+            'model_version': model_version,
+            'embedding_dim': None,
+            'count': 0,
+            'shards': [],
+            'failed': {},
+            'sources': sources or [],
+            'complete': False,
+        }
+        self._buffer = {name: [] for name in ARRAYS}
+
+    def done_ids(self):
+        """Image IDs already written to a shard"""
+        done = set()
+        for image_ids, _, _ in iter_shards(self.shard_dir, self.manifest):
+            done.update(image_ids.tolist())
+        return done
+
+    def add(self, image_ids, classifications, embeddings):
+        self._buffer['image_ids'].extend(image_ids)
+        self._buffer['classifications'].append(np.asarray(classifications, dtype=np.float32).reshape(-1))
+        self._buffer['embeddings'].append(np.asarray(embeddings, dtype=np.float32))
+        if len(self._buffer['image_ids']) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer['image_ids']:
+            return
+        arrays = {
+            'image_ids': np.array(self._buffer['image_ids'], dtype=str),
+            'classifications': np.concatenate(self._buffer['classifications']),
+            'embeddings': np.concatenate(self._buffer['embeddings']),
+        }
+        self._buffer = {name: [] for name in ARRAYS}
+
+        self.manifest['shards'].append(self._write_shard(arrays))
+        self.manifest['embedding_dim'] = int(arrays['embeddings'].shape[1])
+        self.manifest['count'] += len(arrays['image_ids'])
+        self._write_manifest()
+
+    def compact(self):
+        """
+        Rewrite the shards as shards of `shard_size` rows, one at a time from
+        the memory-mapped old ones, then delete the old files. The manifest
+        switches to the new shards at once, so readers see one set or the other.
+        """
+        self.flush()
+        old_shards = self.manifest['shards']
+        if len(old_shards) <= 1:
+            return
+        image_ids, classifications, embeddings = load_shards(self.shard_dir)
+        new_shards = []
+        for start in range(0, len(image_ids), self.shard_size):
+            rows = np.arange(start, min(start + self.shard_size, len(image_ids)))
+            new_shards.append(self._write_shard({
+                'image_ids': image_ids[rows],
+                'classifications': classifications[rows],
+                'embeddings': embeddings[rows],
+            }))
+        self.manifest['shards'] = new_shards
+        self._write_manifest()
+
+        for shard in old_shards:
+            for array_name in ARRAYS:
+                os.remove(os.path.join(self.shard_dir, f"{shard['name']}.{array_name}.npy"))
+
+    def _write_shard(self, arrays):
+        # Names are never reused, so compaction can write new shards next to the old ones
+        number = self.manifest.get('next_shard', len(self.manifest['shards']))
+        self.manifest['next_shard'] = number + 1
+        name = f"shard_{number:05d}"
+        for array_name, array in arrays.items():
+            path = os.path.join(self.shard_dir, f"{name}.{array_name}.npy")
+            _save_atomic(path, lambda f: np.save(f, array, allow_pickle=False))
+        return {'name': name, 'count': len(arrays['image_ids'])}
+
+    def close(self, failed=None):
+        """Write the last partial shard and mark the extraction complete"""
+        self.flush()
+        self.manifest['failed'].update(failed or {})
+        self.manifest['complete'] = True
+        self._write_manifest()
+
+    def _write_manifest(self):
+        self.manifest['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        path = os.path.join(self.shard_dir, MANIFEST_NAME)
+        _save_atomic(path, lambda f: f.write(json.dumps(self.manifest, indent=2).encode('utf-8')))
+
+
+def iter_shards(shard_dir, manifest=None, mmap=True):
+    """Yield (image_ids, classifications, embeddings) for each shard, memory-mapped by default"""
+    manifest = manifest or load_manifest(shard_dir)
+    if manifest is None:
+        return
+    mmap_mode = 'r' if mmap else None
+    for shard in manifest['shards']:
+        yield tuple(
+            np.load(os.path.join(shard_dir, f"{shard['name']}.{array_name}.npy"), mmap_mode=mmap_mode)
+            for array_name in ARRAYS
+        )
+
+
+class ShardedRows:
+    """
+    Rows of one array (classifications or embeddings) spread over several
+    memory-mapped shards, read lazily: indexing gathers only the rows asked for.
+    """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.shape = (int(self._offsets[-1]),) + parts[0].shape[1:]
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.ndim == 0:
+            return self[rows.reshape(1)][0]
+        rows = np.where(rows < 0, rows + len(self), rows)
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError(f"row index out of range for {len(self)} rows")
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        part_of = np.searchsorted(self._offsets, rows, side='right') - 1
+        for part in np.unique(part_of):
+            selected = part_of == part
+            out[selected] = self._parts[part][rows[selected] - self._offsets[part]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def load_shards(shard_dir, mmap=True):
+    """
+    All rows of `shard_dir` as (image_ids, classifications, embeddings).
+    A single shard is returned memory-mapped. With several, the (small) image
+    IDs are concatenated and the other two are ShardedRows views, so only the
+    rows indexed are read into memory.
+    Raises FileNotFoundError if the directory has no manifest.
+    """
+    manifest = load_manifest(shard_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in {shard_dir}; run extract_embeddings.py first")
+    shards = list(iter_shards(shard_dir, manifest, mmap=mmap))
+    if not shards:
+        dim = manifest['embedding_dim'] or 0
+        return np.array([], dtype=str), np.zeros(0, dtype=np.float32), np.zeros((0, dim), dtype=np.float32)
+    if len(shards) == 1:
+        return shards[0]
+    image_ids, classifications, embeddings = zip(*shards)
+    return np.concatenate(image_ids), ShardedRows(classifications), ShardedRows(embeddings)
@@ -1,29 +1,211 @@
+import argparse
+import json
 import os
 import sys
+import time
 import pandas as pd
 import numpy as np
 import asyncio
+import faiss
 from dotenv import load_dotenv
 
 # Add project root to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 
-from backend.app.ml_model import load_model, inference
+from backend.app.ml_model import load_model, default_model_path
+from backend.app.model_registry import weights_version
 from backend.app.faiss_service import faiss_service
+from dataset_manifest import load_dataset
+from extract_embeddings import cached_embeddings
 
-async def evaluate_ann():
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+THRESHOLDS = (3, 5, 6, 8)
+
+# Sweep defaults: faiss factory strings, exact first, then smaller codecs and approximate indexes
+DEFAULT_SWEEP_INDEXES = ['Flat', 'SQfp16', 'SQ8', 'PQ64x4', 'IVF16,Flat|nprobe=4', 'HNSW32']
+DEFAULT_SWEEP_K = [1, 3, 5, 9, 15, 25]
+
+
+def search_neighbours(index, reference_ids, query_ids, query_vectors, k):
     """
-    Evaluates the ANN embeddings by calculating precision@9 and recall@9.
+    Search the index for all queries at once and return the (n_queries, k)
+    matrix of index rows of each query's k nearest reference images, leaving
+    out the query's own image. Rows an approximate index could not fill are -1.
     """
-    print("Starting ANN evaluation script...")
+    # Ask for one extra neighbour because the query image itself may be indexed
+    search_k = min(k + 1, len(reference_ids))
+    _, indices = index.search(query_vectors, search_k)
+    is_self = (indices >= 0) & (reference_ids[indices] == np.asarray(query_ids)[:, None])
+    # Stable sort moves the query's own hit to the end of its row, keeping the ranking of the rest
+    order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def labels_of(neighbours, reference_labels):
+    """Diagnoses of a matrix of index rows ('' for the -1 of missing results)"""
+    return np.append(reference_labels, '')[neighbours]
+
+
+def summarize(true_positives, k):
+    """Precision@k and the match-count rates for one group of queries"""
+    count = len(true_positives)
+    if count == 0:
+        return {'count': 0, 'avg_precision': 0, 'at_least': {t: 0 for t in THRESHOLDS}, 'zero': 0}
+    return {
+        'count': count,
+        'avg_precision': float(np.mean(true_positives / k)),
+        'at_least': {t: float(np.mean(true_positives >= t) * 100) for t in THRESHOLDS},
+        'zero': float(np.mean(true_positives == 0) * 100),
+    }
+
+
+def evaluate(retrieved, query_labels, k):
+    """
+    Metrics over a (n_queries, k) matrix of retrieved diagnoses: the overall
+    summary, one per query diagnosis, and the binary non-melanoma group (any
+    non-melanoma neighbour counts as a match).
+    """
+    true_positives = (retrieved == query_labels[:, None]).sum(axis=1)
+    by_dx = {dx: summarize(true_positives[query_labels == dx], k) for dx in np.unique(query_labels)}
+
+    non_melanoma = query_labels != 'mel'
+    binary_true_positives = (retrieved[non_melanoma] != 'mel').sum(axis=1)
+    return summarize(true_positives, k), by_dx, summarize(binary_true_positives, k)
+
+
+def format_report(overall, by_dx, non_melanoma, not_found_images, k):
+    lines = [
+        "--- Evaluation Summary ---",
+        f"Processed {overall['count']} test images.",
+        f"Average Precision@{k}: {overall['avg_precision']:.4f}",
+    ]
+    lines += [f"% with at least {t}/{k} correct diagnoses: {overall['at_least'][t]:.2f}%" for t in THRESHOLDS]
+    lines += [f"% with no correct diagnoses: {overall['zero']:.2f}%", "--------------------------"]
+
+    if not_found_images:
+        lines += ["", "--- Images Not Found ---"]
+        lines += [f"  - {image_id}" for image_id in sorted(not_found_images)]
+        lines.append("--------------------------")
+
+    def group(title, summary, suffix=""):
+        group_lines = ["", f"Diagnosis: {title} ({summary['count']} samples){suffix}"]
+        group_lines.append(f"  - Avg Precision@{k}: {summary['avg_precision']:.4f}")
+        group_lines += [f"  - % with at least {t}/{k} correct: {summary['at_least'][t]:.2f}%" for t in THRESHOLDS]
+        group_lines.append(f"  - % with no correct diagnoses: {summary['zero']:.2f}%")
+        return group_lines
+
+    lines += ["", "--- Results by Diagnosis ---"]
+    for dx, summary in sorted(by_dx.items()):
+        lines += group(dx, summary)
+    if non_melanoma['count'] > 0:
+        lines += group("non-melanoma", non_melanoma, " [binary classification]")
+    lines.append("----------------------------")
+    return "\n".join(lines) + "\n"
+
+
+def build_index(spec, vectors):
+    """
+    Build a FAISS index from a factory string, optionally followed by search
+    parameters after a "|" (e.g. "IVF32,Flat|nprobe=8"). Returns the index
+    and its build (train + add) time in seconds.
+    """
+    factory, _, parameters = spec.partition('|')
+    started = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], factory)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    if parameters:
+        faiss.ParameterSpace().set_index_parameters(index, parameters)
+    return index, time.perf_counter() - started
+
+
+def sweep(reference_vectors, reference_ids, reference_labels, query_ids, query_vectors, query_labels,
+          k_values, index_specs):
+    """
+    Evaluate every index configuration at every k. Each index is searched once
+    at the largest k; smaller k are prefixes of that ranking. Recall is the
+    share of the exact (Flat) top-k that the index returned.
+    """
+    max_k = max(k_values)
+    exact, _ = build_index('Flat', reference_vectors)
+    exact_neighbours = search_neighbours(exact, reference_ids, query_ids, query_vectors, max_k)
+
+    rows = []
+    for spec in index_specs:
+        index, build_seconds = build_index(spec, reference_vectors)
+        started = time.perf_counter()
+        neighbours = search_neighbours(index, reference_ids, query_ids, query_vectors, max_k)
+        search_seconds = time.perf_counter() - started
+        retrieved = labels_of(neighbours, reference_labels)
+        bytes_per_vector = faiss.serialize_index(index).nbytes / max(index.ntotal, 1)
+
+        for k in sorted(k_values):
+            overall, by_dx, non_melanoma = evaluate(retrieved[:, :k], query_labels, k)
+            top_k = neighbours[:, :k]
+            found = (top_k[:, :, None] == exact_neighbours[:, None, :k]).any(axis=2) & (top_k >= 0)
+            rows.append({
+                'index': spec,
+                'k': k,
+                'precision': round(overall['avg_precision'], 6),
+                **{f'at_least_{t}': round(overall['at_least'][t], 4) for t in THRESHOLDS},
+                'zero_matches': round(overall['zero'], 4),
+                'non_melanoma_precision': round(non_melanoma['avg_precision'], 6),
+                'recall_vs_exact': round(float(found.mean()), 6),
+                'build_seconds': round(build_seconds, 4),
+                'search_seconds': round(search_seconds, 4),
+                'query_ms': round(search_seconds * 1000 / max(len(query_ids), 1), 4),
+                'bytes_per_vector': round(bytes_per_vector, 1),
+                'precision_by_dx': {dx: round(summary['avg_precision'], 6) for dx, summary in by_dx.items()},
+            })
+        print(f"{spec}: precision@{max_k} {rows[-1]['precision']:.4f}, recall {rows[-1]['recall_vs_exact']:.4f}, "
+              f"{rows[-1]['query_ms']:.3f} ms/query, {bytes_per_vector:.0f} bytes/vector")
+    return rows
+
+
+def write_sweep(rows, output_path, details):
+    """Write sweep rows as JSON (with `details`) or, for a .csv path, one CSV row per (index, k)"""
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if output_path.endswith('.csv'):
+        flat_rows = []
+        for row in rows:
+            flat = {key: value for key, value in row.items() if key != 'precision_by_dx'}
+            flat.update({f'precision_{dx}': value for dx, value in row['precision_by_dx'].items()})
+            flat_rows.append(flat)
+        pd.DataFrame(flat_rows).to_csv(output_path, index=False)
+    else:
+        with open(output_path, 'w') as f:
+            json.dump({**details, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': rows}, f, indent=2)
+    return output_path
+
 
-    # Get the directory of the current script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    project_root = os.path.abspath(os.path.join(script_dir, '..', '..'))
+def find_regressions(rows, baseline_path, max_drop):
+    """Describe each (index, k) whose precision fell by more than `max_drop` from a JSON baseline sweep"""
+    with open(baseline_path) as f:
+        baseline = {(row['index'], row['k']): row for row in json.load(f)['results']}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row['index'], row['k']))
+        if before is not None and row['precision'] < before['precision'] - max_drop:
+            regressions.append(f"{row['index']} precision@{row['k']}: "
+                               f"{before['precision']:.4f} -> {row['precision']:.4f}")
+    return regressions
+
+
+async def evaluate_ann(args):
+    """
+    Evaluates the ANN embeddings by calculating precision@k (k=9 by default)
+    and the share of queries with at least 3/5/6/8 neighbours of the same diagnosis.
+    """
+    print("Starting ANN evaluation script...")
+    started = time.time()
+    k = args.k
 
     # Load the model and FAISS service
     print("Loading model...")
-    model = load_model()
+    model_path = default_model_path()
+    model = load_model(model_path)
     print("Model loaded.")
 
     # Load embeddings into FAISS
@@ -36,257 +218,67 @@ async def evaluate_ann():
 
     # Load test data and metadata
     print("Loading test data and metadata...")
-    test_moles_df = pd.read_csv(os.path.join(script_dir, 'non_training_moles.csv'))
-    metadata_df = pd.read_csv(os.path.join(project_root, 'moles_data', 'HAM10000_metadata.csv'))
-    
-    # Create a mapping from image_id to diagnosis for quick lookup
-    image_id_to_dx = pd.Series(metadata_df.dx.values, index=metadata_df.image_id).to_dict()
-    
-    print(f"Loaded {len(test_moles_df)} test images and {len(metadata_df)} metadata records.")
-
-    precisions = []
-    not_found_images = []
-    results_by_dx = {}
-    at_least_3_matches_count = 0
-    at_least_5_matches_count = 0
-    at_least_6_matches_count = 0
-    at_least_8_matches_count = 0
-    zero_matches_count = 0
-    processed_count = 0
-
-    non_melanoma_group_results = {
-        'precisions': [], 'count': 0, 'at_least_3_matches': 0,
-        'at_least_5_matches': 0, 'at_least_6_matches': 0,
-        'at_least_8_matches': 0, 'zero_matches': 0
-    }
-
-    k = 9
-
-    for index, row in test_moles_df.iterrows():
-        query_image_id = row['image_id']
-        
-        image_path_1 = os.path.join(project_root, f'moles_data/HAM10000_images_part_1/{query_image_id}.jpg')
-        image_path_2 = os.path.join(project_root, f'moles_data/HAM10000_images_part_2/{query_image_id}.jpg')
-        
-        image_path = None
-        if os.path.exists(image_path_1):
-            image_path = image_path_1
-        elif os.path.exists(image_path_2):
-            image_path = image_path_2
-        else:
-            not_found_images.append(query_image_id)
-            continue
-            
-        print(f"\nProcessing {query_image_id}...")
-
-        # Get ground truth diagnosis
-        if query_image_id not in image_id_to_dx:
-            print(f"Warning: No metadata found for {query_image_id}. Skipping.")
-            continue
-        query_dx = image_id_to_dx[query_image_id]
-        processed_count += 1
-
-        # Read image and get embedding
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-        
-        _, embedding = inference(model, image_bytes)
-
-        # Find similar images (request k+1 because the image itself will be in the results)
-        similar_results = await faiss_service.find_similar_images(embedding, k=k + 1)
-        
-        # Exclude the query image itself from the results
-        retrieved_ids = [img_id for img_id, dist in similar_results if img_id != query_image_id][:k]
-        
-        if len(retrieved_ids) != k:
-             print(f"Warning: Expected {k} results for {query_image_id}, but got {len(retrieved_ids)}.")
-
-        # Calculate true positives
-        true_positives = sum(1 for res_id in retrieved_ids if image_id_to_dx.get(res_id) == query_dx)
-
-        if true_positives >= 3:
-            at_least_3_matches_count += 1
-        if true_positives >= 5:
-            at_least_5_matches_count += 1
-        if true_positives >= 6:
-            at_least_6_matches_count += 1
-        if true_positives >= 8:
-            at_least_8_matches_count += 1
-        if true_positives == 0:
-            zero_matches_count += 1
-
-        # Calculate Precision@k
-        precision_at_k = true_positives / k
-        precisions.append(precision_at_k)
-
-        # Store results by dx
-        if query_dx not in results_by_dx:
-            results_by_dx[query_dx] = {'precisions': [], 'count': 0, 'at_least_3_matches': 0, 'at_least_5_matches': 0, 'at_least_6_matches': 0, 'at_least_8_matches': 0, 'zero_matches': 0}
-        results_by_dx[query_dx]['precisions'].append(precision_at_k)
-        results_by_dx[query_dx]['count'] += 1
-        if true_positives >= 3:
-            results_by_dx[query_dx]['at_least_3_matches'] += 1
-        if true_positives >= 5:
-            results_by_dx[query_dx]['at_least_5_matches'] += 1
-        if true_positives >= 6:
-            results_by_dx[query_dx]['at_least_6_matches'] += 1
-        if true_positives >= 8:
-            results_by_dx[query_dx]['at_least_8_matches'] += 1
-        if true_positives == 0:
-            results_by_dx[query_dx]['zero_matches'] += 1
-
-        # For non-melanoma images, calculate binary performance (any non-melanoma is a match)
-        if query_dx != 'mel':
-            binary_true_positives = sum(1 for res_id in retrieved_ids if image_id_to_dx.get(res_id) != 'mel')
-            
-            non_melanoma_group_results['count'] += 1
-            precision_at_k_binary = binary_true_positives / k
-            non_melanoma_group_results['precisions'].append(precision_at_k_binary)
-
-            if binary_true_positives >= 3:
-                non_melanoma_group_results['at_least_3_matches'] += 1
-            if binary_true_positives >= 5:
-                non_melanoma_group_results['at_least_5_matches'] += 1
-            if binary_true_positives >= 6:
-                non_melanoma_group_results['at_least_6_matches'] += 1
-            if binary_true_positives >= 8:
-                non_melanoma_group_results['at_least_8_matches'] += 1
-            if binary_true_positives == 0:
-                non_melanoma_group_results['zero_matches'] += 1
-
-        print(f"  -> Query diagnosis: {query_dx}")
-        print(f"  -> Found {true_positives}/{k} similar moles with the same diagnosis.")
-        print(f"  -> Precision@{k}: {precision_at_k:.4f}")
-
-    # Calculate and print average metrics
-    avg_precision = np.mean(precisions) if precisions else 0
-    percent_at_least_3_matches = (at_least_3_matches_count / processed_count * 100) if processed_count > 0 else 0
-    percent_at_least_5_matches = (at_least_5_matches_count / processed_count * 100) if processed_count > 0 else 0
-    percent_at_least_6_matches = (at_least_6_matches_count / processed_count * 100) if processed_count > 0 else 0
-    percent_at_least_8_matches = (at_least_8_matches_count / processed_count * 100) if processed_count > 0 else 0
-    percent_zero_matches = (zero_matches_count / processed_count * 100) if processed_count > 0 else 0
-
-    # --- Calculate final non-melanoma group metrics ---
-    if non_melanoma_group_results['count'] > 0:
-        avg_precision_nm = np.mean(non_melanoma_group_results['precisions'])
-        count_nm = non_melanoma_group_results['count']
-        percent_at_least_3_nm = (non_melanoma_group_results['at_least_3_matches'] / count_nm * 100)
-        percent_at_least_5_nm = (non_melanoma_group_results['at_least_5_matches'] / count_nm * 100)
-        percent_at_least_6_nm = (non_melanoma_group_results['at_least_6_matches'] / count_nm * 100)
-        percent_at_least_8_nm = (non_melanoma_group_results['at_least_8_matches'] / count_nm * 100)
-        percent_zero_nm = (non_melanoma_group_results['zero_matches'] / count_nm * 100)
+    dataset = load_dataset()
+    if args.queries:
+        test_ids = pd.read_csv(args.queries)['image_id'].tolist()
+    else:
+        # Images the model was not trained on (what create_non_training_set.py writes)
+        test_ids = dataset.ids(splits=['test', 'unused'], labeled=True).tolist()
+    print(f"Loaded {len(test_ids)} test images and {len(dataset)} metadata records.")
+
+    query_ids, _, query_vectors, not_found_images = cached_embeddings(
+        model, weights_version(model_path), test_ids, args.batch_size, args.workers
+    )
+
+    # Ground truth; queries without metadata are left out
+    query_labels = dataset.diagnoses(query_ids)
+    has_metadata = query_labels != ''
+    for image_id in np.asarray(query_ids)[~has_metadata]:
+        print(f"Warning: No metadata found for {image_id}. Skipping.")
+    query_ids = np.asarray(query_ids)[has_metadata]
+    query_vectors = query_vectors[has_metadata]
+    query_labels = query_labels[has_metadata]
+
+    # Diagnoses of the indexed reference images, aligned with the index rows ('' when unknown)
+    reference_ids = np.asarray(faiss_service.image_ids)
+    reference_labels = dataset.diagnoses(reference_ids)
+
+    if args.sweep:
+        reference_vectors = faiss_service.index.reconstruct_n(0, faiss_service.index.ntotal)
+        rows = sweep(reference_vectors, reference_ids, reference_labels, query_ids, query_vectors, query_labels,
+                     args.k_values, args.index)
+        output_path = write_sweep(rows, args.output, {
+            'model_version': weights_version(model_path),
+            'queries': len(query_ids),
+            'references': len(reference_ids),
+        })
+        print(f"\nSweep took {time.time() - started:.1f}s; results have been saved to {output_path}")
+        if args.baseline:
+            regressions = find_regressions(rows, args.baseline, args.max_precision_drop)
+            for regression in regressions:
+                print(f"REGRESSION: {regression}")
+            if regressions:
+                sys.exit(1)
+            print(f"No precision drop larger than {args.max_precision_drop} against {args.baseline}")
+        return
 
+    neighbours = search_neighbours(faiss_service.index, reference_ids, query_ids, query_vectors, k)
+    retrieved = labels_of(neighbours, reference_labels)
+    overall, by_dx, non_melanoma = evaluate(retrieved, query_labels, k)
+    report = format_report(overall, by_dx, non_melanoma, not_found_images, k)
 
     # --- Output results to a file ---
-    results_dir = os.path.join(script_dir, 'results')
+    results_dir = os.path.join(SCRIPT_DIR, 'results')
     os.makedirs(results_dir, exist_ok=True)
     results_file_path = os.path.join(results_dir, 'ann_evaluation_results.txt')
-
     with open(results_file_path, 'w') as f:
-        f.write("--- Evaluation Summary ---\n")
-        f.write(f"Processed {processed_count} test images.\n")
-        f.write(f"Average Precision@{k}: {avg_precision:.4f}\n")
-        f.write(f"% with at least 3/9 correct diagnoses: {percent_at_least_3_matches:.2f}%\n")
-        f.write(f"% with at least 5/9 correct diagnoses: {percent_at_least_5_matches:.2f}%\n")
-        f.write(f"% with at least 6/9 correct diagnoses: {percent_at_least_6_matches:.2f}%\n")
-        f.write(f"% with at least 8/9 correct diagnoses: {percent_at_least_8_matches:.2f}%\n")
-        f.write(f"% with no correct diagnoses: {percent_zero_matches:.2f}%\n")
-        f.write("--------------------------\n")
-
-        if not_found_images:
-            f.write("\n--- Images Not Found ---\n")
-            for image_id in sorted(not_found_images):
-                f.write(f"  - {image_id}\n")
-            f.write("--------------------------\n")
-
-        f.write("\n--- Results by Diagnosis ---\n")
-        # Add non-melanoma to the list of diagnoses to print, but handle it separately
-        sorted_dx = sorted(results_by_dx.items())
-        
-        for dx, data in sorted_dx:
-            avg_precision_dx = np.mean(data['precisions'])
-            count = data['count']
-            percent_at_least_3_dx = (data['at_least_3_matches'] / count * 100) if count > 0 else 0
-            percent_at_least_5_dx = (data['at_least_5_matches'] / count * 100) if count > 0 else 0
-            percent_at_least_6_dx = (data['at_least_6_matches'] / count * 100) if count > 0 else 0
-            percent_at_least_8_dx = (data['at_least_8_matches'] / count * 100) if count > 0 else 0
-            percent_zero_dx = (data['zero_matches'] / count * 100) if count > 0 else 0
-
-            f.write(f"\nDiagnosis: {dx} ({count} samples)\n")
-            f.write(f"  - Avg Precision@{k}: {avg_precision_dx:.4f}\n")
-            f.write(f"  - % with at least 3/9 correct: {percent_at_least_3_dx:.2f}%\n")
-            f.write(f"  - % with at least 5/9 correct: {percent_at_least_5_dx:.2f}%\n")
-            f.write(f"  - % with at least 6/9 correct: {percent_at_least_6_dx:.2f}%\n")
-            f.write(f"  - % with at least 8/9 correct: {percent_at_least_8_dx:.2f}%\n")
-            f.write(f"  - % with no correct diagnoses: {percent_zero_dx:.2f}%\n")
-        
-        # --- Write non-melanoma group results to file ---
-        if non_melanoma_group_results['count'] > 0:
-            f.write(f"\nDiagnosis: non-melanoma ({count_nm} samples) [binary classification]\n")
-            f.write(f"  - Avg Precision@{k}: {avg_precision_nm:.4f}\n")
-            f.write(f"  - % with at least 3/9 correct: {percent_at_least_3_nm:.2f}%\n")
-            f.write(f"  - % with at least 5/9 correct: {percent_at_least_5_nm:.2f}%\n")
-            f.write(f"  - % with at least 6/9 correct: {percent_at_least_6_nm:.2f}%\n")
-            f.write(f"  - % with at least 8/9 correct: {percent_at_least_8_nm:.2f}%\n")
-            f.write(f"  - % with no correct diagnoses: {percent_zero_nm:.2f}%\n")
-
-        f.write("----------------------------\n")
+        f.write(report)
 
+    print("\n" + report)
+    print(f"Evaluation took {time.time() - started:.1f}s")
     print(f"\nResults have been saved to {results_file_path}")
 
 
-    print("\n--- Evaluation Summary ---")
-    print(f"Processed {processed_count} test images.")
-    print(f"Average Precision@{k}: {avg_precision:.4f}")
-    print(f"% with at least 3/9 correct diagnoses: {percent_at_least_3_matches:.2f}%")
-    print(f"% with at least 5/9 correct diagnoses: {percent_at_least_5_matches:.2f}%")
-    print(f"% with at least 6/9 correct diagnoses: {percent_at_least_6_matches:.2f}%")
-    print(f"% with at least 8/9 correct diagnoses: {percent_at_least_8_matches:.2f}%")
-    print(f"% with no correct diagnoses: {percent_zero_matches:.2f}%")
-    print("--------------------------")
-
-    if not_found_images:
-        print("\n--- Images Not Found ---")
-        for image_id in sorted(not_found_images):
-            print(f"  - {image_id}")
-        print("--------------------------")
-
-    print("\n--- Results by Diagnosis ---")
-    # Add non-melanoma to the list of diagnoses to print, but handle it separately
-    sorted_dx = sorted(results_by_dx.items())
-    
-    for dx, data in sorted_dx:
-        avg_precision_dx = np.mean(data['precisions'])
-        count = data['count']
-        percent_at_least_3_dx = (data['at_least_3_matches'] / count * 100) if count > 0 else 0
-        percent_at_least_5_dx = (data['at_least_5_matches'] / count * 100) if count > 0 else 0
-        percent_at_least_6_dx = (data['at_least_6_matches'] / count * 100) if count > 0 else 0
-        percent_at_least_8_dx = (data['at_least_8_matches'] / count * 100) if count > 0 else 0
-        percent_zero_dx = (data['zero_matches'] / count * 100) if count > 0 else 0
-
-        print(f"\nDiagnosis: {dx} ({count} samples)")
-        print(f"  - Avg Precision@{k}: {avg_precision_dx:.4f}")
-        print(f"  - % with at least 3/9 correct: {percent_at_least_3_dx:.2f}%")
-        print(f"  - % with at least 5/9 correct: {percent_at_least_5_dx:.2f}%")
-        print(f"  - % with at least 6/9 correct: {percent_at_least_6_dx:.2f}%")
-        print(f"  - % with at least 8/9 correct: {percent_at_least_8_dx:.2f}%")
-        print(f"  - % with no correct diagnoses: {percent_zero_dx:.2f}%")
-    
-    # --- Print non-melanoma group results to console ---
-    if non_melanoma_group_results['count'] > 0:
-        print(f"\nDiagnosis: non-melanoma ({count_nm} samples) [binary classification]")
-        print(f"  - Avg Precision@{k}: {avg_precision_nm:.4f}")
-        print(f"  - % with at least 3/9 correct: {percent_at_least_3_nm:.2f}%")
-        print(f"  - % with at least 5/9 correct: {percent_at_least_5_nm:.2f}%")
-        print(f"  - % with at least 6/9 correct: {percent_at_least_6_nm:.2f}%")
-        print(f"  - % with at least 8/9 correct: {percent_at_least_8_nm:.2f}%")
-        print(f"  - % with no correct diagnoses: {percent_zero_nm:.2f}%")
-
-    print("----------------------------")
-    if os.path.exists(results_file_path):
-        print(f"\nResults have been saved to {results_file_path}")
-
-
 if __name__ == "__main__":
     dotenv_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
     if os.path.exists(dotenv_path):
@@ -294,5 +286,26 @@ if __name__ == "__main__":
         print(f"Loaded .env file from {dotenv_path}")
     else:
         print(".env file not found at project root, relying on environment variables.")
-        
-    asyncio.run(evaluate_ann())
+
+    parser = argparse.ArgumentParser(description="Evaluate similar-mole retrieval on the non-training images")
+    parser.add_argument('--queries', help="CSV with an image_id column (default: every image not used for training)")
+    parser.add_argument('--k', type=int, default=9, help="Neighbours retrieved per query")
+    parser.add_argument('--batch-size', type=int, default=64, help="Query images per forward pass")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Decode worker processes for query images missing from the embedding cache")
+    parser.add_argument('--sweep', action='store_true',
+                        help="Evaluate several k and index configurations and write machine-readable results")
+    parser.add_argument('--k-values', type=lambda value: [int(k) for k in value.split(',')], default=DEFAULT_SWEEP_K,
+                        help="Comma-separated k values for --sweep")
+    parser.add_argument('--index', action='append',
+                        help="faiss index factory string for --sweep, optionally with '|search params' "
+                             "(repeatable; default: %s)" % ', '.join(DEFAULT_SWEEP_INDEXES))
+    parser.add_argument('--output', default=os.path.join(SCRIPT_DIR, 'results', 'ann_sweep.json'),
+                        help="Sweep results file (.json or .csv)")
+    parser.add_argument('--baseline', help="Earlier JSON sweep to compare against; exits with 1 on a regression")
+    parser.add_argument('--max-precision-drop', type=float, default=0.01,
+                        help="Largest precision drop against --baseline that is not a regression")
+
+    args = parser.parse_args()
+    args.index = args.index or DEFAULT_SWEEP_INDEXES
+    asyncio.run(evaluate_ann(args))
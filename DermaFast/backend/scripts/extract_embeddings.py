@@ -0,0 +1,158 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+# Add project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from backend.app.ml_model import load_model, preprocess, default_model_path
+from backend.app.model_registry import weights_version
+from dataset_manifest import DEFAULT_DATA_DIR, IMAGE_DIRS, load_dataset
+from embedding_shards import ShardWriter, load_manifest, load_shards
+
+# The embedding cache is compacted once the runs of cached_embeddings have left more shards than this
+CACHE_MAX_SHARDS = 8
+
+
+def default_shard_dir(model_version, data_dir=DEFAULT_DATA_DIR):
+    """Where extract_embeddings.py writes the shards of a model version by default"""
+    return os.path.join(data_dir, 'embeddings', model_version)
+
+
+class ImageFiles(Dataset):
+    """Decodes images from disk; runs in the DataLoader's worker processes"""
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        image_id, path = self.items[index]
+        try:
+            with open(path, 'rb') as f:
+                return image_id, preprocess(f.read()), None
+        except Exception as e:
+            return image_id, None, str(e)
+
+
+def collate(samples):
+    """Stack the decoded images of a batch and pass decode failures through"""
+    decoded = [(image_id, tensor) for image_id, tensor, _ in samples if tensor is not None]
+    failed = {image_id: error for image_id, _, error in samples if error is not None}
+    image_ids = [image_id for image_id, _ in decoded]
+    batch = torch.stack([tensor for _, tensor in decoded]) if decoded else None
+    return image_ids, batch, failed
+
+
+def embed_into(writer, model, items, batch_size, workers):
+    """
+    Decode the (image_id, path) `items` in `workers` processes, embed them in
+    batches and add them to `writer`. Returns {image_id: error} for the images
+    that could not be decoded.
+    """
+    loader = DataLoader(ImageFiles(items), batch_size=batch_size, num_workers=workers, collate_fn=collate)
+    failed = {}
+    processed = 0
+    started = time.time()
+    with torch.no_grad():
+        for image_ids, batch, batch_failed in loader:
+            failed.update(batch_failed)
+            if batch is not None:
+                classifications, embeddings = model(batch)
+                writer.add(image_ids, classifications.numpy(), embeddings.numpy())
+            processed += len(image_ids) + len(batch_failed)
+            elapsed = time.time() - started
+            print(f"Processed {processed}/{len(items)} images ({processed / elapsed:.1f} images/sec)")
+    return failed
+
+
+def cached_embeddings(model, model_version, image_ids, batch_size, workers, data_dir=DEFAULT_DATA_DIR):
+    """
+    Classifications and embeddings for `image_ids`, read memory-mapped from the
+    shard directory of this model version, which acts as a cache keyed by image
+    ID and weights hash. Only images missing from it are decoded and embedded,
+    and they are added to it for the next run.
+
+    Returns the IDs found (in row order), their classifications and embeddings
+    as float32 arrays, and the IDs whose image was not found.
+    """
+    cache_dir = default_shard_dir(model_version, data_dir)
+    writer = ShardWriter(cache_dir, model_version)
+    cached = writer.done_ids()
+    image_paths = load_dataset(data_dir).image_paths()
+
+    missing = [(image_id, image_paths[image_id]) for image_id in dict.fromkeys(image_ids)
+               if image_id not in cached and image_id in image_paths]
+    not_found = [image_id for image_id in image_ids if image_id not in cached and image_id not in image_paths]
+    print(f"{len(image_ids) - len(missing) - len(not_found)} embeddings cached in {cache_dir}, "
+          f"{len(missing)} to compute")
+
+    if missing:
+        failed = embed_into(writer, model, missing, batch_size, workers)
+        writer.flush()
+        for image_id, error in failed.items():
+            print(f"Warning: Could not decode {image_id} ({error}). Skipping.")
+
+    # Each run appends a small shard; merge them before they pile up
+    if len(writer.manifest['shards']) > CACHE_MAX_SHARDS:
+        print(f"Compacting {len(writer.manifest['shards'])} shards in {cache_dir}")
+        writer.compact()
+
+    if load_manifest(cache_dir) is None:
+        return [], np.zeros(0, dtype=np.float32), np.zeros((0, 0), dtype=np.float32), not_found
+    cache_ids, cache_classifications, cache_embeddings = load_shards(cache_dir)
+    row_of = {image_id: row for row, image_id in enumerate(cache_ids.tolist())}
+    found_ids = [image_id for image_id in image_ids if image_id in row_of]
+    rows = [row_of[image_id] for image_id in found_ids]
+    return (found_ids, np.asarray(cache_classifications[rows], dtype=np.float32),
+            np.ascontiguousarray(cache_embeddings[rows], dtype=np.float32), not_found)
+
+
+def extract_embeddings(args):
+    """
+    Embed every local HAM10000 image with BasicCNN and write the embeddings,
+    classifications and image IDs to memory-mappable shards.
+    """
+    model_path = args.model_path or default_model_path()
+    model_version = weights_version(model_path)
+    shard_dir = args.output_dir or default_shard_dir(model_version, args.data_dir)
+    print(f"Model version {model_version} ({model_path})")
+    model = load_model(model_path)
+
+    images = load_dataset(args.data_dir).image_paths()
+    print(f"Found {len(images)} images under {args.data_dir}")
+
+    writer = ShardWriter(shard_dir, model_version, shard_size=args.shard_size,
+                         sources=[os.path.join(args.data_dir, image_dir) for image_dir in IMAGE_DIRS])
+    done = writer.done_ids()
+    items = [(image_id, path) for image_id, path in sorted(images.items()) if image_id not in done]
+    if done:
+        print(f"Resuming: {len(done)} images already in {shard_dir}")
+    print(f"Embedding {len(items)} images with {args.workers} decode workers...")
+
+    failed = embed_into(writer, model, items, args.batch_size, args.workers)
+
+    writer.close(failed)
+    print(f"\nWrote {writer.manifest['count']} embeddings in {len(writer.manifest['shards'])} shards to {shard_dir}")
+    if failed:
+        print(f"{len(failed)} images could not be decoded (listed in the manifest).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the local HAM10000 images into .npy shards")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help="Directory holding HAM10000_images_part_1 and _part_2")
+    parser.add_argument('--output-dir', help="Shard directory (default: <data-dir>/embeddings/<model version>)")
+    parser.add_argument('--model-path', help="Weights to embed with (default: the bundled weights)")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Decode worker processes")
+    parser.add_argument('--shard-size', type=int, default=4096, help="Images per shard")
+
+    extract_embeddings(parser.parse_args())
@@ -1,4 +1,4 @@
-
+import argparse
 import os
 import sys
 from dotenv import load_dotenv
@@ -6,92 +6,91 @@ from dotenv import load_dotenv
 # Add project root to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 
-from backend.app.ml_model import load_model, inference
+from backend.app.ml_model import load_model, default_model_path
+from backend.app.model_registry import weights_version
 from backend.app.supabase_client import supabase_client as supabase
+from embedding_pipeline import BUCKET_NAME, RESULTS_DIR, Checkpoint, EmbeddingPipeline
+
+DEFAULT_CHECKPOINT = os.path.join(RESULTS_DIR, 'populate_checkpoint.json')
+
+PAGE_SIZE = 1000
+
+
+def list_bucket_image_ids():
+    """All image IDs in the comparison bucket (storage lists at most one page per call)"""
+    image_ids = []
+    offset = 0
+    while True:
+        files = supabase.storage.from_(BUCKET_NAME).list(
+            options={'limit': PAGE_SIZE, 'offset': offset, 'sortBy': {'column': 'name', 'order': 'asc'}}
+        )
+        for file in files:
+            image_name = file['name']
+            if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                image_ids.append(os.path.splitext(image_name)[0])
+            else:
+                print(f"Skipping non-image file: {image_name}")
+        if len(files) < PAGE_SIZE:
+            return image_ids
+        offset += PAGE_SIZE
+
 
-def populate_embeddings():
+def list_metadata_image_ids():
+    """All image IDs that have a ham_metadata row"""
+    image_ids = set()
+    start = 0
+    while True:
+        response = supabase.table('ham_metadata').select('image_id').order('image_id') \
+            .range(start, start + PAGE_SIZE - 1).execute()
+        image_ids.update(row['image_id'] for row in response.data)
+        if len(response.data) < PAGE_SIZE:
+            return image_ids
+        start += PAGE_SIZE
+
+
+def populate_embeddings(args):
     """
     Populates the 'embedding' column in the 'ham_metadata' table for images
     in the 'HAM10000_for_comparison' bucket.
     """
     print("Starting script to populate embeddings...")
 
-    # Load the model
-    # The path is relative to the project root
-    model_path = 'backend/app/ml_model/model_weights.pkl'
+    model_path = args.model_path or default_model_path()
     print(f"Loading model from {model_path}...")
     try:
         model = load_model(model_path=model_path)
-        print("Model loaded successfully.")
+        model_version = weights_version(model_path)
+        print(f"Model loaded successfully (version {model_version}).")
     except Exception as e:
         print(f"Error loading model: {e}")
         return
 
-    # Define bucket name
-    bucket_name = 'HAM10000_for_comparison'
-    print(f"Accessing bucket: {bucket_name}")
-
+    print(f"Accessing bucket: {BUCKET_NAME}")
     try:
-        # List files in the bucket
-        files = supabase.storage.from_(bucket_name).list()
-        print(f"Found {len(files)} files in the bucket.")
-
-        for i, file in enumerate(files):
-            image_name = file['name']
-            
-            # Skip non-image files
-            if not image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                print(f"Skipping non-image file: {image_name}")
-                continue
-
-            image_id = os.path.splitext(image_name)[0]
-            
-            print(f"Processing file {i + 1}/{len(files)}: {image_name} (image_id: {image_id})")
-
-            # Download image
-            try:
-                image_bytes = supabase.storage.from_(bucket_name).download(image_name)
-                if image_bytes is None:
-                    print(f"  -> Failed to download {image_name}.")
-                    continue
-                print(f"  -> Downloaded {image_name}.")
-            except Exception as e:
-                print(f"  -> An error occurred during download for {image_name}: {e}")
-                continue
-
-            # Get embedding
-            try:
-                _, embedding = inference(model, image_bytes)
-                print(f"  -> Generated embedding with {len(embedding)} dimensions.")
-            except Exception as e:
-                print(f"  -> Error during inference for {image_name}: {e}")
-                continue
-
-            # Update database
-            try:
-                update_response = supabase.table('ham_metadata').update({'embedding': embedding}).eq('image_id', image_id).execute()
-                
-                if hasattr(update_response, 'error') and update_response.error:
-                     print(f"  -> Supabase error updating record for {image_id}: {update_response.error}")
-                elif not update_response.data:
-                    print(f"  -> No record found for image_id '{image_id}' in ham_metadata table.")
-                else:
-                    print(f"  -> Supabase reports successful update for {image_id}.")
-                    
-                    # Verification step
-                    try:
-                        verify_response = supabase.table('ham_metadata').select('embedding').eq('image_id', image_id).execute()
-                        if verify_response.data and verify_response.data[0].get('embedding') is not None:
-                            print(f"  -> VERIFIED: Embedding is present for {image_id}.")
-                        else:
-                            print(f"  -> VERIFICATION FAILED: Embedding is NULL for {image_id} after update.")
-                    except Exception as e:
-                        print(f"  -> Error during verification for {image_id}: {e}")
-
-            except Exception as e:
-                print(f"  -> An error occurred while updating the database for {image_id}: {e}")
-
-        print("\nEmbedding population script finished.")
+        bucket_ids = list_bucket_image_ids()
+        print(f"Found {len(bucket_ids)} images in the bucket.")
+
+        # Upserts would create rows for images without metadata, so leave those out
+        known_ids = list_metadata_image_ids()
+        missing = [image_id for image_id in bucket_ids if image_id not in known_ids]
+        if missing:
+            print(f"Skipping {len(missing)} images with no record in ham_metadata (e.g. {missing[0]}).")
+
+        checkpoint = Checkpoint(args.checkpoint, model_version)
+        to_embed = list(checkpoint.pending(
+            (image_id for image_id in bucket_ids if image_id in known_ids), retry_failed=args.retry_failed
+        ))
+        print(f"{len(to_embed)} images to embed "
+              f"({len(checkpoint.completed)} already done according to {args.checkpoint}).")
+
+        pipeline = EmbeddingPipeline(model, model_version, batch_size=args.batch_size,
+                                     download_workers=args.download_workers)
+        stats = pipeline.run(to_embed, checkpoint)
+
+        print(f"\nEmbedding population script finished: {stats['written']} written, {stats['failed']} failed "
+              f"in {stats['seconds']}s ({stats['images_per_second']} images/sec).")
+        if checkpoint.failed:
+            print(f"{len(checkpoint.failed)} images failed; rerun with --retry-failed to try them again.")
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -105,5 +104,13 @@ if __name__ == "__main__":
         print(f"Loaded .env file from {dotenv_path}")
     else:
         print(".env file not found at project root, relying on environment variables.")
-        
-    populate_embeddings()
+
+    parser = argparse.ArgumentParser(description="Compute embeddings for the HAM10000 comparison images")
+    parser.add_argument('--model-path', help="Weights to embed with (default: the bundled weights)")
+    parser.add_argument('--batch-size', type=int, default=64, help="Images per forward pass and per upsert")
+    parser.add_argument('--download-workers', type=int, default=16, help="Concurrent downloads")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                        help="Progress file; image IDs recorded there are skipped on reruns")
+    parser.add_argument('--retry-failed', action='store_true', help="Retry images that failed in an earlier run")
+
+    populate_embeddings(parser.parse_args())
@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import sys
+import urllib.request
+from dotenv import load_dotenv
+
+# Add project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from backend.app.ml_model import load_model, default_model_path
+from backend.app.model_registry import weights_version
+from backend.app.supabase_client import supabase_client as supabase
+from embedding_pipeline import RESULTS_DIR, Checkpoint, EmbeddingPipeline
+
+DEFAULT_CHECKPOINT = os.path.join(RESULTS_DIR, 'reembed_checkpoint.json')
+
+PAGE_SIZE = 1000
+
+
+def stale_image_ids(version, include_missing):
+    """
+    Yield, ordered by image_id, the ham_metadata rows whose embedding was not
+    computed by `version`. Pages are fetched by keyset (image_id > last seen),
+    served by idx_ham_metadata_embedding_version, so rows re-embedded while
+    the scan runs don't shift later pages.
+    """
+    after = None
+    while True:
+        query = supabase.table('ham_metadata').select('image_id').or_(
+            f'embedding_version.is.null,embedding_version.neq.{version}'
+        )
+        if not include_missing:
+            query = query.not_.is_('embedding', 'null')
+        if after:
+            query = query.gt('image_id', after)
+        rows = query.order('image_id').limit(PAGE_SIZE).execute().data
+        for row in rows:
+            yield row['image_id']
+        if len(rows) < PAGE_SIZE:
+            return
+        after = rows[-1]['image_id']
+
+
+def trigger_index_refresh(api_url, admin_token):
+    request = urllib.request.Request(
+        f"{api_url.rstrip('/')}/admin/faiss/refresh",
+        method='POST',
+        headers={'Authorization': f'Bearer {admin_token}'},
+    )
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())
+
+
+def reembed_stale(args):
+    """
+    Recompute ham_metadata embeddings that were produced by another model
+    version (or, with --include-missing, never computed), then ask the API to
+    rebuild its FAISS index.
+    """
+    model_path = args.model_path or default_model_path()
+    version = weights_version(model_path)
+    print(f"Target model version {version} ({model_path})")
+    model = load_model(model_path)
+
+    # Re-embedded rows drop out of the stale scan by themselves; the checkpoint
+    # keeps rows that failed from being retried on every run
+    checkpoint = Checkpoint(args.checkpoint, version)
+    pipeline = EmbeddingPipeline(model, version, batch_size=args.batch_size,
+                                 download_workers=args.download_workers)
+    stats = pipeline.run(
+        checkpoint.pending(stale_image_ids(version, args.include_missing), retry_failed=args.retry_failed),
+        checkpoint,
+    )
+    print(f"Re-embedding finished: {stats['written']} rows updated, {stats['failed']} failed "
+          f"in {stats['seconds']}s ({stats['images_per_second']} images/sec).")
+    if checkpoint.failed:
+        print(f"{len(checkpoint.failed)} rows failed; rerun with --retry-failed to try them again.")
+
+    if args.api_url and args.admin_token:
+        print(f"Refreshing FAISS index at {args.api_url}...")
+        print(f"  -> {trigger_index_refresh(args.api_url, args.admin_token)}")
+        print("  The request reached one API worker; the others rebuild their index on their next "
+              "search once it is stale (within FAISS_STALE_RELOAD_SECONDS).")
+    else:
+        print("Set DERMAFAST_API_URL and DERMAFAST_ADMIN_TOKEN (or pass --api-url/--admin-token) "
+              "to refresh the API's FAISS index automatically.")
+
+
+if __name__ == "__main__":
+    dotenv_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path=dotenv_path)
+        print(f"Loaded .env file from {dotenv_path}")
+    else:
+        print(".env file not found at project root, relying on environment variables.")
+
+    parser = argparse.ArgumentParser(description="Re-embed ham_metadata rows computed by another model version")
+    parser.add_argument('--model-path', help="Weights to embed with (default: the bundled weights)")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--download-workers', type=int, default=16)
+    parser.add_argument('--include-missing', action='store_true',
+                        help="Also embed rows that have no embedding yet")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Retry rows that failed in an earlier run")
+    parser.add_argument('--api-url', default=os.getenv('DERMAFAST_API_URL'))
+    parser.add_argument('--admin-token', default=os.getenv('DERMAFAST_ADMIN_TOKEN'))
+
+    reembed_stale(parser.parse_args())
@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import sys
+import pandas as pd
+import numpy as np
+
+# Add project root to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from backend.app.ml_model import load_model, default_model_path
+from backend.app.model_registry import weights_version
+from backend.app.recommendation import DERMATOLOGIST_CNN_THRESHOLD, SURGEON_CNN_THRESHOLD
+from dataset_manifest import load_dataset
+from extract_embeddings import cached_embeddings
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Thresholds save_similar_moles uses: dermatologist above LOW, plastic surgeon from HIGH
+CURRENT_TIER_THRESHOLDS = (DERMATOLOGIST_CNN_THRESHOLD, SURGEON_CNN_THRESHOLD)
+DEFAULT_REPORT_THRESHOLDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+
+
+def threshold_curves(scores, labels):
+    """
+    Confusion counts, ROC and PR points for every distinct score used as the
+    threshold (predict melanoma when score >= threshold), from one sort and
+    two cumulative sums. Thresholds are returned in decreasing order.
+    """
+    order = np.argsort(-scores, kind='stable')
+    sorted_scores = scores[order]
+    sorted_labels = labels[order]
+
+    # Last position of each run of equal scores: everything up to it is predicted positive
+    last_of_run = np.r_[np.nonzero(np.diff(sorted_scores))[0], len(sorted_scores) - 1]
+    tp = np.cumsum(sorted_labels)[last_of_run]
+    fp = (last_of_run + 1) - tp
+    positives = int(labels.sum())
+    negatives = len(labels) - positives
+    fn = positives - tp
+    tn = negatives - fp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.where(positives > 0, tp / max(positives, 1), 0.0)
+        fpr = np.where(negatives > 0, fp / max(negatives, 1), 0.0)
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+
+    # Trapezoidal areas, starting the curves at the origin
+    roc_tpr, roc_fpr = np.r_[0.0, tpr], np.r_[0.0, fpr]
+    roc_auc = float(np.sum(np.diff(roc_fpr) * (roc_tpr[1:] + roc_tpr[:-1]) / 2))
+
+    return {
+        'thresholds': sorted_scores[last_of_run],
+        'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+        'tpr': tpr, 'fpr': fpr, 'precision': precision, 'recall': tpr, 'f1': f1,
+        'roc_auc': roc_auc,
+        'average_precision': float(np.sum(np.diff(np.r_[0.0, tpr]) * precision)),
+    }
+
+
+def confusion_at(scores, labels, thresholds):
+    """Confusion counts at the given thresholds (score >= threshold is positive)"""
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    positive_scores = np.sort(scores[labels])
+    negative_scores = np.sort(scores[~labels])
+    tp = len(positive_scores) - np.searchsorted(positive_scores, thresholds, side='left')
+    fp = len(negative_scores) - np.searchsorted(negative_scores, thresholds, side='left')
+    return {'thresholds': thresholds, 'tp': tp, 'fp': fp,
+            'fn': len(positive_scores) - tp, 'tn': len(negative_scores) - fp}
+
+
+def tier_distribution(scores, labels, pairs):
+    """
+    Share of images, and of melanomas, that the CNN score alone would put in
+    each recommendation tier for each (low, high) pair: plastic surgeon when
+    score >= high, dermatologist when low < score < high, monitoring otherwise.
+    """
+    pairs = np.asarray(pairs, dtype=np.float64)
+    low, high = pairs[:, 0], pairs[:, 1]
+    rows = []
+    for name, group in (('all', scores), ('melanoma', scores[labels])):
+        ordered = np.sort(group)
+        n = max(len(ordered), 1)
+        surgeon = len(ordered) - np.searchsorted(ordered, high, side='left')
+        above_low = len(ordered) - np.searchsorted(ordered, low, side='right')
+        dermatologist = np.maximum(above_low - surgeon, 0)
+        monitoring = len(ordered) - surgeon - dermatologist
+        rows.append({
+            f'{name}_surgeon': surgeon / n * 100,
+            f'{name}_dermatologist': dermatologist / n * 100,
+            f'{name}_monitoring': monitoring / n * 100,
+        })
+    return [
+        {'low': float(low[i]), 'high': float(high[i]),
+         **{key: round(float(values[i]), 2) for row in rows for key, values in row.items()}}
+        for i in range(len(pairs))
+    ]
+
+
+def parse_pairs(value):
+    return [tuple(float(t) for t in pair.split(':')) for pair in value.split(',')]
+
+
+def threshold_sweep(args):
+    """
+    Score a labeled image set once (reusing cached classifications) and report
+    metrics at every threshold plus the recommendation-tier split of candidate
+    threshold pairs.
+    """
+    model_path = default_model_path()
+    model = load_model(model_path)
+
+    dataset = load_dataset()
+    if args.images:
+        image_ids = pd.read_csv(args.images)['image_id'].tolist()
+    else:
+        image_ids = dataset.ids(splits=['test', 'unused'], labeled=True).tolist()
+
+    image_ids, scores, _, not_found = cached_embeddings(
+        model, weights_version(model_path), image_ids, args.batch_size, args.workers
+    )
+    if not_found:
+        print(f"{len(not_found)} images were not found and are left out.")
+    dx = dataset.diagnoses(image_ids)
+    has_label = dx != ''
+    scores = scores[has_label].astype(np.float64)
+    labels = dx[has_label] == 'mel'
+    print(f"Scored {len(scores)} labeled images ({int(labels.sum())} melanoma).")
+
+    curves = threshold_curves(scores, labels)
+    best = int(np.argmax(curves['f1']))
+    print(f"ROC AUC: {curves['roc_auc']:.4f}   Average precision: {curves['average_precision']:.4f}")
+    print(f"Best F1 {curves['f1'][best]:.4f} at threshold {curves['thresholds'][best]:.4f} "
+          f"(precision {curves['precision'][best]:.4f}, recall {curves['recall'][best]:.4f})")
+
+    table = confusion_at(scores, labels, args.thresholds)
+    print("\nthreshold     tn     fp     fn     tp  precision  recall      f1")
+    for i, threshold in enumerate(table['thresholds']):
+        tp, fp, fn, tn = (int(table[key][i]) for key in ('tp', 'fp', 'fn', 'tn'))
+        precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+        recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+        print(f"{threshold:9.2f} {tn:6d} {fp:6d} {fn:6d} {tp:6d} {precision:10.4f} {recall:7.4f} {f1:7.4f}")
+
+    tiers = tier_distribution(scores, labels, args.pairs)
+    print("\n  low   high   surgeon  dermatologist  monitoring   melanoma: surgeon  dermatologist  monitoring")
+    for row in tiers:
+        print(f"{row['low']:5.2f} {row['high']:6.2f} {row['all_surgeon']:8.2f}% {row['all_dermatologist']:13.2f}% "
+              f"{row['all_monitoring']:10.2f}% {row['melanoma_surgeon']:18.2f}% "
+              f"{row['melanoma_dermatologist']:13.2f}% {row['melanoma_monitoring']:10.2f}%")
+
+    results = {
+        'model_version': weights_version(model_path),
+        'images': len(scores),
+        'melanoma': int(labels.sum()),
+        'roc_auc': curves['roc_auc'],
+        'average_precision': curves['average_precision'],
+        'best_f1': {'threshold': float(curves['thresholds'][best]), 'f1': float(curves['f1'][best])},
+        'curves': {key: np.asarray(value).tolist() for key, value in curves.items()
+                   if key not in ('roc_auc', 'average_precision')},
+        'confusion': {key: np.asarray(value).tolist() for key, value in table.items()},
+        'tiers': tiers,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f)
+    print(f"\nResults have been saved to {args.output}")
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        fig, (ax_threshold, ax_roc, ax_pr) = plt.subplots(1, 3, figsize=(18, 5))
+        for key, label in (('precision', 'Precision'), ('recall', 'Recall'), ('f1', 'F1-Score')):
+            ax_threshold.plot(curves['thresholds'], curves[key], label=label)
+        ax_threshold.set(title='Precision, Recall, and F1-Score vs. Threshold', xlabel='Threshold', ylabel='Score')
+        ax_threshold.legend()
+        ax_roc.plot(curves['fpr'], curves['tpr'])
+        ax_roc.set(title=f"ROC (AUC {curves['roc_auc']:.3f})", xlabel='False positive rate', ylabel='True positive rate')
+        ax_pr.plot(curves['recall'], curves['precision'])
+        ax_pr.set(title=f"PR (AP {curves['average_precision']:.3f})", xlabel='Recall', ylabel='Precision')
+        for ax in (ax_threshold, ax_roc, ax_pr):
+            ax.grid(True)
+        fig.savefig(args.plot)
+        print(f"Plot saved to {args.plot}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Metrics of the CNN score at every threshold on a labeled image set")
+    parser.add_argument('--images',
+                        help="CSV with an image_id column (default: every labeled image not used for training)")
+    parser.add_argument('--thresholds', type=lambda value: [float(t) for t in value.split(',')],
+                        default=DEFAULT_REPORT_THRESHOLDS, help="Comma-separated thresholds for the confusion table")
+    parser.add_argument('--pairs', type=parse_pairs,
+                        default=[CURRENT_TIER_THRESHOLDS, (0.1, 0.3), (0.2, 0.3), (0.15, 0.4), (0.1, 0.5), (0.2, 0.5)],
+                        help="Comma-separated low:high recommendation threshold pairs")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Decode worker processes for images missing from the embedding cache")
+    parser.add_argument('--output', default=os.path.join(SCRIPT_DIR, 'results', 'threshold_sweep.json'))
+    parser.add_argument('--plot', help="Also save threshold, ROC and PR plots to this image file")
+
+    threshold_sweep(parser.parse_args())
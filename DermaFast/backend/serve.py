@@ -0,0 +1,239 @@
+"""
+Pre-fork production server for the DermaFast backend.
+
+The master process imports the app, which loads the CNN weights (and, with
+--preload-faiss, the FAISS index), binds the listening socket and then forks
+the workers. The read-only weights stay shared copy-on-write between workers,
+each of which runs its own uvicorn server on the inherited socket.
+
+    python serve.py --workers 4 --max-requests 5000
+
+Signals sent to the master:
+    SIGTERM / SIGINT   graceful shutdown of all workers
+    SIGHUP             graceful rolling restart of the workers
+
+Use run.py for development (single process with auto-reload).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+import torch
+import uvicorn
+
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+
+# Intra-op threads per worker; 0 divides the cores evenly between workers
+TORCH_THREADS_PER_WORKER = int(os.getenv("TORCH_THREADS_PER_WORKER", "0"))
+
+# Recycle a worker after this many requests (0 = never), with random jitter so they don't all restart together
+WORKER_MAX_REQUESTS = int(os.getenv("WORKER_MAX_REQUESTS", "0"))
+WORKER_MAX_REQUESTS_JITTER = int(os.getenv("WORKER_MAX_REQUESTS_JITTER", "0"))
+
+# Time a worker gets to finish in-flight requests before it is killed
+GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("GRACEFUL_TIMEOUT_SECONDS", "30"))
+
+# A worker that exits sooner than this after starting is treated as crashing and respawned with a delay
+MIN_WORKER_LIFETIME_SECONDS = 5.0
+
+logger = logging.getLogger("app.serve")
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def torch_threads_per_worker(workers: int) -> int:
+    if TORCH_THREADS_PER_WORKER > 0:
+        return TORCH_THREADS_PER_WORKER
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def preload(preload_faiss: bool):
+    """Import the app in the master so the model (and optionally FAISS) is shared by the workers"""
+    # Keep the master single-threaded: an OpenMP pool started before fork is unusable in the children
+    torch.set_num_threads(1)
+
+    from app.main import app
+    from app.supabase_client import close_connections
+
+    if preload_faiss:
+        from app.faiss_service import faiss_service
+        # The k-NN graph's self-search runs on FAISS's OpenMP pool, which does not survive fork either
+        faiss_service.build_threads = 1
+        if not asyncio.run(faiss_service.load_embeddings()):
+            logger.warning("FAISS index could not be preloaded; workers will load it on first use")
+
+    # Workers must not share the master's HTTP connections to Supabase
+    close_connections()
+    return app
+
+
+def run_worker(app, sock: socket.socket, torch_threads: int, max_requests: int) -> None:
+    """Body of a forked worker; never returns"""
+    exit_code = 0
+    try:
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_DFL)
+
+        torch.set_num_threads(torch_threads)
+        from app.faiss_service import faiss_service
+        faiss_service.build_threads = torch_threads
+
+        config = uvicorn.Config(
+            app,
+            limit_max_requests=max_requests or None,
+            timeout_graceful_shutdown=GRACEFUL_TIMEOUT_SECONDS,
+        )
+        uvicorn.Server(config).run(sockets=[sock])
+    except Exception:
+        logger.exception("Worker crashed")
+        exit_code = 1
+    finally:
+        from app.logging_config import stop_logging
+        stop_logging()
+        os._exit(exit_code)
+
+
+class Master:
+    def __init__(self, app, sock: socket.socket, workers: int, max_requests: int, max_requests_jitter: int):
+        self.app = app
+        self.sock = sock
+        self.num_workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.torch_threads = torch_threads_per_worker(workers)
+        self.workers = {}  # pid -> (slot, start time)
+        self.stopping = False
+        self.restart_requested = False
+        self.retiring = []  # workers still to be replaced by a rolling restart
+        self.terminating = None  # worker currently finishing its requests
+
+    def spawn(self, slot: int) -> None:
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.app, self.sock, self.torch_threads, max_requests)
+
+        self.workers[pid] = (slot, time.monotonic())
+        logger.info("Started worker", extra={"worker_pid": pid, "slot": slot, "torch_threads": self.torch_threads})
+
+    def _handle_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _handle_restart(self, signum, frame) -> None:
+        self.restart_requested = True
+
+    def _reap(self) -> None:
+        """Collect exited workers and respawn them unless shutting down"""
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            slot, started = self.workers.pop(pid, (None, None))
+            if slot is None:
+                continue
+            if pid == self.terminating:
+                self.terminating = None
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            logger.info("Worker exited", extra={"worker_pid": pid, "slot": slot, "exit_code": exit_code})
+            if self.stopping:
+                continue
+            if exit_code != 0 and time.monotonic() - started < MIN_WORKER_LIFETIME_SECONDS:
+                time.sleep(1)  # avoid a tight crash loop
+            self.spawn(slot)
+
+    def _rolling_restart(self) -> None:
+        """Retire workers one at a time, so the others keep serving while each is replaced"""
+        if self.restart_requested:
+            self.restart_requested = False
+            self.retiring = list(self.workers)
+
+        if self.terminating is None:
+            while self.retiring:
+                pid = self.retiring.pop(0)
+                if pid in self.workers:
+                    self.terminating = pid
+                    self._signal(pid, signal.SIGTERM)
+                    break
+
+    @staticmethod
+    def _signal(pid: int, sig: int) -> None:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self) -> None:
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT_SECONDS + 5
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for pid in list(self.workers):
+            logger.warning("Killing worker that did not stop in time", extra={"worker_pid": pid})
+            self._signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.clear()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+
+        while not self.stopping:
+            self._rolling_restart()
+            self._reap()
+            time.sleep(0.5)
+
+        logger.info("Shutting down workers")
+        self.shutdown()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the DermaFast API with pre-forked workers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--max-requests", type=int, default=WORKER_MAX_REQUESTS,
+                        help="Recycle each worker after this many requests (0 = never)")
+    parser.add_argument("--max-requests-jitter", type=int, default=WORKER_MAX_REQUESTS_JITTER)
+    parser.add_argument("--preload-faiss", action="store_true",
+                        help="Build the FAISS index in the master so workers share it")
+    args = parser.parse_args()
+
+    if sys.platform == "win32":
+        parser.error("serve.py needs os.fork; use run.py on Windows")
+
+    app = preload(args.preload_faiss)
+    sock = bind_socket(args.host, args.port)
+    logger.info("Listening", extra={"host": args.host, "port": args.port, "workers": args.workers})
+
+    Master(app, sock, args.workers, args.max_requests, args.max_requests_jitter).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from backend.app.admission import InferenceQueue, AdmissionMiddleware, retry_after_seconds, shed_requests
+
+
+def make_app(queue):
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, queue=queue)
+
+    @app.post("/api/analyze")
+    async def analyze():
+        return {"ok": True}
+
+    @app.post("/api/save_similar_moles")
+    async def save_similar_moles():
+        return {"ok": True}
+
+    return app
+
+
+def test_service_time_tracks_observed_inference():
+    queue = InferenceQueue(workers=1)
+
+    async def scenario():
+        for _ in range(20):
+            await queue.run(time.sleep, 0.01)
+
+    asyncio.run(scenario())
+
+    assert queue.pending_units == 0
+    assert 0.005 < queue.service_seconds_per_unit < 0.05
+
+
+def test_expected_wait_grows_with_backlog():
+    queue = InferenceQueue(workers=2)
+    queue.service_seconds_per_unit = 0.5
+
+    assert queue.expected_wait() == 0.5
+    queue.pending_units = 8
+    assert queue.expected_wait() == (8 / 2 + 1) * 0.5
+
+
+def test_analysis_is_shed_when_backlog_exceeds_budget():
+    queue = InferenceQueue(workers=1)
+    queue.service_seconds_per_unit = 1.0
+    queue.pending_units = 20
+    client = TestClient(make_app(queue))
+    shed_before = shed_requests.value(priority="analysis")
+
+    response = client.post("/api/analyze")
+
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) == retry_after_seconds(21.0, 5.0)
+    assert shed_requests.value(priority="analysis") == shed_before + 1
+
+
+def test_critical_routes_keep_flowing_under_backlog():
+    queue = InferenceQueue(workers=1)
+    queue.service_seconds_per_unit = 1.0
+    queue.pending_units = 20
+    client = TestClient(make_app(queue))
+
+    assert client.post("/api/save_similar_moles").status_code == 200
+
+
+def test_analysis_is_admitted_within_budget():
+    queue = InferenceQueue(workers=2)
+    queue.service_seconds_per_unit = 0.2
+    queue.pending_units = 4
+    client = TestClient(make_app(queue))
+
+    assert client.post("/api/analyze").status_code == 200
@@ -0,0 +1,213 @@
+import io
+import json
+import struct
+import zlib
+import pytest
+from PIL import Image
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi.testclient import TestClient
+from backend.app.main import app
+from backend.app.auth import AuthService
+from backend.app.assessments import assessment_store
+
+# Mock AuthService.get_current_user to bypass authentication for tests
+async def override_get_current_user():
+    return {"national_id": "test_user"}
+
+app.dependency_overrides[AuthService.get_current_user] = override_get_current_user
+
+client = TestClient(app)
+
+# Mock Supabase client and FAISS service
+mock_supabase_client = MagicMock()
+mock_faiss_service = MagicMock()
+
+EMBEDDING = [0.1] * 256
+
+
+@pytest.fixture(autouse=True)
+def override_dependencies():
+    mock_supabase_client.reset_mock()
+    mock_faiss_service.reset_mock()
+    mock_faiss_service.embeddings_loaded = True
+    mock_faiss_service.stale = False
+    mock_faiss_service.find_similar_images = AsyncMock(return_value=[("ISIC_1", 1.5), ("ISIC_2", 2.5)])
+    mock_faiss_service.get_image_metadata = AsyncMock(return_value=[
+        {"image_id": "ISIC_1", "dx": "mel", "age": 50, "sex": "male", "localization": "back", "image_url": "url1"},
+    ])
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(
+        error=None, data=[{"cnn_result": 0.42, "embedding": EMBEDDING}]
+    )
+    with patch('backend.app.analysis.supabase', mock_supabase_client), \
+         patch('backend.app.analysis.faiss_service', mock_faiss_service), \
+         patch('backend.app.analysis.inference', return_value=(0.42, EMBEDDING)):
+        yield
+
+
+def _jpeg_bytes(width=32, height=32):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color=(120, 80, 60)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+IMAGE_A = _jpeg_bytes()
+IMAGE_B = _jpeg_bytes(48, 40)
+
+
+def _upload(content=IMAGE_A):
+    return {"file": ("mole.jpg", content, "image/jpeg")}
+
+
+def test_analyze_returns_similar_images():
+    response = client.post("/api/analyze", files=_upload())
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["cnn_result"] == 0.42
+    assert data["embedding_dimensions"] == 256
+    assert [img["image_id"] for img in data["similar_images"]] == ["ISIC_1", "ISIC_2"]
+    assert data["similar_images"][0]["diagnosis"] == "mel"
+    assert data["similar_images"][1]["diagnosis"] == "unknown"
+
+    # Stage latencies are summarized in the Server-Timing header
+    assert "db_insert_cnn_results;dur=" in response.headers["server-timing"]
+    assert "faiss_search;dur=" in response.headers["server-timing"]
+
+    # The analysis is kept in a new assessment, with the diagnoses that are known
+    assessment = assessment_store.get("test_user", data["assessment_id"])
+    assert assessment.cnn_result == 0.42
+    assert assessment.diagnoses == {"ISIC_1": "mel"}
+
+
+def test_idempotency_key_is_bound_to_the_assessment():
+    headers = {"Idempotency-Key": "test-retry-analyze-assessment"}
+    first = client.post("/api/analyze", files=_upload(), data={"assessment_id": "first"}, headers=headers)
+    replay = client.post("/api/analyze", files=_upload(), data={"assessment_id": "first"}, headers=headers)
+    conflict = client.post("/api/analyze", files=_upload(), data={"assessment_id": "second"}, headers=headers)
+
+    assert first.status_code == replay.status_code == 200
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert conflict.status_code == 422
+
+
+def test_analyze_stream_emits_events_in_order():
+    response = client.post("/api/analyze/stream", files=_upload())
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+
+    assert [event["event"] for event in events] == ["classification", "similar_images", "complete"]
+    assert events[0]["cnn_result"] == 0.42
+    assert len(events[1]["similar_images"]) == 2
+    assert events[2]["stored"] is True
+    assert assessment_store.get("test_user", events[2]["assessment_id"]).cnn_result == 0.42
+
+    mock_supabase_client.table.assert_any_call("cnn_results")
+
+
+def test_analyze_stream_reports_storage_failure():
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(error="db down", data=None)
+
+    response = client.post("/api/analyze/stream", files=_upload())
+
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[0]["event"] == "classification"
+    assert events[-1] == {"event": "complete", "stored": False, "message": "Failed to store results: db down"}
+
+
+def test_analyze_stream_rejects_non_images():
+    response = client.post("/api/analyze/stream", files={"file": ("notes.txt", b"hello", "text/plain")})
+
+    assert response.status_code == 400
+
+
+def test_analyze_batch_runs_one_pass_and_one_insert():
+    mock_faiss_service.find_similar_images_batch = AsyncMock(return_value=[[("ISIC_1", 1.5)], [("ISIC_2", 2.5)]])
+    files = [
+        ("files", ("a.jpg", IMAGE_A, "image/jpeg")),
+        ("files", ("notes.txt", b"hello", "text/plain")),
+        ("files", ("b.jpg", IMAGE_B, "image/jpeg")),
+    ]
+
+    with patch('backend.app.analysis.inference_batch', return_value=[(0.2, EMBEDDING), (0.7, EMBEDDING)]) as mock_batch:
+        response = client.post("/api/analyze/batch", files=files)
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["analyzed"] == 2
+    assert data["failed"] == 1
+    assert [r["filename"] for r in data["results"]] == ["a.jpg", "notes.txt", "b.jpg"]
+    assert data["results"][1]["error"] == "File must be an image"
+    assert data["results"][2]["cnn_result"] == 0.7
+    assert data["results"][2]["similar_images"][0]["image_id"] == "ISIC_2"
+
+    # One forward pass over the two images, one insert with both rows, one metadata query
+    mock_batch.assert_called_once()
+    assert mock_batch.call_args.args[1] == [IMAGE_A, IMAGE_B]
+    inserted_rows = mock_supabase_client.table.return_value.insert.call_args.args[0]
+    assert [row["cnn_result"] for row in inserted_rows] == [0.2, 0.7]
+    # Rows of one insert share now(), so each carries its own (national_id, timestamp) key, in upload order
+    keys = [(row["national_id"], row["timestamp"]) for row in inserted_rows]
+    assert len(set(keys)) == len(keys)
+    assert [timestamp for _, timestamp in keys] == sorted(timestamp for _, timestamp in keys)
+    mock_faiss_service.get_image_metadata.assert_awaited_once_with(["ISIC_1", "ISIC_2"])
+
+
+def test_analyze_rejects_payload_that_is_not_an_image():
+    response = client.post("/api/analyze", files=_upload(b"%PDF-1.7 definitely not an image"))
+
+    assert response.status_code == 415
+    mock_supabase_client.table.assert_not_called()
+
+
+def test_analyze_rejects_oversized_upload():
+    with patch('backend.app.uploads.MAX_UPLOAD_BYTES', 100), \
+         patch('backend.app.main.MAX_UPLOAD_BYTES', 100):
+        response = client.post("/api/analyze", files=_upload())
+
+    assert response.status_code == 413
+
+
+def test_analyze_rejects_decompression_bomb():
+    with patch('backend.app.uploads.MAX_IMAGE_PIXELS', 32 * 32 - 1):
+        response = client.post("/api/analyze", files=_upload())
+
+    assert response.status_code == 400
+    assert "exceed" in response.json()["detail"]
+
+
+def _png_header(width, height):
+    """A PNG claiming the given dimensions, with an empty IDAT chunk instead of pixel data"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IDAT", b"")
+
+
+def test_analyze_rejects_header_beyond_pil_bomb_limit():
+    # 400M pixels: PIL raises DecompressionBombError while opening the header
+    bomb = _png_header(20000, 20000)
+
+    for path in ("/api/analyze", "/api/analyze/stream"):
+        response = client.post(path, files=_upload(bomb))
+        assert response.status_code == 400
+        assert "exceed" in response.json()["detail"]
+
+    # In a batch only that file is rejected
+    response = client.post("/api/analyze/batch", files=[
+        ("files", ("bomb.png", bomb, "image/png")), ("files", ("mole.jpg", IMAGE_A, "image/jpeg")),
+    ])
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert "exceed" in results[0]["error"]
+    assert "cnn_result" in results[1]
+
+
+def test_metrics_endpoint_exposes_stage_histograms():
+    client.post("/api/analyze", files=_upload())
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'dermafast_stage_duration_seconds_count{stage="db_insert_cnn_results"}' in response.text
+    assert "dermafast_faiss_index_size" in response.text
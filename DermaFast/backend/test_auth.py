@@ -0,0 +1,239 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock, patch
+from fastapi import HTTPException
+from backend.app import auth
+from backend.app.auth import AuthService
+
+# Mock Supabase client
+mock_supabase_client = MagicMock()
+
+
+@pytest.fixture(autouse=True)
+def override_supabase_client():
+    mock_supabase_client.reset_mock()
+    auth._user_cache.clear()
+    auth._revoked_user_ids.clear()
+    with patch('backend.app.auth.supabase_client', mock_supabase_client):
+        yield
+
+
+def _auth_header(user_id=42):
+    token = AuthService.create_access_token({"sub": user_id, "national_id": "test_user"})
+    return f"Bearer {token}"
+
+
+def _users_query():
+    return mock_supabase_client.from_.return_value.select.return_value.eq.return_value.execute
+
+
+def test_get_current_user_is_cached():
+    _users_query().return_value = MagicMock(data=[{"id": 42, "national_id": "test_user"}])
+
+    first = asyncio.run(AuthService.get_current_user(_auth_header()))
+    second = asyncio.run(AuthService.get_current_user(_auth_header()))
+
+    assert first == second == {"id": 42, "national_id": "test_user"}
+    assert _users_query().call_count == 1
+
+
+def test_get_current_user_unknown_user_is_not_cached():
+    _users_query().return_value = MagicMock(data=[])
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(AuthService.get_current_user(_auth_header()))
+        assert exc_info.value.status_code == 401
+
+    assert _users_query().call_count == 2
+
+
+def test_revoked_user_is_rejected_even_when_cached():
+    _users_query().return_value = MagicMock(data=[{"id": 42, "national_id": "test_user"}])
+    token = _auth_header()
+    asyncio.run(AuthService.get_current_user(token))
+
+    AuthService.revoke_user(42)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(AuthService.get_current_user(token))
+    assert exc_info.value.status_code == 401
+
+    AuthService.restore_user(42)
+    assert asyncio.run(AuthService.get_current_user(token))["national_id"] == "test_user"
+
+
+def test_delete_user_revokes_tokens():
+    _users_query().return_value = MagicMock(data=[{"id": 42, "national_id": "test_user"}])
+    token = _auth_header()
+    asyncio.run(AuthService.get_current_user(token))
+
+    mock_supabase_client.from_.return_value.delete.return_value.eq.return_value.execute.return_value = MagicMock(
+        data=[{"id": 42, "national_id": "test_user"}]
+    )
+    assert asyncio.run(AuthService.delete_user("test_user")) is True
+
+    with pytest.raises(HTTPException):
+        asyncio.run(AuthService.get_current_user(token))
+
+
+def _users_update():
+    return mock_supabase_client.from_.return_value.update.return_value.eq.return_value.execute
+
+
+def test_revocation_rejects_only_tokens_issued_before_it():
+    _users_query().return_value = MagicMock(data=[{"id": 42, "national_id": "test_user"}])
+    _users_update().return_value = MagicMock(data=[{"id": 42}])
+    earlier = _auth_header()
+
+    assert asyncio.run(AuthService.revoke_sessions("test_user")) is True
+    with pytest.raises(HTTPException):
+        asyncio.run(AuthService.get_current_user(earlier))
+
+    # A token from signing in again, even within the same second, is accepted
+    assert asyncio.run(AuthService.get_current_user(_auth_header()))["national_id"] == "test_user"
+
+
+def test_revocation_reaches_other_processes_through_the_users_table():
+    earlier = _auth_header()
+    _users_update().return_value = MagicMock(data=[{"id": 42}])
+    asyncio.run(AuthService.revoke_sessions("test_user"))
+    tokens_valid_after = mock_supabase_client.from_.return_value.update.call_args.args[0]["tokens_valid_after"]
+    later = _auth_header()
+
+    # Another worker: no deny-list entry, only the column read with the user
+    auth._revoked_user_ids.clear()
+    auth._user_cache.clear()
+    _users_query().return_value = MagicMock(data=[
+        {"id": 42, "national_id": "test_user", "tokens_valid_after": tokens_valid_after}
+    ])
+
+    with pytest.raises(HTTPException):
+        asyncio.run(AuthService.get_current_user(earlier))
+    # Rejected from the cached entry too, without another query
+    with pytest.raises(HTTPException):
+        asyncio.run(AuthService.get_current_user(earlier))
+    assert asyncio.run(AuthService.get_current_user(later)) == {"id": 42, "national_id": "test_user"}
+    assert _users_query().call_count == 1
+
+
+def test_revocations_expire_with_the_tokens_they_cover():
+    assert auth._revoked_user_ids.ttl == auth.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+
+def test_admin_endpoints_delete_and_revoke_users():
+    from fastapi.testclient import TestClient
+    from backend.app.main import app
+
+    async def override_admin():
+        return {"national_id": "admin"}
+
+    app.dependency_overrides[auth.require_admin] = override_admin
+    try:
+        client = TestClient(app)
+        _users_update().return_value = MagicMock(data=[{"id": 42}])
+        mock_supabase_client.from_.return_value.delete.return_value.eq.return_value.execute.return_value = MagicMock(
+            data=[{"id": 7, "national_id": "gone"}]
+        )
+
+        assert client.post("/admin/users/test_user/revoke").status_code == 200
+        assert AuthService.is_revoked(42)
+        assert client.delete("/admin/users/gone").status_code == 200
+        assert AuthService.is_revoked(7)
+
+        _users_update().return_value = MagicMock(data=[])
+        assert client.post("/admin/users/nobody/revoke").status_code == 404
+    finally:
+        del app.dependency_overrides[auth.require_admin]
+
+
+def test_password_hashing_runs_off_the_event_loop():
+    hashed = asyncio.run(AuthService.hash_password_async("secret-password"))
+
+    assert asyncio.run(AuthService.verify_password_async("secret-password", hashed)) is True
+    assert asyncio.run(AuthService.verify_password_async("wrong-password", hashed)) is False
+    assert auth.password_hash_queue_time.count() >= 3
+
+
+def test_password_pool_rejects_when_saturated():
+    with patch('backend.app.auth.PASSWORD_HASH_MAX_PENDING', 0):
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(AuthService.hash_password_async("secret-password"))
+
+    assert exc_info.value.status_code == 503
+    assert "Retry-After" in exc_info.value.headers
+
+
+def test_login_admission_limits_failed_logins_per_account():
+    _users_query().return_value = MagicMock(
+        data=[{"id": 42, "password_hash": AuthService.hash_password("right-password"), "last_login": None}]
+    )
+    with patch('backend.app.auth._account_limiter', auth.SlidingWindowLimiter(2, 60)):
+        # Successful logins do not count against the account
+        for _ in range(3):
+            AuthService.check_login_admission("flood_user", "10.0.0.1")
+            assert asyncio.run(AuthService.authenticate_user("flood_user", "right-password")) is not None
+
+        for _ in range(2):
+            AuthService.check_login_admission("flood_user", "10.0.0.2")
+            assert asyncio.run(AuthService.authenticate_user("flood_user", "wrong-password")) is None
+
+        with pytest.raises(HTTPException) as exc_info:
+            AuthService.check_login_admission("flood_user", "10.0.0.3")
+        assert exc_info.value.status_code == 429
+        assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+        # Other accounts are unaffected
+        AuthService.check_login_admission("other_user", "10.0.0.3")
+
+
+def test_successful_login_clears_failed_attempts():
+    _users_query().return_value = MagicMock(
+        data=[{"id": 42, "password_hash": AuthService.hash_password("right-password"), "last_login": None}]
+    )
+    with patch('backend.app.auth._account_limiter', auth.SlidingWindowLimiter(2, 60)):
+        assert asyncio.run(AuthService.authenticate_user("typo_user", "wrong-password")) is None
+        assert asyncio.run(AuthService.authenticate_user("typo_user", "right-password")) is not None
+        assert asyncio.run(AuthService.authenticate_user("typo_user", "wrong-password")) is None
+
+        AuthService.check_login_admission("typo_user", "10.0.0.4")
+
+
+def test_concurrent_guesses_cannot_pass_the_account_limit():
+    _users_query().return_value = MagicMock(
+        data=[{"id": 42, "password_hash": AuthService.hash_password("right-password"), "last_login": None}]
+    )
+
+    async def burst():
+        return await asyncio.gather(
+            *(AuthService.authenticate_user("burst_user", "wrong-password") for _ in range(6)),
+            return_exceptions=True,
+        )
+
+    with patch('backend.app.auth._account_limiter', auth.SlidingWindowLimiter(2, 60)):
+        results = asyncio.run(burst())
+
+    # All six passed admission together, but only two got to check a password
+    assert results.count(None) == 2
+    assert [r.status_code for r in results if isinstance(r, HTTPException)] == [429] * 4
+
+
+def test_flooding_new_accounts_does_not_lift_a_limit():
+    limiter = auth.SlidingWindowLimiter(2, 60, max_keys=3)
+    limiter.hit("target")
+    limiter.hit("target")
+
+    for i in range(10):
+        limiter.hit(f"random-{i}")
+
+    assert limiter.check("target") is not None
+    assert limiter.check("random-0") is None  # evicted, being under its limit
+
+
+def test_login_admission_limits_each_ip():
+    with patch('backend.app.auth._ip_limiter', auth.SlidingWindowLimiter(1, 60)):
+        AuthService.check_login_admission("user_a", "10.0.0.9")
+
+        with pytest.raises(HTTPException) as exc_info:
+            AuthService.check_login_admission("user_b", "10.0.0.9")
+        assert exc_info.value.status_code == 429
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from backend.app.idempotency import IdempotencyStore, fingerprint
+
+
+def test_duplicate_key_returns_stored_result():
+    store = IdempotencyStore()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {"value": len(calls)}
+
+    async def scenario():
+        first = await store.run("key", fingerprint("a"), compute)
+        second = await store.run("key", fingerprint("a"), compute)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert first == ({"value": 1}, False)
+    assert second == ({"value": 1}, True)
+    assert len(calls) == 1
+
+
+def test_concurrent_duplicate_waits_for_original():
+    store = IdempotencyStore()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def scenario():
+        return await asyncio.gather(
+            store.run("key", fingerprint("a"), compute),
+            store.run("key", fingerprint("a"), compute),
+        )
+
+    results = asyncio.run(scenario())
+
+    assert sorted(results, key=lambda r: r[1]) == [("done", False), ("done", True)]
+    assert len(calls) == 1
+
+
+def test_key_reused_with_different_payload_is_rejected():
+    store = IdempotencyStore()
+
+    async def compute():
+        return "done"
+
+    async def scenario():
+        await store.run("key", fingerprint("a"), compute)
+        await store.run("key", fingerprint("b"), compute)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(scenario())
+    assert exc_info.value.status_code == 422
+
+
+def test_failures_are_not_stored():
+    store = IdempotencyStore()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        if len(calls) == 1:
+            raise HTTPException(status_code=500, detail="db down")
+        return "done"
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await store.run("key", fingerprint("a"), compute)
+        return await store.run("key", fingerprint("a"), compute)
+
+    assert asyncio.run(scenario()) == ("done", False)
+    assert len(calls) == 2
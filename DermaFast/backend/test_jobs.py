@@ -0,0 +1,224 @@
+import asyncio
+import io
+import threading
+import time
+import anyio.to_thread
+import pytest
+from unittest.mock import AsyncMock, patch
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from backend.app import jobs
+from backend.app.jobs import JobBroker, JobBrokerServer, LongPollsFull, QueueFull, connect_broker, wait_for_job, work
+from backend.app.main import app
+from backend.app.auth import AuthService
+from PIL import Image
+
+
+def _jpeg_bytes(width=32, height=32):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color=(150, 90, 60)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_claim_and_complete():
+    broker = JobBroker()
+    job_id = broker.submit("user", {"value": 1})
+
+    assert broker.get(job_id)["status"] == jobs.QUEUED
+    assert broker.claim(timeout=0) == (job_id, {"value": 1})
+    assert broker.get(job_id)["status"] == jobs.RUNNING
+
+    broker.complete(job_id, {"answer": 42})
+    job = broker.get(job_id)
+    assert job["status"] == jobs.SUCCEEDED
+    assert job["result"] == {"answer": 42}
+    assert "payload" not in job
+
+
+def test_failed_attempts_are_retried_until_max_attempts():
+    broker = JobBroker(max_attempts=2)
+    job_id = broker.submit("user", "payload")
+
+    broker.claim(timeout=0)
+    broker.fail(job_id, "database timeout")
+    assert broker.get(job_id)["status"] == jobs.QUEUED
+
+    assert broker.claim(timeout=0) == (job_id, "payload")
+    broker.fail(job_id, "database timeout")
+    job = broker.get(job_id)
+    assert job["status"] == jobs.FAILED
+    assert job["attempts"] == 2
+    assert job["error"] == "database timeout"
+
+
+def test_non_retryable_failure_is_final():
+    broker = JobBroker(max_attempts=3)
+    job_id = broker.submit("user", "payload")
+    broker.claim(timeout=0)
+
+    broker.fail(job_id, "not an image", retryable=False)
+
+    assert broker.get(job_id)["status"] == jobs.FAILED
+    assert broker.claim(timeout=0) is None
+
+
+def test_expired_lease_hands_job_to_another_worker():
+    broker = JobBroker(lease_seconds=0.01)
+    job_id = broker.submit("user", "payload")
+    broker.claim(timeout=0)
+
+    time.sleep(0.02)
+
+    assert broker.claim(timeout=0) == (job_id, "payload")
+    assert broker.get(job_id)["attempts"] == 2
+
+
+def test_finished_jobs_expire():
+    broker = JobBroker(result_ttl=0.01)
+    job_id = broker.submit("user", "payload")
+    broker.claim(timeout=0)
+    broker.complete(job_id, "done")
+
+    time.sleep(0.02)
+    broker.claim(timeout=0)
+
+    assert broker.get(job_id) is None
+
+
+def test_queue_is_bounded():
+    broker = JobBroker(max_queued=1)
+    broker.submit("user", "first")
+    with pytest.raises(QueueFull):
+        broker.submit("user", "second")
+
+
+def test_wait_returns_when_job_finishes():
+    broker = JobBroker()
+    job_id = broker.submit("user", "payload")
+    broker.claim(timeout=0)
+    threading.Timer(0.05, broker.complete, (job_id, "done")).start()
+
+    start = time.monotonic()
+    job = broker.wait(job_id, timeout=5)
+
+    assert job["status"] == jobs.SUCCEEDED
+    assert time.monotonic() - start < 1
+
+
+def test_long_polls_hold_no_threads():
+    broker = JobBroker()
+    job_id = broker.submit("user", "payload")
+    broker.claim(timeout=0)
+
+    async def scenario():
+        # Far more waiters than broker threads, and none of them borrow from the shared pool
+        waiters = [asyncio.create_task(wait_for_job(broker, job_id, 5)) for _ in range(50)]
+        await asyncio.sleep(0.2)
+        assert anyio.to_thread.current_default_thread_limiter().borrowed_tokens == 0
+        assert not any(waiter.done() for waiter in waiters)
+        broker.complete(job_id, "done")
+        return await asyncio.gather(*waiters)
+
+    results = asyncio.run(scenario())
+
+    assert all(job["status"] == jobs.SUCCEEDED for job in results)
+    assert jobs._long_polls == 0
+
+
+def test_long_polls_are_capped(monkeypatch):
+    broker = JobBroker()
+    job_id = broker.submit("user", "payload")
+    monkeypatch.setattr(jobs, "MAX_JOB_LONG_POLLS", 1)
+
+    async def scenario():
+        held = asyncio.create_task(wait_for_job(broker, job_id, 0.3))
+        await asyncio.sleep(0)
+        with pytest.raises(LongPollsFull):
+            await wait_for_job(broker, job_id, 0.3)
+        # A timed-out long poll returns the job as it stands and frees its slot
+        assert (await held)["status"] == jobs.QUEUED
+        assert (await wait_for_job(broker, job_id, 0.01))["status"] == jobs.QUEUED
+
+    asyncio.run(scenario())
+
+
+def test_broker_requires_an_authkey(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_BROKER_AUTHKEY", None)
+    with pytest.raises(RuntimeError):
+        connect_broker("127.0.0.1:50000")
+    with pytest.raises(RuntimeError):
+        jobs.serve_broker("127.0.0.1:0")
+
+
+def test_worker_loop_over_tcp_broker(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_BROKER_AUTHKEY", "test-secret")
+    broker = JobBroker()
+    JobBrokerServer.register("broker", callable=lambda: broker)
+    server = JobBrokerServer(address=("127.0.0.1", 0), authkey=jobs.broker_authkey()).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.address
+
+    remote = connect_broker(f"{host}:{port}")
+    ok_job = remote.submit("user", 2)
+    bad_job = remote.submit("user", -1)
+
+    async def process(payload):
+        if payload < 0:
+            raise HTTPException(status_code=400, detail="negative")
+        return payload * 10
+
+    async def scenario():
+        stop = asyncio.Event()
+        worker = asyncio.create_task(work(remote, process, stop, poll_seconds=0.05))
+        while remote.stats()[jobs.QUEUED] or remote.stats()[jobs.RUNNING]:
+            await asyncio.sleep(0.01)
+        stop.set()
+        await worker
+
+    asyncio.run(scenario())
+
+    assert remote.get(ok_job)["result"] == 20
+    assert remote.get(bad_job)["status"] == jobs.FAILED
+    assert remote.get(bad_job)["attempts"] == 1
+
+
+def test_job_endpoints_with_in_process_worker():
+    async def override_get_current_user():
+        return {"national_id": "job_user"}
+
+    result = {"message": "Analysis successful", "cnn_result": 0.2, "embedding_dimensions": 256, "similar_images": []}
+
+    with patch.dict(app.dependency_overrides, {AuthService.get_current_user: override_get_current_user}), \
+         patch('backend.app.main.analyze_image', AsyncMock(return_value=result)), \
+         patch.object(jobs, '_broker', JobBroker()), \
+         TestClient(app) as client:
+        response = client.post("/api/jobs/analyze", files={"file": ("mole.jpg", _jpeg_bytes(), "image/jpeg")})
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+
+        job = client.get(f"/api/jobs/{job_id}", params={"wait": 5}).json()
+        assert job["status"] == jobs.SUCCEEDED
+        assert job["result"] == result
+        assert "owner" not in job
+
+        assert client.get("/api/jobs/unknown").status_code == 404
+
+
+def test_job_endpoint_answers_at_once_when_long_polls_are_full():
+    async def override_get_current_user():
+        return {"national_id": "job_user"}
+
+    broker = JobBroker()
+    job_id = broker.submit("job_user", {"national_id": "job_user", "image_bytes": b""})
+
+    # No lifespan, so no worker picks the job up
+    with patch.dict(app.dependency_overrides, {AuthService.get_current_user: override_get_current_user}), \
+         patch.object(jobs, '_broker', broker), \
+         patch.object(jobs, 'MAX_JOB_LONG_POLLS', 0):
+        start = time.monotonic()
+        response = TestClient(app).get(f"/api/jobs/{job_id}", params={"wait": 5})
+
+    assert response.status_code == 202
+    assert response.headers["retry-after"] == "1"
+    assert response.json()["status"] == jobs.QUEUED
+    assert time.monotonic() - start < 1
@@ -0,0 +1,81 @@
+import asyncio
+import numpy as np
+from unittest.mock import MagicMock, patch
+from fastapi.testclient import TestClient
+from backend.app.main import app
+from backend.app.auth import AuthService
+from backend.app.faiss_service import FAISSService, build_knn_graph
+
+async def override_get_current_user():
+    return {"national_id": "test_user"}
+
+app.dependency_overrides[AuthService.get_current_user] = override_get_current_user
+
+client = TestClient(app)
+
+
+def _rows(vectors, start=0):
+    return [
+        {"image_id": f"ISIC_{start + i}", "embedding": vector.tolist(), "embedding_version": None,
+         "dx": "mel" if i % 2 else "nv", "age": 40, "sex": "female", "localization": "back"}
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def _load(service, rows):
+    with patch('backend.app.faiss_service.supabase') as mock_supabase:
+        mock_supabase.table.return_value.select.return_value.not_.is_.return_value.execute.return_value = \
+            MagicMock(data=rows)
+        assert asyncio.run(service.load_embeddings())
+
+
+def test_graph_holds_the_nearest_other_references():
+    vectors = np.random.default_rng(0).normal(size=(50, 8)).astype(np.float32)
+    service = FAISSService()
+    _load(service, _rows(vectors))
+
+    squared = ((vectors[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    np.fill_diagonal(squared, np.inf)
+    expected = np.argsort(squared, axis=1)[:, :9]
+
+    rows = [service.image_ids.index(f"ISIC_{i}") for i in range(len(vectors))]
+    neighbours = [[int(service.image_ids[n].split("_")[1]) for n in service.neighbour_rows[row]] for row in rows]
+    assert np.array_equal(neighbours, expected)
+
+    similar = service.similar_to_reference("ISIC_0", k=3)
+    assert [image_id for image_id, _ in similar] == [f"ISIC_{i}" for i in expected[0, :3]]
+    assert service.similar_to_reference("ISIC_unknown") is None
+
+
+def test_added_references_extend_the_graph():
+    vectors = np.random.default_rng(1).normal(size=(80, 8)).astype(np.float32)
+    service = FAISSService()
+    _load(service, _rows(vectors[:60]))
+    rows_before = {image_id: row for row, image_id in enumerate(service.image_ids)}
+
+    # Rows come back in any order; the indexed references keep their rows
+    _load(service, list(reversed(_rows(vectors))))
+
+    assert all(service.image_ids[row] == image_id for image_id, row in rows_before.items())
+    distances, rows = build_knn_graph(service.index, 9)
+    assert np.allclose(service.neighbour_distances, distances, atol=1e-5)
+    assert np.array_equal(service.neighbour_rows, rows)
+
+
+def test_similar_references_endpoint_makes_no_database_query():
+    service = FAISSService()
+    _load(service, _rows(np.random.default_rng(2).normal(size=(20, 8)).astype(np.float32)))
+
+    with patch('backend.app.main.faiss_service', service), \
+         patch('backend.app.faiss_service.supabase') as mock_supabase:
+        mock_supabase.storage.from_.return_value.get_public_url.side_effect = lambda path: f"https://storage/{path}"
+
+        response = client.get("/api/references/ISIC_3/similar?k=4")
+        assert response.status_code == 200
+        similar = response.json()["similar_images"]
+        assert [image["image_id"] for image in similar] == [image_id for image_id, _ in service.similar_to_reference("ISIC_3", 4)]
+        assert all(image["diagnosis"] in ("mel", "nv") and image["image_url"].endswith(".jpg") for image in similar)
+        mock_supabase.table.assert_not_called()
+
+        assert client.get("/api/references/ISIC_404/similar").status_code == 404
+        assert client.get("/api/references/ISIC_3/similar?k=50").status_code == 400
@@ -0,0 +1,46 @@
+import json
+import logging
+from backend.app import logging_config
+from backend.app.logging_config import JsonFormatter, RequestContextFilter, bind_user, hash_national_id
+
+
+def _record(level=logging.INFO, msg="hello", **extra):
+    record = logging.LogRecord("backend.app.test", level, __file__, 1, msg, (), None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def test_json_records_carry_request_context():
+    token = logging_config.request_id_var.set("req-123")
+    try:
+        bind_user("123456789")
+        record = _record(stage="inference")
+        assert RequestContextFilter().filter(record)
+        entry = json.loads(JsonFormatter().format(record))
+    finally:
+        logging_config.request_id_var.reset(token)
+        bind_user(None)
+
+    assert entry["message"] == "hello"
+    assert entry["request_id"] == "req-123"
+    assert entry["national_id_hash"] == hash_national_id("123456789")
+    assert "123456789" not in json.dumps(entry)
+    assert entry["stage"] == "inference"
+
+
+def test_debug_records_are_sampled_per_request():
+    context_filter = RequestContextFilter()
+
+    token = logging_config.debug_sampled_var.set(False)
+    try:
+        assert not context_filter.filter(_record(logging.DEBUG))
+        assert context_filter.filter(_record(logging.INFO))
+    finally:
+        logging_config.debug_sampled_var.reset(token)
+
+    token = logging_config.debug_sampled_var.set(True)
+    try:
+        assert context_filter.filter(_record(logging.DEBUG))
+    finally:
+        logging_config.debug_sampled_var.reset(token)
@@ -0,0 +1,44 @@
+import pytest
+from backend.app.metrics import Counter, Gauge, Histogram, Registry, stage_timer, stage_latency, stage_errors
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.register(Histogram("test_seconds", "Test latency", ["stage"], buckets=(0.1, 1.0)))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5.0, stage="a")
+
+    text = registry.render()
+
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text
+
+
+def test_counter_and_callback_gauge():
+    registry = Registry()
+    counter = registry.register(Counter("test_total", "Test counter", ["reason"]))
+    registry.register(Gauge("test_depth", "Test gauge", callback=lambda: 7))
+    counter.inc(reason="x")
+    counter.inc(2, reason="x")
+
+    text = registry.render()
+
+    assert 'test_total{reason="x"} 3.0' in text
+    assert 'test_depth 7.0' in text
+
+
+def test_stage_timer_records_latency_and_errors():
+    before = stage_latency.count(stage="unit_test_stage")
+
+    with stage_timer("unit_test_stage"):
+        pass
+    with pytest.raises(ValueError):
+        with stage_timer("unit_test_stage"):
+            raise ValueError("boom")
+
+    assert stage_latency.count(stage="unit_test_stage") == before + 2
+    assert stage_errors.value(stage="unit_test_stage") >= 1
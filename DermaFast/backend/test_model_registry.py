@@ -0,0 +1,159 @@
+import asyncio
+import pytest
+import torch
+from unittest.mock import MagicMock, patch
+from backend.app.ml_model import BasicCNN
+from backend.app.model_registry import ModelRegistry, weights_version
+from backend.app.faiss_service import FAISSService
+
+
+def _save_weights(path, seed):
+    torch.manual_seed(seed)
+    torch.save(BasicCNN().state_dict(), path)
+
+
+@pytest.fixture
+def weights_path(tmp_path):
+    path = tmp_path / "weights.pkl"
+    _save_weights(path, seed=0)
+    return str(path)
+
+
+def test_reload_swaps_to_new_version_and_keeps_old_model_for_in_flight_work(weights_path):
+    registry = ModelRegistry(weights_path)
+    in_flight = registry.current()
+
+    _save_weights(weights_path, seed=1)
+    result = registry.reload()
+
+    assert result == {"reloaded": True, "version": weights_version(weights_path), "previous_version": in_flight.version}
+    assert registry.current().version != in_flight.version
+    assert registry.current().model is not in_flight.model
+    # The request that took the old model still holds a usable model
+    assert not in_flight.model.training
+
+
+def test_unchanged_weights_are_not_reloaded(weights_path):
+    registry = ModelRegistry(weights_path)
+    before = registry.current()
+
+    assert registry.reload()["reloaded"] is False
+    assert registry.current() is before
+    assert registry.reload(force=True)["reloaded"] is True
+
+
+def test_failed_reload_keeps_current_model(weights_path):
+    registry = ModelRegistry(weights_path)
+    before = registry.current()
+
+    with open(weights_path, "wb") as weights:
+        weights.write(b"not a checkpoint")
+    with pytest.raises(Exception):
+        registry.reload()
+
+    assert registry.current() is before
+
+
+def test_swap_marks_reference_embeddings_stale(weights_path):
+    registry = ModelRegistry(weights_path)
+    faiss = FAISSService()
+    faiss.set_model_version(registry.current().version)
+    registry.on_swap(lambda old, new: faiss.set_model_version(new.version))
+    assert not faiss.stale
+
+    _save_weights(weights_path, seed=1)
+    registry.reload()
+
+    assert faiss.stale
+
+
+def test_watch_reloads_changed_file(weights_path):
+    registry = ModelRegistry(weights_path)
+    first_version = registry.current().version
+
+    async def scenario():
+        stop = asyncio.Event()
+        watcher = asyncio.create_task(registry.watch(0.02, stop))
+        await asyncio.sleep(0.05)
+        _save_weights(weights_path, seed=1)
+        for _ in range(100):
+            if registry.current().version != first_version:
+                break
+            await asyncio.sleep(0.02)
+        stop.set()
+        await watcher
+
+    asyncio.run(scenario())
+
+    assert registry.current().version == weights_version(weights_path) != first_version
+
+
+def test_index_only_holds_embeddings_of_the_serving_version():
+    rows = [
+        {"image_id": "legacy", "embedding": [1.0, 0.0], "embedding_version": None},
+        {"image_id": "old", "embedding": [0.0, 1.0], "embedding_version": "aaaaaaaaaaaa"},
+        {"image_id": "new", "embedding": [1.0, 1.0], "embedding_version": "bbbbbbbbbbbb"},
+    ]
+    faiss = FAISSService()
+    faiss.set_model_version("aaaaaaaaaaaa")
+
+    with patch('backend.app.faiss_service.supabase') as mock_supabase:
+        load = mock_supabase.table.return_value.select.return_value.not_.is_.return_value.execute
+        load.return_value = MagicMock(data=rows)
+        assert asyncio.run(faiss.load_embeddings())
+        assert sorted(faiss.image_ids) == ["legacy", "old"]
+
+        # Swapping models marks the index stale; a partly re-embedded table does not replace it
+        faiss.set_model_version("bbbbbbbbbbbb")
+        assert faiss.stale
+        assert not asyncio.run(faiss.load_embeddings())
+        assert sorted(faiss.image_ids) == ["legacy", "old"]
+        assert faiss.stale
+
+        # Once every reference was re-embedded the index is rebuilt from them
+        load.return_value = MagicMock(data=[dict(row, embedding_version="bbbbbbbbbbbb") for row in rows])
+        assert asyncio.run(faiss.load_embeddings())
+
+    assert sorted(faiss.image_ids) == ["legacy", "new", "old"]
+    assert not faiss.stale
+
+
+def test_stale_index_is_rebuilt_in_the_background():
+    rows = [
+        {"image_id": "old", "embedding": [0.0, 1.0], "embedding_version": "aaaaaaaaaaaa"},
+        {"image_id": "new", "embedding": [1.0, 1.0], "embedding_version": "bbbbbbbbbbbb"},
+    ]
+    faiss = FAISSService()
+    faiss.set_model_version("aaaaaaaaaaaa")
+
+    async def scenario():
+        with patch('backend.app.faiss_service.supabase') as mock_supabase:
+            filtered = mock_supabase.table.return_value.select.return_value.not_.is_.return_value
+            filtered.execute.return_value = MagicMock(data=rows)
+            assert await faiss.load_embeddings()
+
+            # Another worker swapped models; this one notices on its next search, but
+            # "old" is not re-embedded yet, so it keeps its index rather than index a subset
+            faiss.set_model_version("bbbbbbbbbbbb")
+            filtered.or_.return_value.limit.return_value.execute.return_value = MagicMock(data=[{"image_id": "old"}])
+            faiss.reload_if_stale()
+            assert not await faiss._reload_task
+            assert faiss.stale
+            assert faiss.image_ids == ["old"]
+
+            # Attempts are spaced out while the references are still stale
+            faiss.reload_if_stale()
+            assert faiss._reload_task.done()
+
+            # The re-embed finished: the next attempt rebuilds from every reference
+            rows[0]["embedding_version"] = "bbbbbbbbbbbb"
+            filtered.or_.return_value.limit.return_value.execute.return_value = MagicMock(data=[])
+            faiss._last_reload_attempt = float("-inf")
+            faiss.reload_if_stale()
+            assert await faiss._reload_task
+            assert not faiss.stale
+            assert sorted(faiss.image_ids) == ["new", "old"]
+            # NULL versions count as the old model, so the probe looks for them too
+            assert filtered.or_.call_args.args[0] == "embedding_version.is.null,embedding_version.neq.bbbbbbbbbbbb"
+
+    asyncio.run(scenario())
@@ -0,0 +1,63 @@
+import threading
+import time
+import pytest
+from backend.app import profiling
+
+
+def _busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sample_cpu_collects_collapsed_and_speedscope_output():
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_worker, args=(stop,), name="busy-worker")
+    worker.start()
+    try:
+        profile = profiling.sample_cpu(0.2, interval=0.01)
+    finally:
+        stop.set()
+        worker.join()
+
+    collapsed = profiling.to_collapsed(profile)
+    assert any(line.startswith("busy-worker;") and "_busy_worker" in line for line in collapsed.splitlines())
+
+    speedscope = profiling.to_speedscope(profile)
+    assert "busy-worker" in [p["name"] for p in speedscope["profiles"]]
+    assert speedscope["shared"]["frames"]
+
+
+def test_only_one_cpu_profile_at_a_time():
+    result = {}
+    runner = threading.Thread(target=lambda: result.update(profiling.sample_cpu(0.3, interval=0.01)))
+    runner.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(profiling.ProfilerBusy):
+            profiling.sample_cpu(0.1)
+    finally:
+        runner.join()
+    assert result["samples"]
+
+
+def test_tracemalloc_is_off_until_started():
+    assert profiling.tracemalloc_top() is None
+
+    assert profiling.start_tracemalloc() is True
+    try:
+        data = [bytearray(1024) for _ in range(100)]
+        top = profiling.tracemalloc_top(limit=5)
+        assert top["traced_bytes"] > 0
+        assert len(top["top"]) <= 5
+    finally:
+        assert profiling.stop_tracemalloc() is True
+
+    assert profiling.tracemalloc_top() is None
+    assert data
+
+
+def test_memory_breakdown_reports_rss():
+    report = profiling.memory_breakdown()
+
+    assert report["max_rss_bytes"] > 0
+    assert report["tracemalloc_active"] is False
@@ -1,8 +1,14 @@
+import numpy as np
+import pandas as pd
 import pytest
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import MagicMock, patch
 from fastapi.testclient import TestClient
 from backend.app.main import app
 from backend.app.auth import AuthService
+from backend.app.assessments import assessment_store
+from backend.app.recommendation import (
+    DERMATOLOGIST, MESSAGES, MONITORING, PLASTIC_SURGEON, count_yes_answers, recommend_tier, recommend_tiers,
+)
 
 # Mock AuthService.get_current_user to bypass authentication for tests
 async def override_get_current_user():
@@ -176,3 +182,112 @@ def test_recommendation_plastic_surgeon_cnn_exact_0_3():
         "national_id": "test_user",
         "recommendation": data["recommendation"]
     })
+
+def test_retry_with_idempotency_key_is_not_saved_twice():
+    # Mock Supabase responses
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(error=None)
+    mock_supabase_client.table.return_value.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.side_effect = [
+        MagicMock(data=[{"cnn_result": 0.2}]), # Medium CNN result
+        MagicMock(data=[{"q1": False, "q2": False, "q3": False, "q4": False, "q5": False}]), # 0 yes answers
+    ]
+    mock_supabase_client.table.return_value.select.return_value.in_.return_value.eq.return_value.execute.return_value = MagicMock(data=[]) # No melanoma selected
+
+    headers = {"Idempotency-Key": "test-retry-save-similar-moles"}
+    first = client.post("/api/save_similar_moles", json={"selected_ids": ["img1"]}, headers=headers)
+    second = client.post("/api/save_similar_moles", json={"selected_ids": ["img1"]}, headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert "dermatologist" in second.json()["recommendation"]
+    assert second.headers["Idempotent-Replayed"] == "true"
+
+    # Selection and recommendation were each inserted once
+    assert mock_supabase_client.table.return_value.insert.call_count == 2
+
+    # Reusing the key for a different selection is rejected
+    conflict = client.post("/api/save_similar_moles", json={"selected_ids": ["img2"]}, headers=headers)
+    assert conflict.status_code == 422
+
+    # ...and for the same selection in another assessment
+    conflict = client.post("/api/save_similar_moles", json={"selected_ids": ["img1"], "assessment_id": "other"},
+                           headers=headers)
+    assert conflict.status_code == 422
+
+def test_recommend_tiers_matches_the_single_user_rules():
+    cnn = [0.35, 0.3, 0.2, 0.15, None, 0.0, 0.1, np.nan]
+    yes = [0, 0, 0, 0, 2, 1, 0, 0]
+    melanoma = [False, False, False, False, False, False, True, False]
+
+    tiers = recommend_tiers(pd.Series(cnn, dtype=float), np.array(yes), melanoma)
+
+    expected = [PLASTIC_SURGEON, PLASTIC_SURGEON, DERMATOLOGIST, MONITORING,
+                PLASTIC_SURGEON, DERMATOLOGIST, PLASTIC_SURGEON, MONITORING]
+    assert tiers.tolist() == expected
+    assert [recommend_tier(*user) for user in zip(cnn, yes, melanoma)] == expected
+
+def test_recommend_tiers_with_candidate_thresholds():
+    tiers = recommend_tiers([0.2, 0.35, 0.45], [0, 0, 0], [False, False, False],
+                            surgeon_threshold=0.4, dermatologist_threshold=0.25)
+    assert tiers.tolist() == [MONITORING, DERMATOLOGIST, PLASTIC_SURGEON]
+
+def test_count_yes_answers_of_a_row_and_of_a_frame():
+    assert count_yes_answers({"q1": True, "q2": False, "q3": True, "q4": None, "q5": False}) == 2
+    answers = pd.DataFrame([
+        {"q1": True, "q2": True, "q3": True, "q4": False, "q5": False},
+        {"q1": np.nan, "q2": np.nan, "q3": np.nan, "q4": np.nan, "q5": np.nan},  # no questionnaire
+    ])
+    assert count_yes_answers(answers).tolist() == [3, 0]
+    assert "plastic surgeon" in MESSAGES[PLASTIC_SURGEON]
+
+def test_recommendation_from_assessment_skips_read_backs():
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(error=None)
+
+    answers = {"q1": True, "q2": False, "q3": False, "q4": False, "q5": False}
+    response = client.post("/api/questionnaire", json=answers)
+    assert response.status_code == 200
+    assessment_id = response.json()["assessment_id"]
+    mock_supabase_client.table.assert_any_call("mole_questionnaires")
+
+    # What /api/analyze records: the stored score and the diagnoses of the similar images
+    assessment_store.record_analysis("test_user", assessment_id, 0.05, [
+        {"image_id": "img1", "diagnosis": "nv"}, {"image_id": "img2", "diagnosis": "mel"},
+    ])
+
+    response = client.post("/api/save_similar_moles", json={"selected_ids": ["img1"], "assessment_id": assessment_id})
+    assert response.status_code == 200
+    assert "dermatologist" in response.json()["recommendation"]  # one "yes" answer
+
+    response = client.post("/api/save_similar_moles", json={"selected_ids": ["img1", "img2"], "assessment_id": assessment_id})
+    assert "plastic surgeon" in response.json()["recommendation"]  # a melanoma was selected
+
+    # Nothing was read back from the database
+    mock_supabase_client.table.return_value.select.assert_not_called()
+
+def test_recommendation_reads_what_the_assessment_lacks():
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(error=None)
+    mock_supabase_client.table.return_value.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.side_effect = [
+        MagicMock(data=[{"q1": True, "q2": True, "q3": False, "q4": False, "q5": False}]), # 2 yes answers
+    ]
+    mock_supabase_client.table.return_value.select.return_value.in_.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
+
+    assessment_id = assessment_store.record_analysis("test_user", None, 0.05, [{"image_id": "img1", "diagnosis": "nv"}])
+    response = client.post("/api/save_similar_moles", json={"selected_ids": ["img9"], "assessment_id": assessment_id})
+
+    assert "plastic surgeon" in response.json()["recommendation"]
+    # The questionnaire and the unknown image's diagnosis came from the database, the score did not
+    mock_supabase_client.table.assert_any_call("mole_questionnaires")
+    mock_supabase_client.table.assert_any_call("ham_metadata")
+    assert ("cnn_results",) not in [c.args for c in mock_supabase_client.table.call_args_list]
+
+def test_other_users_assessment_is_ignored():
+    mock_supabase_client.table.return_value.insert.return_value.execute.return_value = MagicMock(error=None)
+    mock_supabase_client.table.return_value.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.side_effect = [
+        MagicMock(data=[{"cnn_result": 0.05}]),
+        MagicMock(data=[{"q1": False, "q2": False, "q3": False, "q4": False, "q5": False}]),
+    ]
+    mock_supabase_client.table.return_value.select.return_value.in_.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
+
+    assessment_id = assessment_store.record_analysis("someone_else", None, 0.9, [])
+    response = client.post("/api/save_similar_moles", json={"selected_ids": ["img1"], "assessment_id": assessment_id})
+
+    assert "monitoring" in response.json()["recommendation"]
@@ -0,0 +1,96 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+from fastapi import HTTPException
+from backend.app import resilience
+from backend.app.resilience import CircuitBreaker, DependencyTimeout, DependencyUnavailable, deadline, remote_call
+from backend.app.analysis import find_similar_with_metadata
+
+
+def failing_call():
+    raise ConnectionError("database unreachable")
+
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+
+    with patch.dict(resilience.breakers, {"database": breaker}):
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                asyncio.run(remote_call("database", failing_call))
+
+        calls = []
+        with pytest.raises(DependencyUnavailable) as exc_info:
+            asyncio.run(remote_call("database", lambda: calls.append(1)))
+
+    assert breaker.state == "open"
+    assert calls == []
+    assert exc_info.value.status_code == 503
+    assert int(exc_info.value.headers["Retry-After"]) > 0
+
+
+def test_breaker_probe_success_closes_it():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    breaker.before_call()
+    # Only one probe is let through at a time
+    with pytest.raises(DependencyUnavailable):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_database_errors_do_not_trip_the_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+
+    def rejected():
+        raise HTTPException(status_code=400, detail="bad request")
+
+    with patch.dict(resilience.breakers, {"database": breaker}):
+        with pytest.raises(HTTPException):
+            asyncio.run(remote_call("database", rejected))
+
+    assert breaker.state == "closed"
+
+
+def test_remote_call_timeout_is_bounded_by_deadline():
+    breaker = CircuitBreaker("test")
+
+    async def scenario():
+        with deadline(0.1):
+            await remote_call("database", time.sleep, 1, timeout=5)
+
+    with patch.dict(resilience.breakers, {"database": breaker}):
+        start = time.monotonic()
+        with pytest.raises(DependencyTimeout) as exc_info:
+            asyncio.run(scenario())
+
+    assert time.monotonic() - start < 0.5
+    assert exc_info.value.status_code == 504
+
+
+def test_exhausted_deadline_fails_without_calling():
+    calls = []
+
+    async def scenario():
+        with deadline(0):
+            await remote_call("database", lambda: calls.append(1))
+
+    with pytest.raises(DependencyTimeout):
+        asyncio.run(scenario())
+    assert calls == []
+
+
+def test_similar_images_skipped_when_budget_is_exhausted():
+    async def scenario():
+        with deadline(0.01):
+            return await find_similar_with_metadata([0.0] * 256)
+
+    with patch('backend.app.analysis.faiss_service') as mock_faiss_service:
+        assert asyncio.run(scenario()) == []
+        mock_faiss_service.find_similar_images.assert_not_called()
@@ -9,6 +9,9 @@ CREATE TABLE users (
 ALTER TABLE users
 ADD COLUMN last_login TIMESTAMPTZ;
 
+-- Tokens issued up to this time are rejected (POST /admin/users/{national_id}/revoke)
+ALTER TABLE users ADD COLUMN tokens_valid_after TIMESTAMPTZ;
+
 CREATE INDEX idx_users_national_id ON users(national_id);
 
 
@@ -62,6 +65,14 @@ CREATE TABLE cnn_results (
   ALTER TABLE cnn_results DROP CONSTRAINT cnn_results_pkey;
   ALTER TABLE cnn_results ADD PRIMARY KEY (national_id, timestamp);
 
+-- Version (sha256 prefix of the weights file) of the model that produced each result
+ALTER TABLE cnn_results ADD COLUMN model_version TEXT;
+
+-- Version of the model that computed each reference embedding (NULL = computed before versioning);
+-- the index serves scripts/reembed_stale.py's "not the current version" scan
+ALTER TABLE ham_metadata ADD COLUMN embedding_version TEXT;
+CREATE INDEX idx_ham_metadata_embedding_version ON ham_metadata (embedding_version, image_id);
+
 
 select dx, count(*) from ham_metadata where embedding is not null
 group by dx;-- 52 mel, 31 nv, 16 other
@@ -33,6 +33,10 @@ const CheckLesionPage = () => {
 
     const formData = new FormData();
     formData.append('file', file);
+    const assessmentId = sessionStorage.getItem('assessmentId');
+    if (assessmentId) {
+      formData.append('assessment_id', assessmentId);
+    }
 
     setMessage('Analyzing...');
     setAnalysisResult(null);
@@ -53,6 +57,7 @@ const CheckLesionPage = () => {
       }
 
       const result = await response.json();
+      sessionStorage.setItem('assessmentId', result.assessment_id);
       setAnalysisResult(result);
       setMessage('Analysis complete.');
     } catch (error) {
@@ -91,7 +96,7 @@ const CheckLesionPage = () => {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${tokenData.access_token}`,
         },
-        body: JSON.stringify({ selected_ids: selectedImages }),
+        body: JSON.stringify({ selected_ids: selectedImages, assessment_id: sessionStorage.getItem('assessmentId') }),
       });
 
       if (!response.ok) {
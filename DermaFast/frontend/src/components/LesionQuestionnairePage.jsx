@@ -4,7 +4,6 @@ import { Card, CardContent, CardDescription, CardFooter, CardHeader, CardTitle }
 import { Button } from "@/components/ui/button";
 import { Label } from "@/components/ui/label";
 import { RadioGroup, RadioGroupItem } from "@/components/ui/radio-group";
-import { supabase } from "@/supabase";
 
 const questions = [
   {
@@ -48,23 +47,38 @@ const LesionQuestionnairePage = ({ nationalId }) => {
     }
     setError('');
     
+    const tokenData = JSON.parse(localStorage.getItem('authToken'));
+    if (!tokenData || !tokenData.access_token) {
+        setError('You must be logged in to submit the questionnaire.');
+        return;
+    }
+
     const submissionData = {
-        national_id: nationalId,
+        assessment_id: sessionStorage.getItem('assessmentId'),
     };
     questions.forEach((q, index) => {
         submissionData[`q${index + 1}`] = answers[q.id] === 'yes';
     });
 
     try {
-        const { data, error } = await supabase
-            .from('mole_questionnaires')
-            .insert([submissionData]);
+        const response = await fetch('http://localhost:8000/api/questionnaire', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${tokenData.access_token}`,
+            },
+            body: JSON.stringify(submissionData),
+        });
 
-        if (error) {
-            throw error;
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.detail || 'Failed to submit questionnaire');
         }
 
-        console.log("Questionnaire submitted successfully:", data);
+        // The analysis and the similar-mole selection join the same assessment
+        const result = await response.json();
+        sessionStorage.setItem('assessmentId', result.assessment_id);
+        console.log("Questionnaire submitted successfully:", result);
         setShowSuccess(true);
     } catch (error) {
         console.error("Error submitting questionnaire:", error);